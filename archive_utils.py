@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Append-only archive of the raw Statistical API responses, to replay the pipeline without the network.
+
+import os
+import gzip
+import json
+import shutil
+import hashlib
+import datetime
+import threading
+import multiprocessing
+import ndvi_utils
+
+# Segments are closed once they reach this size
+SEGMENT_MAX_BYTES = 64 * 1024 * 1024
+SEGMENT_PREFIX = "segment-"
+SEGMENT_SUFFIX = ".jsonl.gz"
+INDEX_FILE = "index.jsonl"
+
+
+def get_request_hash(download_request):
+    """ Hash of a Statistical API request: url and payload
+    Args:
+        download_request: sentinelhub DownloadRequest
+
+    Returns:
+        request_hash: (str) hex digest
+    """
+    payload = json.dumps(download_request.post_values, sort_keys=True, default=str)
+    return hashlib.sha1((str(download_request.url) + payload).encode()).hexdigest()
+
+
+class ResponseArchive:
+    """ Raw responses stored as gzip compressed JSON lines, one record per parcel:
+    {"parcel_id", "request_hash", "time", "response"}.
+
+    Every append writes one gzip member at the end of the current segment, so segments are only ever
+    appended to. index.jsonl maps each parcel id and request hash to its segment and member offset.
+    """
+
+    def __init__(self, archive_dir, segment_max_bytes=SEGMENT_MAX_BYTES):
+        self.archive_dir = archive_dir
+        self.segment_max_bytes = segment_max_bytes
+        if not os.path.exists(archive_dir):
+            os.makedirs(archive_dir, exist_ok=True)
+        self._index = None
+        # Fetch threads append concurrently
+        self._lock = threading.Lock()
+
+    @property
+    def segments(self):
+        """ Segment file names in write order
+        """
+        return sorted(f for f in os.listdir(self.archive_dir)
+                      if f.startswith(SEGMENT_PREFIX) and f.endswith(SEGMENT_SUFFIX))
+
+    def append(self, parcel_ids, responses, request_hashes):
+        """ Archive the responses of an API request batch
+        Args:
+            parcel_ids: (iterable) Polygon identifiers
+            responses: (iterable) Statistical API responses (json), aligned with parcel_ids
+            request_hashes: (iterable) get_request_hash of each request
+
+        Returns:
+            None
+        """
+        now = datetime.datetime.now().isoformat()
+        records = [{"parcel_id": str(parcel_id), "request_hash": request_hash, "time": now, "response": response}
+                   for parcel_id, response, request_hash in zip(parcel_ids, responses, request_hashes)]
+        if not records:
+            return
+        member = gzip.compress("".join(json.dumps(r) + "\n" for r in records).encode())
+        with self._lock:
+            segment = self._current_segment()
+            path = os.path.join(self.archive_dir, segment)
+            offset = os.path.getsize(path) if os.path.exists(path) else 0
+            with open(path, "ab") as f:
+                f.write(member)
+            entries = [{"parcel_id": r["parcel_id"], "request_hash": r["request_hash"],
+                        "segment": segment, "offset": offset} for r in records]
+            with open(os.path.join(self.archive_dir, INDEX_FILE), "a") as f:
+                f.write("".join(json.dumps(e) + "\n" for e in entries))
+            if self._index is not None:
+                for e in entries:
+                    self._index[e["parcel_id"]] = e
+
+    def add_archive(self, other_dir):
+        """ Append the segments of another archive (a shard of a multi-node run) as new segments
+        Args:
+            other_dir: (str) archive directory to copy
+
+        Returns:
+            n_records: (int) number of index entries added
+        """
+        other = ResponseArchive(other_dir)
+        n_records = 0
+        with self._lock:
+            renamed = {}
+            for segment in other.segments:
+                # A new segment each, so the member offsets of the index stay valid
+                renamed[segment] = self._next_segment()
+                shutil.copyfile(os.path.join(other_dir, segment), os.path.join(self.archive_dir, renamed[segment]))
+            index_file = os.path.join(other_dir, INDEX_FILE)
+            if not renamed or not os.path.isfile(index_file):
+                return 0
+            with open(index_file) as f, open(os.path.join(self.archive_dir, INDEX_FILE), "a") as out:
+                for line in f:
+                    entry = json.loads(line)
+                    entry["segment"] = renamed[entry["segment"]]
+                    out.write(json.dumps(entry) + "\n")
+                    n_records += 1
+            self._index = None
+        return n_records
+
+    def get(self, parcel_id):
+        """ Latest archived record of a parcel, None if it was never archived
+        """
+        entry = self._load_index().get(str(parcel_id))
+        if entry is None:
+            return None
+        with open(os.path.join(self.archive_dir, entry["segment"]), "rb") as f:
+            f.seek(entry["offset"])
+            # Decompression starts at the member holding the record
+            with gzip.GzipFile(fileobj=f) as member:
+                for line in member:
+                    record = json.loads(line)
+                    if record["parcel_id"] == entry["parcel_id"] and record["request_hash"] == entry["request_hash"]:
+                        return record
+        return None
+
+    def iter_records(self, segment):
+        """ Records of a segment, in write order
+        """
+        with gzip.open(os.path.join(self.archive_dir, segment), "rt") as f:
+            for line in f:
+                yield json.loads(line)
+
+    def _current_segment(self):
+        segments = self.segments
+        if segments and os.path.getsize(os.path.join(self.archive_dir, segments[-1])) < self.segment_max_bytes:
+            return segments[-1]
+        return self._next_segment()
+
+    def _next_segment(self):
+        segments = self.segments
+        number = int(segments[-1][len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)]) + 1 if segments else 0
+        return "{}{:06d}{}".format(SEGMENT_PREFIX, number, SEGMENT_SUFFIX)
+
+    def _load_index(self):
+        if self._index is None:
+            self._index = {}
+            index_file = os.path.join(self.archive_dir, INDEX_FILE)
+            if os.path.isfile(index_file):
+                with open(index_file) as f:
+                    for line in f:
+                        entry = json.loads(line)
+                        # Later entries replace earlier ones
+                        self._index[entry["parcel_id"]] = entry
+        return self._index
+
+
+def _parse_segment(args):
+    archive_dir, segment = args
+    archive = ResponseArchive(archive_dir)
+    return [(record["parcel_id"], ndvi_utils.response_to_ndvi_df(record["response"]))
+            for record in archive.iter_records(segment)]
+
+
+def replay(archive_dir, processes=None):
+    """ Parse the archived responses, one segment per worker process
+    Args:
+        archive_dir: (str) archive directory
+        processes: (int) number of worker processes, os.cpu_count() by default
+
+    Returns:
+        Generator of (parcel_ids, ndvi_dfs) batches, one per segment in write order. A parcel archived
+        more than once appears once per record, the latest last.
+    """
+    archive = ResponseArchive(archive_dir)
+    tasks = [(archive_dir, segment) for segment in archive.segments]
+    if not tasks:
+        return
+    with multiprocessing.Pool(min(processes or os.cpu_count(), len(tasks))) as pool:
+        for parsed in pool.imap(_parse_segment, tasks):
+            yield [parcel_id for parcel_id, _ in parsed], [ndvi_df for _, ndvi_df in parsed]
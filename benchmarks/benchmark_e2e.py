@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# End-to-end benchmark of ndvi_plot.py and ndvi_plot_multiprocess.py against a local mock Sentinel Hub.
+#
+# Usage: python benchmarks/benchmark_e2e.py --parcels 1000 --driver serial --output results.json
+
+import os
+import sys
+import glob
+import json
+import time
+import shutil
+import sqlite3
+import argparse
+import datetime
+import resource
+import platform
+import subprocess
+import tempfile
+import numpy as np
+from mock_sentinelhub import MockSentinelHub, DEFAULT_OPTIONS
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARK_DIR)
+DRIVERS = {
+    "serial": os.path.join(REPO_DIR, "ndvi_plot.py"),
+    "multiprocess": os.path.join(REPO_DIR, "multiprocessing", "ndvi_plot_multiprocess.py"),
+}
+REPO_CLI = os.path.join(REPO_DIR, "ndvi_cli.py")
+# Startup time target of `python ndvi_cli.py --help`, in seconds
+STARTUP_TARGET_SECONDS = 0.25
+CROPS = ["BLAT TOU", "ORDI", "PANIS", "BLAT DUR", "GIRA-SOL", "OLIVERES", "VINYA", "ALFALS"]
+
+
+def write_parcel_layer(filename, n_parcels, seed=0):
+    """ Synthetic parcel layer: small squares around Lleida with random crops, written as GeoJSON
+    Args:
+        filename: (str) output GeoJSON file
+        n_parcels: (int) number of polygons
+        seed: (int) random seed
+
+    Returns:
+        None
+    """
+    rng = np.random.default_rng(seed)
+    lon = rng.uniform(0.4, 1.2, n_parcels)
+    lat = rng.uniform(41.4, 41.9, n_parcels)
+    half = rng.uniform(0.0005, 0.003, n_parcels)
+    crops = rng.choice(CROPS, n_parcels)
+    with open(filename, "w") as f:
+        f.write('{"type": "FeatureCollection", "features": [\n')
+        for i in range(n_parcels):
+            x0, x1, y0, y1 = lon[i] - half[i], lon[i] + half[i], lat[i] - half[i], lat[i] + half[i]
+            feature = {"type": "Feature", "properties": {"id": i + 1, "PRODUCTE": str(crops[i])},
+                       "geometry": {"type": "Polygon",
+                                    "coordinates": [[[x0, y0], [x1, y0], [x1, y1], [x0, y1], [x0, y0]]]}}
+            f.write(json.dumps(feature) + (",\n" if i < n_parcels - 1 else "\n"))
+        f.write("]}\n")
+
+
+def _clear_stages(workdir):
+    stages_dir = os.path.join(workdir, "stages")
+    os.makedirs(stages_dir, exist_ok=True)
+    for stage_file in glob.glob(os.path.join(stages_dir, "stages-*.json")):
+        os.remove(stage_file)
+    return stages_dir
+
+
+def _collect_stages(stages_dir):
+    # Stage times summed over every process, with the latency percentiles of one call
+    stages = {}
+    for stage_file in glob.glob(os.path.join(stages_dir, "stages-*.json")):
+        with open(stage_file) as f:
+            for stage, values in json.load(f).items():
+                total = stages.setdefault(stage, {"seconds": 0.0, "calls": 0, "durations": []})
+                total["seconds"] += values["seconds"]
+                total["calls"] += values["calls"]
+                total["durations"].extend(values.get("durations", []))
+    # A batch request for the request stage
+    for total in stages.values():
+        durations = total.pop("durations")
+        if durations:
+            total["p50"] = float(np.percentile(durations, 50))
+            total["p99"] = float(np.percentile(durations, 99))
+    return stages
+
+
+def _run_measures(workdir, returncode, elapsed, stages_dir):
+    # ru_maxrss is in kB on Linux: the largest child process finished so far, this run included
+    peak_rss_mb = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024.0
+    n_done = len(glob.glob(os.path.join(workdir, "ndvi", "*_ndvi.csv")))
+    return {"returncode": returncode, "seconds": elapsed, "parcels_done": n_done,
+            "parcels_per_second": n_done / elapsed if elapsed else 0.0,
+            "peak_rss_mb": peak_rss_mb, "stages": _collect_stages(stages_dir)}
+
+
+def run_driver(driver, workdir, mock, retry_sleep, hedge=None):
+    """ Run one pipeline script in workdir against the mock and collect its measures
+    """
+    stages_dir = _clear_stages(workdir)
+    start = time.time()
+    completed = subprocess.run([sys.executable, os.path.join(BENCHMARK_DIR, "run_pipeline.py"),
+                                DRIVERS[driver], mock.url, stages_dir, str(retry_sleep)]
+                               + ([str(hedge)] if hedge is not None else []), cwd=workdir)
+    return _run_measures(workdir, completed.returncode, time.time() - start, stages_dir)
+
+
+def run_nodes(workdir, mock, n_nodes, n_shards, retry_sleep, lease=10.0, kill_after=None):
+    """ Run `ndvi_cli.py node` in n_nodes local processes standing for the nodes of a multi-node run
+    Args:
+        workdir: (str) base directory shared by the nodes, holding dun2021.geojson
+        mock: MockSentinelHub
+        n_nodes: (int) number of node processes
+        n_shards: (int) number of shards
+        retry_sleep: (float) client sleep between retries
+        lease: (float) seconds before the shards of a dead node are claimed again
+        kill_after: (float) kill the first node after this many seconds, to check that its shards are retaken
+
+    Returns:
+        run: (dict) measures of the run, with the shards done by each node
+    """
+    stages_dir = _clear_stages(workdir)
+    start = time.time()
+    nodes = [subprocess.Popen([sys.executable, os.path.join(BENCHMARK_DIR, "run_pipeline.py"), REPO_CLI, mock.url,
+                               stages_dir, str(retry_sleep), "--", "--base-dir", workdir,
+                               "--log-file", "node-{}.log".format(i), "node", "--shards", str(n_shards),
+                               "--node", "node-{}".format(i), "--lease", str(lease), "--poll", "1",
+                               "--executor", "serial"], cwd=workdir)
+             for i in range(n_nodes)]
+    if kill_after is not None:
+        try:
+            nodes[0].wait(kill_after)
+        except subprocess.TimeoutExpired:
+            nodes[0].kill()
+    returncodes = [node.wait() for node in nodes]
+    run = _run_measures(workdir, max(returncodes[1:] if kill_after is not None else returncodes, default=0),
+                        time.time() - start, stages_dir)
+    connection = sqlite3.connect(os.path.join(workdir, "shards", "coordinator.sqlite"))
+    run["shards"] = dict(connection.execute("SELECT node || ':' || state, COUNT(*) FROM shards GROUP BY node, state"))
+    run["reclaimed"] = connection.execute("SELECT COUNT(*) FROM shards WHERE attempts > 1").fetchone()[0]
+    connection.close()
+    return run
+
+
+def measure_startup(repeat=5, target=STARTUP_TARGET_SECONDS):
+    """ Median wall time of `python ndvi_cli.py --help`, which should not import the heavy modules
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, os.path.join(REPO_DIR, "ndvi_cli.py"), "--help"], cwd=REPO_DIR,
+                       stdout=subprocess.DEVNULL, check=True)
+        times.append(time.perf_counter() - start)
+    seconds = sorted(times)[len(times) // 2]
+    return {"command": "ndvi_cli.py --help", "seconds": seconds, "target_seconds": target,
+            "within_target": seconds <= target}
+
+
+def get_git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPO_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="End-to-end NDVI pipeline benchmark against a mock Sentinel Hub")
+    parser.add_argument("--parcels", type=int, default=1000, help="number of synthetic parcels")
+    parser.add_argument("--driver", choices=sorted(DRIVERS) + ["both"], default="serial")
+    parser.add_argument("--intervals", type=int, default=DEFAULT_OPTIONS["n_intervals"])
+    parser.add_argument("--no-data-ratio", type=float, default=DEFAULT_OPTIONS["no_data_ratio"])
+    parser.add_argument("--latency-median", type=float, default=DEFAULT_OPTIONS["latency_median"])
+    parser.add_argument("--latency-sigma", type=float, default=DEFAULT_OPTIONS["latency_sigma"])
+    parser.add_argument("--error-429", type=float, default=DEFAULT_OPTIONS["error_429"])
+    parser.add_argument("--error-5xx", type=float, default=DEFAULT_OPTIONS["error_5xx"])
+    parser.add_argument("--straggler-ratio", type=float, default=DEFAULT_OPTIONS["straggler_ratio"],
+                        help="share of requests straggler-factor times slower")
+    parser.add_argument("--straggler-factor", type=float, default=DEFAULT_OPTIONS["straggler_factor"])
+    parser.add_argument("--hedge", type=float, help="latency percentile after which requests are hedged")
+    parser.add_argument("--nodes", type=int, default=0, help="also run a multi-node run with this many local nodes")
+    parser.add_argument("--shards", type=int, help="shards of the multi-node run (default: 4 per node)")
+    parser.add_argument("--lease", type=float, default=10.0, help="lease of a shard claim in seconds")
+    parser.add_argument("--kill-node-after", type=float,
+                        help="kill one node after this many seconds, its shards must be retaken by the others")
+    parser.add_argument("--retry-sleep", type=float, default=0.5, help="client sleep between retries")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workdir", help="working directory, a temporary one by default")
+    parser.add_argument("--keep", action="store_true", help="keep the working directory")
+    parser.add_argument("--output", help="JSON results file, printed if not given")
+    parser.add_argument("--startup-repeat", type=int, default=5, help="runs of the CLI startup measure")
+    args = parser.parse_args(argv)
+
+    base_dir = args.workdir or tempfile.mkdtemp(prefix="ndvi_benchmark_")
+    drivers = sorted(DRIVERS) if args.driver == "both" else [args.driver]
+    options = {"n_intervals": args.intervals, "no_data_ratio": args.no_data_ratio,
+               "latency_median": args.latency_median, "latency_sigma": args.latency_sigma,
+               "error_429": args.error_429, "error_5xx": args.error_5xx, "straggler_ratio": args.straggler_ratio,
+               "straggler_factor": args.straggler_factor, "seed": args.seed}
+    results = {"time": datetime.datetime.now().isoformat(), "commit": get_git_commit(),
+               "python": platform.python_version(), "cpu_count": os.cpu_count(),
+               "parcels": args.parcels, "mock": options, "hedge": args.hedge, "runs": {},
+               "startup": measure_startup(args.startup_repeat)}
+    try:
+        for driver in drivers:
+            workdir = os.path.join(base_dir, driver)
+            os.makedirs(workdir, exist_ok=True)
+            write_parcel_layer(os.path.join(workdir, "dun2021.geojson"), args.parcels, args.seed)
+            mock = MockSentinelHub(**options).start()
+            try:
+                run = run_driver(driver, workdir, mock, args.retry_sleep, args.hedge)
+            finally:
+                mock.stop()
+            run["mock"] = mock.report()
+            results["runs"][driver] = run
+        if args.nodes:
+            workdir = os.path.join(base_dir, "nodes")
+            os.makedirs(workdir, exist_ok=True)
+            write_parcel_layer(os.path.join(workdir, "dun2021.geojson"), args.parcels, args.seed)
+            mock = MockSentinelHub(**options).start()
+            try:
+                run = run_nodes(workdir, mock, args.nodes, args.shards or 4 * args.nodes, args.retry_sleep,
+                                args.lease, args.kill_node_after)
+            finally:
+                mock.stop()
+            run["mock"] = mock.report()
+            results["runs"]["nodes"] = run
+    finally:
+        if not args.keep and not args.workdir:
+            shutil.rmtree(base_dir, ignore_errors=True)
+
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    return results
+
+
+if __name__ == "__main__":
+    main()
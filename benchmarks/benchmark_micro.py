@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Microbenchmarks of the parse, aggregate, plot and request building hot paths, with a history by commit.
+#
+# Usage: python benchmarks/benchmark_micro.py [--quick] [--threshold 0.2] [--fail-on-regression]
+
+import os
+import sys
+import json
+import glob
+import time
+import shutil
+import argparse
+import datetime
+import platform
+import tempfile
+import statistics
+import numpy as np
+import pandas as pd
+from mock_sentinelhub import synthetic_response, DEFAULT_OPTIONS
+from benchmark_e2e import REPO_DIR, CROPS, get_git_commit, write_parcel_layer
+
+sys.path.insert(0, REPO_DIR)
+import matplotlib
+matplotlib.use("Agg")
+import graph_utils
+
+HISTORY_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "micro_history.json")
+# Fixture sizes: acquisitions per response, parcels per crop mean, polygons per request batch
+SIZES = {
+    "stats_to_df": [30, 120, 334],
+    "get_crop_mean_ndvi": [100, 1000],
+    "display_ndvi_profiles": [30, 120],
+    "get_current_list_of_months": [12, 24],
+    "build_download_requests": [100, 1000],
+}
+
+
+def _response(n_intervals, seed=0):
+    options = dict(DEFAULT_OPTIONS, n_intervals=n_intervals, no_data_ratio=0.3)
+    return synthetic_response(str(seed).encode(), options)
+
+
+def _ndvi_df(sentinel_api_utils, n_intervals, seed=0):
+    return sentinel_api_utils.response_to_ndvi_df(_response(n_intervals, seed))
+
+
+def _remove_render_hashes(folder):
+    # Plots are incremental: without their hash files they are drawn again
+    for hash_file in glob.glob(os.path.join(folder, "**", "*.sha1"), recursive=True):
+        os.remove(hash_file)
+
+
+def get_benchmarks(workdir, quick=False):
+    """ Benchmarks as (name, size, setup, function); setup runs untimed before every call
+    """
+    try:
+        import sentinel_api_utils
+    except ImportError:
+        sentinel_api_utils = None
+    sizes = {name: values[:1] if quick else values for name, values in SIZES.items()}
+    benchmarks = []
+
+    for n in sizes["get_current_list_of_months"]:
+        benchmarks.append(("get_current_list_of_months", n, None,
+                           lambda n=n: graph_utils.get_current_list_of_months("202101", n)))
+    if sentinel_api_utils is None:
+        return benchmarks
+
+    for n in sizes["stats_to_df"]:
+        response = _response(n)
+        benchmarks.append(("stats_to_df", n, None, lambda response=response: sentinel_api_utils.stats_to_df(response)))
+
+    for n in sizes["get_crop_mean_ndvi"]:
+        base_dir = os.path.join(workdir, "crop_mean_{}".format(n))
+        os.makedirs(base_dir + "/ndvi")
+        df = pd.DataFrame({"id": np.arange(n), "PRODUCTE": np.resize(CROPS[:4], n)})
+        for _id in df["id"]:
+            _ndvi_df(sentinel_api_utils, 60, _id).to_csv(base_dir + "/ndvi/" + str(_id) + "_ndvi.csv")
+        benchmarks.append(("get_crop_mean_ndvi", n, None,
+                           lambda df=df, base_dir=base_dir: sentinel_api_utils.get_crop_mean_ndvi(
+                               df, "id", "PRODUCTE", base_dir)))
+
+    for n in sizes["display_ndvi_profiles"]:
+        base_dir = os.path.join(workdir, "display_{}".format(n))
+        os.makedirs(base_dir + "/ndvi")
+        crop = CROPS[0]
+        ndvi_df = _ndvi_df(sentinel_api_utils, n)
+        ndvi_df.to_csv(base_dir + "/ndvi/1_ndvi.csv")
+        # The with-mean variant reads <id>_<crop>_ndvi.csv, with a Field_ID column
+        ndvi_df.assign(Field_ID=1).to_csv(base_dir + "/ndvi/1_" + crop + "_ndvi.csv")
+        sentinel_api_utils.get_crop_mean_ndvi(pd.DataFrame({"id": [1], "PRODUCTE": [crop]}), "id", "PRODUCTE", base_dir)
+        setup = lambda base_dir=base_dir: _remove_render_hashes(base_dir)
+        benchmarks.append(("display_ndvi_profiles", n, setup,
+                           lambda base_dir=base_dir: graph_utils.display_ndvi_profiles(
+                               1, crop, "NDVI", base_dir, add_error_bars=True)))
+        benchmarks.append(("display_ndvi_profiles_with_mean_profile_of_the_crop", n, setup,
+                           lambda base_dir=base_dir: graph_utils.display_ndvi_profiles_with_mean_profile_of_the_crop(
+                               1, crop, "NDVI", base_dir, add_error_bars=True)))
+        benchmarks.append(("display_ndvi_profiles_with_mean_profile_of_the_crop_with_std", n, setup,
+                           lambda base_dir=base_dir: graph_utils.display_ndvi_profiles_with_mean_profile_of_the_crop_with_std(
+                               1, crop, "NDVI", base_dir, base_dir + "/crop_mean_ndvi", add_error_bars=True)))
+
+    try:
+        import geopandas as gpd
+    except ImportError:
+        return benchmarks
+    for n in sizes["build_download_requests"]:
+        layer = os.path.join(workdir, "layer_{}.geojson".format(n))
+        write_parcel_layer(layer, n)
+        geodf = gpd.read_file(layer)
+        benchmarks.append(("build_download_requests", n, None,
+                           lambda geodf=geodf: sentinel_api_utils.build_download_requests(geodf)))
+    return benchmarks
+
+
+def run_benchmark(setup, function, repeat, min_time):
+    """ Seconds per call of every repetition; a repetition loops until it lasts min_time
+    """
+    times = []
+    for _ in range(repeat):
+        calls, elapsed = 0, 0.0
+        while elapsed < min_time or calls == 0:
+            if setup is not None:
+                setup()
+            start = time.perf_counter()
+            function()
+            elapsed += time.perf_counter() - start
+            calls += 1
+        times.append(elapsed / calls)
+    return times
+
+
+def load_history(history_file=HISTORY_FILE):
+    if os.path.isfile(history_file):
+        with open(history_file) as f:
+            return json.load(f)
+    return {"runs": []}
+
+
+def find_regressions(current, baseline, threshold):
+    """ Benchmarks whose median time grew more than threshold (0.2 = 20%) over the baseline run
+    """
+    regressions = []
+    for key, result in current.items():
+        if key in baseline and baseline[key]["median"] > 0:
+            ratio = result["median"] / baseline[key]["median"]
+            if ratio > 1.0 + threshold:
+                regressions.append({"benchmark": key, "ratio": ratio,
+                                    "baseline": baseline[key]["median"], "current": result["median"]})
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Microbenchmarks of the NDVI hot paths")
+    parser.add_argument("--quick", action="store_true", help="smallest fixture size only")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--min-time", type=float, default=0.2, help="minimum seconds per repetition")
+    parser.add_argument("--filter", help="run only the benchmarks whose name contains this text")
+    parser.add_argument("--threshold", type=float, default=0.2, help="regression threshold (0.2 = 20%%)")
+    parser.add_argument("--history", default=HISTORY_FILE)
+    parser.add_argument("--no-record", action="store_true", help="do not add the run to the history")
+    parser.add_argument("--fail-on-regression", action="store_true")
+    args = parser.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix="ndvi_micro_")
+    results = {}
+    try:
+        for name, size, setup, function in get_benchmarks(workdir, args.quick):
+            if args.filter and args.filter not in name:
+                continue
+            key = "{}[{}]".format(name, size)
+            try:
+                times = run_benchmark(setup, function, args.repeat, args.min_time)
+            except Exception as e:
+                print("{:<75} failed: {}".format(key, e))
+                continue
+            results[key] = {"min": min(times), "median": statistics.median(times)}
+            print("{:<75} {:>10.3f} ms".format(key, 1000 * results[key]["median"]))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    history = load_history(args.history)
+    commit = get_git_commit()
+    # Compare with the latest run of another commit
+    baseline = next((run for run in reversed(history["runs"]) if run["commit"] != commit), None)
+    regressions = find_regressions(results, baseline["results"], args.threshold) if baseline else []
+    for regression in regressions:
+        print("REGRESSION {benchmark}: {current:.6f}s vs {baseline:.6f}s (x{ratio:.2f})".format(**regression))
+
+    if not args.no_record:
+        # One entry per commit, the latest run replacing earlier ones
+        history["runs"] = [run for run in history["runs"] if run["commit"] != commit]
+        history["runs"].append({"commit": commit, "time": datetime.datetime.now().isoformat(),
+                                "python": platform.python_version(), "results": results,
+                                "baseline": baseline["commit"] if baseline else None,
+                                "regressions": regressions})
+        with open(args.history, "w") as f:
+            json.dump(history, f, indent=1)
+
+    if regressions and args.fail_on_regression:
+        sys.exit(1)
+    return results, regressions
+
+
+if __name__ == "__main__":
+    main()
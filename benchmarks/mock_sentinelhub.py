@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Local mock of the Sentinel Hub OAuth and Statistical API endpoints for benchmarks.
+
+import json
+import time
+import base64
+import zlib
+import random
+import datetime
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import numpy as np
+
+# Default behaviour of the mock
+DEFAULT_OPTIONS = {
+    "n_intervals": 60,  # acquisitions per parcel and year
+    "no_data_ratio": 0.3,  # share of acquisitions fully masked (clouds)
+    "latency_median": 0.5,  # seconds
+    "latency_sigma": 0.5,  # sigma of the lognormal latency
+    "error_429": 0.0,  # share of requests answered with 429 Too Many Requests
+    "error_5xx": 0.0,  # share of requests answered with 503
+    "straggler_ratio": 0.0,  # share of requests straggler_factor times slower
+    "straggler_factor": 10.0,
+    "year": 2021,
+    "seed": 0,
+}
+# JWT shaped token, sentinelhub decodes its payload
+BENCHMARK_TOKEN = "e30." + base64.urlsafe_b64encode(json.dumps({"azp": "benchmark"}).encode()).decode().rstrip("=") + ".mock"
+
+
+def synthetic_response(request_body, options):
+    """ Statistical API response with a seasonal NDVI curve, noise and cloud masked acquisitions.
+    The same request body always gives the same response.
+    Args:
+        request_body: (bytes) request payload
+        options: (dict) mock options, see DEFAULT_OPTIONS
+
+    Returns:
+        response: (dict) Statistical API json response
+    """
+    rng = np.random.default_rng(zlib.crc32(request_body) + options["seed"])
+    first = datetime.date(options["year"], 1, 1)
+    days = np.sort(rng.choice(334, size=min(options["n_intervals"], 334), replace=False))
+    # Seasonal curve: a crop specific peak day and amplitude
+    peak, amplitude, base = rng.uniform(120, 220), rng.uniform(0.3, 0.6), rng.uniform(0.1, 0.25)
+    means = base + amplitude * np.exp(-0.5 * ((days - peak) / rng.uniform(25, 50)) ** 2) + rng.normal(0, 0.03, len(days))
+    no_data = rng.random(len(days)) < options["no_data_ratio"]
+    sample_count = int(rng.integers(20, 2000))
+    data = []
+    for day, mean, masked in zip(days, means, no_data):
+        date_from = first + datetime.timedelta(days=int(day))
+        std = abs(rng.normal(0.05, 0.02))
+        data.append({
+            "interval": {"from": date_from.isoformat() + "T00:00:00Z",
+                         "to": (date_from + datetime.timedelta(days=1)).isoformat() + "T00:00:00Z"},
+            "outputs": {
+                "ndvi": {"bands": {"B0": {"stats": {
+                    "min": float(mean - 2 * std), "max": float(mean + 2 * std), "mean": float(mean),
+                    "stDev": float(std), "sampleCount": sample_count,
+                    "noDataCount": sample_count if masked else 0}}}},
+                "masks": {"bands": {"CLM": {"stats": {
+                    "min": 0.0, "max": 1.0 if masked else 0.0, "mean": 1.0 if masked else 0.0, "stDev": 0.0,
+                    "sampleCount": sample_count, "noDataCount": 0}}}},
+                "dataMask": {"bands": {"B0": {"stats": {
+                    "min": 0.0, "max": 1.0, "mean": 0.0 if masked else 1.0, "stDev": 0.0,
+                    "sampleCount": sample_count, "noDataCount": 0}}}},
+            },
+        })
+    return {"data": data, "status": "OK"}
+
+
+class MockSentinelHub:
+    """ Threaded HTTP server answering /oauth/token and /api/v1/statistics.
+
+    Statistics requests wait a lognormal latency, some are stragglers, and may fail with 429 or 503
+    at the configured rates; the service time of every request is recorded for the latency percentiles. Token requests
+    and TCP connections are counted, to check session and connection reuse.
+    """
+
+    def __init__(self, port=0, **options):
+        self.options = dict(DEFAULT_OPTIONS, **options)
+        self.latencies = []
+        self.counts = {"token": 0, "statistics": 0, "429": 0, "5xx": 0, "connections": 0}
+        self._lock = threading.Lock()
+        self._random = random.Random(self.options["seed"])
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), self._make_handler())
+        self.server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{}".format(self.server.server_port)
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def report(self):
+        """ Request counts and latency percentiles in seconds
+        """
+        with self._lock:
+            latencies = np.asarray(self.latencies)
+            report = dict(self.counts)
+        if len(latencies):
+            report.update({"latency_p50": float(np.percentile(latencies, 50)),
+                           "latency_p99": float(np.percentile(latencies, 99)),
+                           "latency_mean": float(latencies.mean())})
+        return report
+
+    def _draw(self):
+        with self._lock:
+            latency = self._random.lognormvariate(np.log(self.options["latency_median"]),
+                                                  self.options["latency_sigma"])
+            failure = self._random.random()
+            if self._random.random() < self.options["straggler_ratio"]:
+                latency *= self.options["straggler_factor"]
+        if failure < self.options["error_429"]:
+            return latency, 429
+        if failure < self.options["error_429"] + self.options["error_5xx"]:
+            return latency, 503
+        return latency, 200
+
+    def _make_handler(self):
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def setup(self):
+                # Once per TCP connection, keep-alive requests reuse it
+                super().setup()
+                with mock._lock:
+                    mock.counts["connections"] += 1
+
+            def do_POST(self):
+                start = time.time()
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                if self.path.endswith("/oauth/token"):
+                    with mock._lock:
+                        mock.counts["token"] += 1
+                    now = time.time()
+                    return self._json(200, {"access_token": BENCHMARK_TOKEN, "token_type": "Bearer",
+                                            "expires_in": 3600, "expires_at": now + 3600})
+                if not self.path.endswith("/statistics"):
+                    return self._json(404, {"error": "unknown endpoint"})
+                latency, status = mock._draw()
+                time.sleep(latency)
+                with mock._lock:
+                    mock.counts["statistics"] += 1
+                    if status == 429:
+                        mock.counts["429"] += 1
+                    elif status != 200:
+                        mock.counts["5xx"] += 1
+                if status != 200:
+                    self._json(status, {"error": {"status": status, "reason": "injected"}})
+                else:
+                    self._json(200, synthetic_response(body, mock.options))
+                with mock._lock:
+                    mock.latencies.append(time.time() - start)
+
+            def _json(self, status, content):
+                data = json.dumps(content).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                if status == 429:
+                    self.send_header("Retry-After", "1")
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Runs ndvi_plot.py or ndvi_plot_multiprocess.py against a mock Sentinel Hub, timing every stage.
+#
+# Usage: python run_pipeline.py <script> <mock_url> <stages_dir> [retry_sleep] [hedge_percentile] [-- script arguments]
+# The script is run from the current directory, which has to hold dun2021.geojson.
+
+import os
+import sys
+import json
+import time
+import runpy
+import functools
+import multiprocessing.util
+
+# Functions timed, by stage: (module name, function name)
+STAGES = {
+    # Requests are parsed as they arrive: a batch request with the parsing of its responses
+    "request": [("pipeline_utils", "fetch_batch")],
+    "parse": [("ndvi_utils", "stats_to_df")],
+    "plot": [("graph_utils", "plot_ndvi_profile"), ("thumbnail_utils", "render_ndvi_thumbnail")],
+    "store": [("cube_utils", "NdviCube.add_batch"), ("similarity_utils", "SimilarityIndex.add_profiles")],
+}
+
+_stage_times = {}
+
+
+def _timed(stage, function):
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            _stage_times.setdefault(stage, []).append(time.perf_counter() - start)
+    return wrapper
+
+
+def _instrument():
+    for stage, targets in STAGES.items():
+        for module_name, name in targets:
+            try:
+                module = __import__(module_name)
+            except ImportError:
+                continue
+            owner = module
+            *path, attribute = name.split(".")
+            for part in path:
+                owner = getattr(owner, part, None)
+            if owner is not None and hasattr(owner, attribute):
+                setattr(owner, attribute, _timed(stage, getattr(owner, attribute)))
+
+
+class _StageDump:
+    """ Writes the stage times of the process at exit, re-registered in every forked worker
+    """
+
+    def __init__(self, stages_dir):
+        self.stages_dir = stages_dir
+        self.register()
+        multiprocessing.util.register_after_fork(self, _StageDump.after_fork)
+
+    def register(self):
+        # Run at exit of the main process and of multiprocessing workers
+        multiprocessing.util.Finalize(None, _dump_stages, args=(self.stages_dir,), exitpriority=10)
+
+    def after_fork(self):
+        # Forked workers start with an empty finalizer registry and the parent's times
+        _stage_times.clear()
+        self.register()
+
+
+def _dump_stages(stages_dir):
+    # Every process, workers included, writes its own file
+    with open(os.path.join(stages_dir, "stages-{}.json".format(os.getpid())), "w") as f:
+        json.dump({stage: {"seconds": sum(durations), "calls": len(durations), "durations": durations}
+                   for stage, durations in _stage_times.items()}, f)
+
+
+def main(script, mock_url, stages_dir, retry_sleep=0.5, hedge_percentile=None, script_args=()):
+    # The mock is plain http
+    os.environ["OAUTHLIB_INSECURE_TRANSPORT"] = "1"
+    sys.path.insert(0, os.path.dirname(os.path.abspath(script)))
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import sentinel_api_utils
+    config = sentinel_api_utils.config
+    config.sh_base_url = mock_url
+    if hasattr(config, "sh_auth_base_url"):
+        config.sh_auth_base_url = mock_url
+    if hasattr(config, "sh_token_url"):
+        config.sh_token_url = mock_url + "/oauth/token"
+    config.sh_client_id = "benchmark"
+    config.sh_client_secret = "benchmark"
+    config.download_sleep_time = retry_sleep
+    # Data collections pin their own service url, which the config does not override
+    sentinel_api_utils.data_collection = sentinel_api_utils.data_collection.define_from(
+        "BENCHMARK_" + sentinel_api_utils.data_collection.name, service_url=mock_url)
+    if hedge_percentile is not None:
+        import session_utils
+        session_utils.hedge_percentile = hedge_percentile
+    _instrument()
+    stage_dump = _StageDump(stages_dir)
+    sys.argv = [script] + list(script_args)
+    runpy.run_path(script, run_name="__main__")
+
+
+if __name__ == "__main__":
+    argv = sys.argv[1:sys.argv.index("--")] if "--" in sys.argv else sys.argv[1:]
+    main(argv[0], argv[1], argv[2], float(argv[3]) if len(argv) > 3 else 0.5, float(argv[4]) if len(argv) > 4 else None,
+         sys.argv[sys.argv.index("--") + 1:] if "--" in sys.argv else ())
@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Dense parcel x day-of-year NDVI cube stored as memory-mapped files.
+
+import os
+import json
+import numpy as np
+import pandas as pd
+from numpy.lib.format import open_memmap
+
+# Number of day-of-year columns (leap years included)
+CUBE_DAYS = 366
+# Spacing in days of the regular gap-filled grid
+GRID_STEP = 5
+
+META_FILE = "meta.json"
+MEAN_FILE = "ndvi_mean.npy"
+STD_FILE = "ndvi_std.npy"
+VALID_FILE = "valid.npy"
+PARCEL_ID_FILE = "parcel_id.npy"
+CROP_FILE = "crop.npy"
+
+
+def create_cube(cube_dir, parcel_ids, crops, year, overwrite=False):
+    """ Create an empty NDVI cube on disk, or open the existing one
+    Args:
+        cube_dir: (str) cube directory
+        parcel_ids: (iterable) Polygon identifiers, one row per parcel
+        crops: (iterable) Polygon crop names, aligned with parcel_ids
+        year: (int) year covered by the day-of-year axis
+        overwrite: (bool) discard an existing cube in cube_dir
+
+    Returns:
+        cube: NdviCube opened for writing
+    """
+    if os.path.isfile(os.path.join(cube_dir, META_FILE)) and not overwrite:
+        cube = NdviCube(cube_dir, mode="r+")
+        if cube.year != year or cube.n_parcels != len(parcel_ids):
+            raise ValueError("Existing cube at {} does not match the requested layout".format(cube_dir))
+        return cube
+
+    if not os.path.exists(cube_dir):
+        os.makedirs(cube_dir)
+
+    parcel_ids = np.asarray([str(_id) for _id in parcel_ids])
+    crops = np.asarray([str(crop) for crop in crops])
+    if len(parcel_ids) != len(crops):
+        raise ValueError("parcel_ids and crops must have the same length")
+    n_parcels = len(parcel_ids)
+
+    # Index arrays
+    np.save(os.path.join(cube_dir, PARCEL_ID_FILE), parcel_ids)
+    np.save(os.path.join(cube_dir, CROP_FILE), crops)
+    # Data arrays, NaN until a profile is added
+    for filename in (MEAN_FILE, STD_FILE):
+        data = open_memmap(os.path.join(cube_dir, filename), mode="w+",
+                           dtype=np.float32, shape=(n_parcels, CUBE_DAYS))
+        data[:] = np.nan
+        data.flush()
+        del data
+    # One bit per day and parcel
+    valid = open_memmap(os.path.join(cube_dir, VALID_FILE), mode="w+",
+                        dtype=np.uint8, shape=(n_parcels, (CUBE_DAYS + 7) // 8))
+    valid[:] = 0
+    valid.flush()
+    del valid
+
+    with open(os.path.join(cube_dir, META_FILE), "w") as f:
+        json.dump({"year": int(year), "n_parcels": n_parcels, "n_days": CUBE_DAYS}, f)
+
+    return NdviCube(cube_dir, mode="r+")
+
+
+def open_cube(cube_dir, mode="r"):
+    """ Open an existing NDVI cube
+    Args:
+        cube_dir: (str) cube directory
+        mode: (str) "r" for read only, "r+" to add profiles
+
+    Returns:
+        cube: NdviCube
+    """
+    return NdviCube(cube_dir, mode=mode)
+
+
+class NdviCube:
+    """ Parcel x day-of-year NDVI mean/std arrays backed by memory-mapped files.
+
+    Row i holds the parcel parcel_id[i] (crop crop[i]); column j holds day-of-year j + 1.
+    Days without a valid observation are NaN and have their bit cleared in the validity mask.
+    """
+
+    def __init__(self, cube_dir, mode="r"):
+        self.cube_dir = cube_dir
+        self.mode = mode
+        with open(os.path.join(cube_dir, META_FILE)) as f:
+            meta = json.load(f)
+        self.year = meta["year"]
+        self.n_days = meta["n_days"]
+        self.parcel_id = np.load(os.path.join(cube_dir, PARCEL_ID_FILE))
+        self.crop = np.load(os.path.join(cube_dir, CROP_FILE))
+        self.mean = np.load(os.path.join(cube_dir, MEAN_FILE), mmap_mode=mode)
+        self.std = np.load(os.path.join(cube_dir, STD_FILE), mmap_mode=mode)
+        self.valid_bits = np.load(os.path.join(cube_dir, VALID_FILE), mmap_mode=mode)
+        self._rows = None
+
+    @property
+    def n_parcels(self):
+        return len(self.parcel_id)
+
+    @property
+    def dates(self):
+        """ Dates of the day-of-year axis (numpy datetime64[D])
+        """
+        return np.datetime64("{}-01-01".format(self.year)) + np.arange(self.n_days)
+
+    def row(self, parcel_id):
+        """ Row index of a parcel
+        """
+        if self._rows is None:
+            self._rows = {_id: i for i, _id in enumerate(self.parcel_id)}
+        return self._rows[str(parcel_id)]
+
+    def rows(self, parcel_ids):
+        """ Row indexes of several parcels
+        """
+        return np.asarray([self.row(_id) for _id in parcel_ids], dtype=np.int64)
+
+    def day_index(self, dates):
+        """ Day-of-year column index of each date
+        """
+        dates = pd.to_datetime(pd.Series(dates)).values.astype("datetime64[D]")
+        return (dates - np.datetime64("{}-01-01".format(self.year))).astype(np.int64)
+
+    def valid(self, rows=slice(None)):
+        """ Validity mask as a boolean array for the selected rows
+        """
+        return np.unpackbits(self.valid_bits[rows], axis=-1, count=self.n_days).astype(bool)
+
+    def add_profile(self, parcel_id, ndvi_df):
+        """ Store one parcel profile (acq_date, ndvi_mean, ndvi_std columns) in its row
+        Args:
+            parcel_id: Polygon identifier
+            ndvi_df: Pandas Dataframe
+
+        Returns:
+            None
+        """
+        row = self.row(parcel_id)
+        mean = np.full(self.n_days, np.nan, dtype=np.float32)
+        std = np.full(self.n_days, np.nan, dtype=np.float32)
+        if not ndvi_df.empty:
+            days = self.day_index(ndvi_df["acq_date"])
+            # Keep dates inside the cube year
+            in_year = (days >= 0) & (days < self.n_days)
+            days = days[in_year]
+            mean[days] = pd.to_numeric(ndvi_df["ndvi_mean"], errors="coerce").values[in_year]
+            std[days] = pd.to_numeric(ndvi_df["ndvi_std"], errors="coerce").values[in_year]
+        self.mean[row] = mean
+        self.std[row] = std
+        self.valid_bits[row] = np.packbits(~np.isnan(mean))
+
+    def add_batch(self, parcel_ids, ndvi_dfs):
+        """ Store the profiles of an API request batch and flush them to disk
+        Args:
+            parcel_ids: (iterable) Polygon identifiers
+            ndvi_dfs: (iterable) Pandas Dataframes, aligned with parcel_ids
+
+        Returns:
+            None
+        """
+        for parcel_id, ndvi_df in zip(parcel_ids, ndvi_dfs):
+            self.add_profile(parcel_id, ndvi_df)
+        self.flush()
+
+    def add_cube(self, other):
+        """ Copy the rows of another cube of the same year (a shard of a multi-node run) and flush them
+        Args:
+            other: NdviCube whose parcels are all in this cube
+
+        Returns:
+            None
+        """
+        if other.year != self.year or other.n_days != self.n_days:
+            raise ValueError("Cube {} does not match the layout of {}".format(other.cube_dir, self.cube_dir))
+        rows = self.rows(other.parcel_id)
+        self.mean[rows] = other.mean[:]
+        self.std[rows] = other.std[:]
+        self.valid_bits[rows] = other.valid_bits[:]
+        self.flush()
+
+    def profile(self, parcel_id):
+        """ Parcel profile as a Dataframe with the columns of the ndvi csv files
+        """
+        row = self.row(parcel_id)
+        valid = self.valid(row)
+        return pd.DataFrame({"acq_date": pd.to_datetime(self.dates[valid]),
+                             "ndvi_mean": self.mean[row][valid].astype(np.float64),
+                             "ndvi_std": self.std[row][valid].astype(np.float64)})
+
+    def iter_chunks(self, chunk_size=10000, gap_filled=False, step=GRID_STEP):
+        """ Iterate over the cube in blocks of rows, so that only one block is held in memory
+        Args:
+            chunk_size: (int) number of parcels per block
+            gap_filled: (bool) return values interpolated onto a regular grid
+            step: (int) grid spacing in days when gap_filled is True
+
+        Returns:
+            Generator of (rows, mean, std, valid); with gap_filled the last item is the grid days
+        """
+        for start in range(0, self.n_parcels, chunk_size):
+            rows = slice(start, min(start + chunk_size, self.n_parcels))
+            mean = np.asarray(self.mean[rows])
+            std = np.asarray(self.std[rows])
+            valid = self.valid(rows)
+            if gap_filled:
+                grid = regular_grid(self.n_days, step)
+                yield rows, interpolate_rows(mean, valid, grid), interpolate_rows(std, valid, grid), grid
+            else:
+                yield rows, mean, std, valid
+
+    def flush(self):
+        if self.mode != "r":
+            self.mean.flush()
+            self.std.flush()
+            self.valid_bits.flush()
+
+
+def regular_grid(n_days=CUBE_DAYS, step=GRID_STEP):
+    """ Day indexes of a regular grid with 'step' days spacing
+    """
+    return np.arange(0, n_days, step)
+
+
+def interpolate_rows(values, valid, x_out):
+    """ Linear interpolation of every row at the column positions x_out, using only valid cells.
+
+    Positions before the first (after the last) valid cell take its value. Rows without any
+    valid cell are NaN.
+
+    Args:
+        values: (numpy.ndarray) 2D array, one series per row
+        valid: (numpy.ndarray) boolean mask with the shape of values
+        x_out: (numpy.ndarray) integer column positions
+
+    Returns:
+        out: (numpy.ndarray) float32 array of shape (rows, len(x_out))
+    """
+    n_rows, n_cols = values.shape
+    x_out = np.asarray(x_out)
+    idx = np.arange(n_cols)
+    # Previous and next valid column for every column
+    prev_idx = np.maximum.accumulate(np.where(valid, idx, -1), axis=1)[:, x_out]
+    next_idx = np.minimum.accumulate(np.where(valid, idx, n_cols)[:, ::-1], axis=1)[:, ::-1][:, x_out]
+    has_prev = prev_idx >= 0
+    has_next = next_idx < n_cols
+    # Without a neighbour on one side hold the other one
+    lo = np.where(has_prev, prev_idx, np.where(has_next, next_idx, 0))
+    hi = np.where(has_next, next_idx, lo)
+    r = np.arange(n_rows)[:, None]
+    v_lo = values[r, lo]
+    v_hi = values[r, hi]
+    span = hi - lo
+    w = np.where(span > 0, (x_out - lo) / np.maximum(span, 1), 0.0)
+    out = (v_lo + w * (v_hi - v_lo)).astype(np.float32)
+    out[~(has_prev | has_next)] = np.nan
+    return out
+
+
+def build_cube_from_csv(df, id_column, crop_column, base_dir, year, chunk_size=1000):
+    """ Build the cube of an existing run from its ndvi/<id>_ndvi.csv files
+    Args:
+        df: Pandas Dataframe
+        id_column: (int) Polygon identifier
+        crop_column: (str) Polygon crop name
+        base_dir: (str) base directory
+        year: (int) year covered by the day-of-year axis
+        chunk_size: (int) number of parcels written between flushes
+
+    Returns:
+        cube: NdviCube
+    """
+    cube = create_cube(base_dir + "/ndvi_cube", df[id_column], df[crop_column], year, overwrite=True)
+    for i, _id in enumerate(df[id_column]):
+        filename = base_dir + "/ndvi/" + str(_id) + "_ndvi.csv"
+        if os.path.isfile(filename):
+            cube.add_profile(_id, pd.read_csv(filename))
+        if (i + 1) % chunk_size == 0:
+            cube.flush()
+    cube.flush()
+    return cube
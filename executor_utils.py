@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Execution backends of the pipeline: serial, thread pool, process pool or both (hybrid).
+#
+# Requests are I/O bound and go to threads; plotting is CPU bound and goes to processes whose
+# initializer loads matplotlib once. Every backend has the concurrent.futures submit interface.
+
+import os
+import math
+import multiprocessing
+import multiprocessing.util
+import concurrent.futures
+import metrics_utils
+import profile_utils
+import log_utils
+
+EXECUTORS = ("serial", "thread", "process", "hybrid")
+# Concurrent requests when there are no measures of a previous run, and upper bound
+DEFAULT_FETCH_WORKERS = 4
+MAX_FETCH_WORKERS = 8
+
+
+class SerialExecutor(concurrent.futures.Executor):
+    """ Runs every task at once in the calling thread, for debugging and profiling
+    """
+
+    def submit(self, fn, /, *args, **kwargs):
+        future = concurrent.futures.Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except BaseException as e:
+            future.set_exception(e)
+        return future
+
+
+def warm_matplotlib():
+    """ Load matplotlib with the Agg backend, and its fonts, by drawing a tiny figure
+    """
+    import matplotlib
+    matplotlib.use("Agg")
+    from matplotlib import pyplot
+    fig = pyplot.figure(figsize=(1, 1))
+    fig.text(0.5, 0.5, "NDVI 2021")
+    fig.canvas.draw()
+    pyplot.close(fig)
+
+
+def _init_process(metrics_dir, log_queue, profile_options, initializer, initargs):
+    if log_queue is not None:
+        log_utils.configure_worker(log_queue)
+    # Metrics of this worker only
+    name = multiprocessing.current_process().name
+    metrics_utils.reset()
+    metrics_utils.set_worker(name)
+    profile_utils.start_worker(name, profile_options)
+    # Written at exit, before the last log batch is sent
+    multiprocessing.util.Finalize(None, _exit_process, args=(metrics_dir,), exitpriority=20)
+    if initializer is not None:
+        initializer(*initargs)
+
+
+def _exit_process(metrics_dir):
+    if metrics_dir is not None:
+        metrics_utils.dump(metrics_dir)
+    profile_utils.stop_worker()
+
+
+def _stage_seconds(metrics_summary, stage):
+    # Total seconds and calls of a stage over every worker
+    entry = metrics_summary.get("stages", {}).get(stage, {}).get("all")
+    return (entry["seconds"], entry["calls"]) if entry else (0.0, 0)
+
+
+def get_worker_counts(executor, metrics_summary=None, cpu_count=None):
+    """ Number of fetch threads and render processes of an executor
+    Args:
+        executor: (str) one of EXECUTORS
+        metrics_summary: (dict) metrics_utils summary of a previous run, to size the fetch threads
+        cpu_count: (int) number of CPUs, os.cpu_count() by default
+
+    Returns:
+        fetch_workers: (int) concurrent requests, 1 without threads
+        render_workers: (int) render processes, 0 when rendering in the main process
+    """
+    if executor not in EXECUTORS:
+        raise ValueError("Unknown executor {}, use one of {}".format(executor, EXECUTORS))
+    cpu_count = cpu_count or os.cpu_count() or 1
+    # One CPU is left to the main process, which parses, writes and stores
+    render_workers = max(1, cpu_count - 1) if executor in ("process", "hybrid") else 0
+    if executor not in ("thread", "hybrid"):
+        return 1, render_workers
+    fetch_workers = DEFAULT_FETCH_WORKERS
+    download_seconds, n_batches = _stage_seconds(metrics_summary or {}, "download")
+    if n_batches:
+        # Enough requests in flight to keep the local stages busy: request time / local time per batch
+        request_seconds = download_seconds + _stage_seconds(metrics_summary, "request_build")[0]
+        local_seconds = sum(_stage_seconds(metrics_summary, stage)[0] for stage in ("parse", "write", "store"))
+        local_seconds += _stage_seconds(metrics_summary, "render")[0] / max(1, render_workers)
+        fetch_workers = math.ceil(request_seconds / max(local_seconds, 1e-3))
+    return min(max(1, fetch_workers), MAX_FETCH_WORKERS), render_workers
+
+
+def create_executors(executor, fetch_workers=None, render_workers=None, metrics_summary=None, metrics_dir=None,
+                     initializer=None, initargs=()):
+    """ Executors of the fetch and render stages
+    Args:
+        executor: (str) "serial", "thread" (threaded requests), "process" (render processes) or "hybrid" (both)
+        fetch_workers: (int) concurrent requests, auto-sized by default
+        render_workers: (int) render processes, auto-sized by default
+        metrics_summary: (dict) metrics_utils summary of a previous run, to size the fetch threads
+        metrics_dir: (str) directory where the render processes dump their metrics
+        initializer: function run once in every render process, warm_matplotlib by default
+        initargs: (tuple) initializer arguments
+
+    Returns:
+        fetch_executor: concurrent.futures Executor
+        render_executor: concurrent.futures Executor
+    """
+    auto_fetch, auto_render = get_worker_counts(executor, metrics_summary)
+    fetch_workers = fetch_workers or auto_fetch
+    render_workers = render_workers or auto_render
+    if executor in ("process", "hybrid"):
+        render_executor = concurrent.futures.ProcessPoolExecutor(
+            render_workers, initializer=_init_process,
+            initargs=(metrics_dir, log_utils.get_queue(), profile_utils.get_options(),
+                      initializer or warm_matplotlib, initargs))
+        # Start the workers now, before any fetch thread: forking a process with running threads may deadlock
+        render_executor.submit(os.getpid).result()
+    else:
+        render_executor = SerialExecutor()
+    if executor in ("thread", "hybrid") and fetch_workers > 1:
+        fetch_executor = concurrent.futures.ThreadPoolExecutor(fetch_workers, thread_name_prefix="fetch")
+    else:
+        fetch_executor = SerialExecutor()
+    return fetch_executor, render_executor
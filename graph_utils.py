@@ -8,6 +8,7 @@
 # License   : 3-Clause BSD
 
 import datetime
+import functools
 import logging
 import calendar
 import os
@@ -15,14 +16,100 @@ import time
 import numpy as np
 import pandas as pd
 import matplotlib.dates as mdates
+import matplotlib.image as mimage
 from matplotlib import pyplot
+from matplotlib.collections import LineCollection
+from matplotlib.backends.backend_pdf import PdfPages
 import matplotlib.ticker as ticker
+import smoothing_utils
+import render_cache_utils
+import metrics_utils
+
+# Bump when the look of the plots changes, so that existing images are drawn again
+RENDERER_VERSION = "1"
+
+# Number of crop mean profiles kept in memory
+CROP_PROFILE_CACHE_SIZE = 128
+
+# Crop mean profiles given in memory, by crop name
+_crop_profiles = {}
+
 
 def get_ndvi_profiles_from_csv(csv_file):
     ndvi_profile = pd.read_csv(csv_file)
     return ndvi_profile
 
 
+def prepare_crop_profile(mean_ndvi_profile):
+    """
+    parses and sorts a crop mean profile (acq_date, ndvi_mean, ndvi_stdev columns) and
+    precomputes its std band
+    """
+    mean_ndvi_profile = mean_ndvi_profile.copy()
+    mean_ndvi_profile['acq_date'] = pd.to_datetime(mean_ndvi_profile.acq_date)
+    mean_ndvi_profile = mean_ndvi_profile.sort_values(by=['acq_date'])
+    # rename the column names from 'ndvi_mean' to more meaningful name
+    mean_ndvi_profile = mean_ndvi_profile.rename(
+        columns={'ndvi_mean': 'S2 NDVI mean', 'acq_date': 'date'})
+    if 'ndvi_stdev' in mean_ndvi_profile:
+        mean_ndvi_profile['band_low'] = mean_ndvi_profile['S2 NDVI mean'] - mean_ndvi_profile['ndvi_stdev']
+        mean_ndvi_profile['band_high'] = mean_ndvi_profile['S2 NDVI mean'] + mean_ndvi_profile['ndvi_stdev']
+    return mean_ndvi_profile
+
+
+@functools.lru_cache(maxsize=CROP_PROFILE_CACHE_SIZE)
+def _load_crop_profile(mean_ndvi_csv_file, mtime_ns):
+    # The modification time is part of the key, so a rewritten file is read again
+    return prepare_crop_profile(pd.read_csv(mean_ndvi_csv_file))
+
+
+def set_crop_profiles(crop_profiles):
+    """
+    registers in-memory crop mean profiles, such as the ones returned by get_crop_mean_ndvi,
+    so that they are used instead of the csv files
+    """
+    for crop, mean_ndvi_profile in crop_profiles.items():
+        _crop_profiles[str(crop)] = prepare_crop_profile(mean_ndvi_profile)
+
+
+def get_crop_profile(crop, mean_profile_folder):
+    """
+    returns the prepared mean profile of the crop, or None if there is none. Each profile is read
+    once per process and again when its file changes; the returned dataframe is shared and must
+    not be modified
+    """
+    if crop in _crop_profiles:
+        metrics_utils.inc("cache_requests_total", cache="crop_profile", result="hit")
+        return _crop_profiles[crop]
+    mean_ndvi_csv_file = mean_profile_folder + "/" + crop + ".csv"
+    # Missing files are not cached, the profile may be written later
+    try:
+        mtime_ns = os.stat(mean_ndvi_csv_file).st_mtime_ns
+    except FileNotFoundError:
+        metrics_utils.inc("cache_requests_total", cache="crop_profile", result="miss")
+        return None
+    hits = _load_crop_profile.cache_info().hits
+    mean_ndvi_profile = _load_crop_profile(mean_ndvi_csv_file, mtime_ns)
+    metrics_utils.inc("cache_requests_total", cache="crop_profile",
+                      result="hit" if _load_crop_profile.cache_info().hits > hits else "miss")
+    return mean_ndvi_profile
+
+
+def prepare_ndvi_profile(ndvi_profile):
+    """
+    parses the dates of an NDVI profile (Dataframe or dict of arrays with acq_date, ndvi_mean and
+    ndvi_std), sorts it and renames its columns for plotting. The given profile is not modified
+    """
+    if not isinstance(ndvi_profile, pd.DataFrame):
+        ndvi_profile = pd.DataFrame(ndvi_profile)
+    ndvi_profile = ndvi_profile.assign(acq_date=pd.to_datetime(ndvi_profile.acq_date))
+    ndvi_profile = ndvi_profile.sort_values(by=['acq_date'])
+    # rename the column names from 'ndvi_mean' to more meaningful name
+    ndvi_profile = ndvi_profile.rename(columns={'ndvi_mean': 'S2 NDVI'})
+    ndvi_profile = ndvi_profile.rename(columns={'acq_date': 'date'})
+    return ndvi_profile
+
+
 def get_current_list_of_months(first_year_month, number_of_year_months):
     textstrs_tuples = [
         ("202001", "2020\nJAN"),
@@ -73,25 +160,35 @@ def diff_month(d1, d2):
 
 
 def display_ndvi_profiles(parcel_id, crop, plot_title, out_tif_folder_base,
-                          add_error_bars=False):
+                          add_error_bars=False, smoothing="polynomial"):
     """
-    this function plots the NDVI profile and saves the figures to the outputFolder
+    this function reads the NDVI profile csv, plots it and saves the figures to the outputFolder
     """
-    y_tick_spacing = 0.1
-    start = time.time()
     chip_folder = str(parcel_id)
     ndvi_folder = out_tif_folder_base + "/ndvi"
     ndvi_csv_file = ndvi_folder + "/" + chip_folder + "_ndvi.csv"
     output_graph_folder = out_tif_folder_base + "/ndvi_graphs"
-    if not os.path.exists(output_graph_folder):
-        os.makedirs(output_graph_folder)
     ndvi_profile = pd.read_csv(ndvi_csv_file)
 
-    ndvi_profile['acq_date'] = pd.to_datetime(ndvi_profile.acq_date)
-    ndvi_profile = ndvi_profile.sort_values(by=['acq_date'])
-    # rename the column names from 'ndvi_mean' to more meaningful name
-    ndvi_profile = ndvi_profile.rename(columns={'ndvi_mean': 'S2 NDVI'})
-    ndvi_profile = ndvi_profile.rename(columns={'acq_date': 'date'})
+    return plot_ndvi_profile(ndvi_profile, parcel_id, crop, plot_title,
+                             output_graph_folder + '/' + str(parcel_id) + '_NDVI.jpg',
+                             add_error_bars=add_error_bars, smoothing=smoothing)
+
+
+def plot_ndvi_profile(ndvi_profile, parcel_id, crop, plot_title, output_file,
+                      add_error_bars=False, smoothing="polynomial", incremental=True):
+    """
+    this function plots an already loaded NDVI profile and saves the figure to output_file
+    (a path, or a file-like object that receives a PNG)
+    the trend line uses the smoothing_utils method given by smoothing
+    with incremental, the drawing is skipped if output_file was drawn from the same data; the prepared
+    profile is returned either way
+    """
+    y_tick_spacing = 0.1
+    start = time.time()
+    render_hash = render_cache_utils.get_render_hash(
+        ndvi_profile, RENDERER_VERSION, "profile", parcel_id, crop, plot_title, add_error_bars, smoothing)
+    ndvi_profile = prepare_ndvi_profile(ndvi_profile)
 
     # check if there are real NDVI values and stdev values in the dataframe
     # (for very small parcels the values in the csv can be None which evaluates as object in
@@ -99,6 +196,14 @@ def display_ndvi_profiles(parcel_id, crop, plot_title, out_tif_folder_base,
     if not ndvi_profile['S2 NDVI'].dtypes == "float64" or \
             not ndvi_profile['ndvi_std'].dtypes == "float64":
         return
+    # Smooth line (polynomial regression by default), returned with the profile
+    ndvi_profile['pol_regr'] = smoothing_utils.smooth_series(
+        ndvi_profile['date'], ndvi_profile['S2 NDVI'], method=smoothing)
+    if incremental and isinstance(output_file, str) and render_cache_utils.is_render_current(output_file, render_hash):
+        # Not drawn again, the prepared profile and its trend are still returned
+        render_cache_utils.count_render(reused=True)
+        return ndvi_profile
+    _make_output_folder(output_file)
 
     # plot the time series
     ax0 = pyplot.gca()
@@ -113,10 +218,6 @@ def display_ndvi_profiles(parcel_id, crop, plot_title, out_tif_folder_base,
             ndvi_profile.plot(kind='line', marker='+', x='date',
                               y='S2 NDVI', color='blue', label='pol mean', ax=ax0)
 
-    # Smooth line using polynomial regression
-    date_num = mdates.date2num(ndvi_profile['date'])
-    poly = np.polyfit(date_num, ndvi_profile['S2 NDVI'], 5)
-    ndvi_profile['pol_regr'] = np.poly1d(poly)(date_num)
     ndvi_profile.plot(kind='line', x='date', y='pol_regr',
                       color='red', label='trend', ax=ax0)
 
@@ -171,8 +272,11 @@ def display_ndvi_profiles(parcel_id, crop, plot_title, out_tif_folder_base,
     ax0.yaxis.set_major_locator(ticker.MultipleLocator(y_tick_spacing))
 
     # save the figure to a jpg file
-    fig.savefig(output_graph_folder + '/' + str(parcel_id) + '_NDVI.jpg')
+    fig.savefig(output_file, format=None if isinstance(output_file, str) else 'png')
     pyplot.close(fig)
+    if isinstance(output_file, str):
+        render_cache_utils.store_render_hash(output_file, render_hash)
+    render_cache_utils.count_render(reused=False)
     logging.info((datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S") + "\t" + str(parcel_id) + "\tgraph_utils.display_ndvi_profiles:\t" +
                   "{0:.3f}".format(time.time() - start)))
 
@@ -180,40 +284,42 @@ def display_ndvi_profiles(parcel_id, crop, plot_title, out_tif_folder_base,
 
 
 def display_ndvi_profiles_with_mean_profile_of_the_crop(parcel_id, crop, plot_title, out_tif_folder_base,
-                                                        add_error_bars=False):
+                                                        add_error_bars=False, mean_profile_folder=None):
     """
-    this function plots the NDVI profile and saves the figures to the outputFolder
+    this function reads the NDVI profile csv, plots it and saves the figures to the outputFolder
+    the crop mean profiles are read from mean_profile_folder (crop_mean_ndvi by default)
     """
-    mean_profile_folder = "c:/Users/Csaba/ownCloud/GTCAP/cbm_qa/be_fl/notebooks/output_csv_selected_v02"
-    start = time.time()
+    if mean_profile_folder is None:
+        mean_profile_folder = out_tif_folder_base + "/crop_mean_ndvi"
     chip_folder = str(parcel_id) + '_' + crop
     ndvi_folder = out_tif_folder_base + "/ndvi"
     ndvi_csv_file = ndvi_folder + "/" + chip_folder + "_ndvi.csv"
-    mean_ndvi_csv_file = mean_profile_folder + "/" + crop  # + ".csv"
     output_graph_folder = out_tif_folder_base + "/ndvi_graphs_with_mean"
-
-    if not os.path.exists(output_graph_folder):
-        os.makedirs(output_graph_folder)
     ndvi_profile = pd.read_csv(ndvi_csv_file)
 
-    ndvi_profile['acq_date'] = pd.to_datetime(ndvi_profile.acq_date)
-    ndvi_profile = ndvi_profile.sort_values(by=['acq_date'])
-    # rename the column names from 'ndvi_mean' to more meaningful name
-    ndvi_profile = ndvi_profile.rename(columns={'ndvi_mean': 'S2 NDVI'})
-    ndvi_profile = ndvi_profile.rename(columns={'acq_date': 'date'})
+    return plot_ndvi_profile_with_mean_profile_of_the_crop(
+        ndvi_profile, parcel_id, crop, plot_title,
+        output_graph_folder + '/parcel_id_' + str(parcel_id) + '_NDVI.jpg',
+        mean_profile_folder, add_error_bars=add_error_bars)
 
-    mean_ndvi_csv_file_exists = False
-    if os.path.isfile(mean_ndvi_csv_file):
-        mean_ndvi_csv_file_exists = True
-        mean_ndvi_profile = pd.read_csv(mean_ndvi_csv_file)
-        mean_ndvi_profile['acq_date'] = pd.to_datetime(
-            mean_ndvi_profile.acq_date)
-        mean_ndvi_profile = mean_ndvi_profile.sort_values(by=['acq_date'])
-        # rename the column names from 'ndvi_mean' to more meaningful name
-        mean_ndvi_profile = mean_ndvi_profile.rename(
-            columns={'ndvi_mean': 'S2 NDVI mean'})
-        mean_ndvi_profile = mean_ndvi_profile.rename(
-            columns={'acq_date': 'date'})
+
+def plot_ndvi_profile_with_mean_profile_of_the_crop(ndvi_profile, parcel_id, crop, plot_title, output_file,
+                                                    mean_profile_folder, add_error_bars=False, incremental=True):
+    """
+    this function plots an already loaded NDVI profile with the crop mean profile and saves
+    the figure to output_file
+    with incremental, the drawing is skipped if output_file was drawn from the same data; the prepared
+    profile is returned either way
+    """
+    start = time.time()
+    # crop mean profile, loaded once per process
+    mean_ndvi_profile = get_crop_profile(crop, mean_profile_folder)
+    mean_ndvi_csv_file_exists = mean_ndvi_profile is not None
+
+    render_hash = render_cache_utils.get_render_hash(
+        ndvi_profile, RENDERER_VERSION, "with_mean", parcel_id, crop, plot_title, add_error_bars,
+        mean_ndvi_profile)
+    ndvi_profile = prepare_ndvi_profile(ndvi_profile)
 
     # check if there are real NDVI values and stdev values in the dataframe
     # (for very small parcels the values in the csv can be None which evaluates as object in
@@ -221,6 +327,11 @@ def display_ndvi_profiles_with_mean_profile_of_the_crop(parcel_id, crop, plot_ti
     if not ndvi_profile['S2 NDVI'].dtypes == "float64" or \
             not ndvi_profile['ndvi_std'].dtypes == "float64":
         return
+    if incremental and isinstance(output_file, str) and render_cache_utils.is_render_current(output_file, render_hash):
+        # Not drawn again, the prepared profile is still returned
+        render_cache_utils.count_render(reused=True)
+        return ndvi_profile
+    _make_output_folder(output_file)
 
     # plot the time series
     ax0 = pyplot.gca()
@@ -284,10 +395,12 @@ def display_ndvi_profiles_with_mean_profile_of_the_crop(parcel_id, crop, plot_ti
                  color='blue', fontsize=13)
 
     # save the figure to a jpg file
-    fig.savefig(output_graph_folder + '/parcel_id_' +
-                str(parcel_id) + '_NDVI.jpg')
+    fig.savefig(output_file, format=None if isinstance(output_file, str) else 'png')
     pyplot.close(fig)
-    logging.info((datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S") + "\t" + parcel_id +
+    if isinstance(output_file, str):
+        render_cache_utils.store_render_hash(output_file, render_hash)
+    render_cache_utils.count_render(reused=False)
+    logging.info((datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S") + "\t" + str(parcel_id) +
                  "\tgraph_utils.display_ndvi_profiles_with_mean_profile_of_the_crop:\t" + "{0:.3f}".format(time.time() - start)))
     return ndvi_profile
 
@@ -296,39 +409,40 @@ def display_ndvi_profiles_with_mean_profile_of_the_crop_with_std(parcel_id, crop
                                                                  mean_profile_folder, add_error_bars=False,
                                                                  mean_color='blue', current_color='red'):
     """
-    this function plots the NDVI profile and saves the figures to the outputFolder
+    this function reads the NDVI profile csv, plots it and saves the figures to the outputFolder
     """
-
-    start = time.time()
     chip_folder = str(parcel_id)
     ndvi_folder = out_tif_folder_base + "/ndvi"
     ndvi_csv_file = ndvi_folder + "/" + chip_folder + "_ndvi.csv"
-
-    mean_ndvi_csv_file = mean_profile_folder + "/" + crop + ".csv"
     output_graph_folder = out_tif_folder_base + "/ndvi_graphs_with_mean"
-
-    if not os.path.exists(output_graph_folder):
-        os.makedirs(output_graph_folder)
     ndvi_profile = pd.read_csv(ndvi_csv_file)
 
-    ndvi_profile['acq_date'] = pd.to_datetime(ndvi_profile.acq_date)
-    ndvi_profile = ndvi_profile.sort_values(by=['acq_date'])
-    # rename the column names from 'ndvi_mean' to more meaningful name
-    ndvi_profile = ndvi_profile.rename(columns={'ndvi_mean': 'S2 NDVI'})
-    ndvi_profile = ndvi_profile.rename(columns={'acq_date': 'date'})
+    return plot_ndvi_profile_with_mean_profile_of_the_crop_with_std(
+        ndvi_profile, parcel_id, crop, plot_title,
+        output_graph_folder + '/parcel_id_' + str(parcel_id) + '_NDVI.jpg',
+        mean_profile_folder, add_error_bars=add_error_bars,
+        mean_color=mean_color, current_color=current_color)
 
-    mean_ndvi_csv_file_exists = False
-    if os.path.isfile(mean_ndvi_csv_file):
-        mean_ndvi_csv_file_exists = True
-        mean_ndvi_profile = pd.read_csv(mean_ndvi_csv_file)
-        mean_ndvi_profile['acq_date'] = pd.to_datetime(
-            mean_ndvi_profile.acq_date)
-        mean_ndvi_profile = mean_ndvi_profile.sort_values(by=['acq_date'])
-        # rename the column names from 'ndvi_mean' to more meaningful name
-        mean_ndvi_profile = mean_ndvi_profile.rename(
-            columns={'ndvi_mean': 'S2 NDVI mean'})
-        mean_ndvi_profile = mean_ndvi_profile.rename(
-            columns={'acq_date': 'date'})
+
+def plot_ndvi_profile_with_mean_profile_of_the_crop_with_std(ndvi_profile, parcel_id, crop, plot_title, output_file,
+                                                             mean_profile_folder, add_error_bars=False,
+                                                             mean_color='blue', current_color='red',
+                                                             incremental=True):
+    """
+    this function plots an already loaded NDVI profile with the crop mean profile and its std band
+    and saves the figure to output_file
+    with incremental, the drawing is skipped if output_file was drawn from the same data; the prepared
+    profile is returned either way
+    """
+    start = time.time()
+    # crop mean profile, loaded once per process
+    mean_ndvi_profile = get_crop_profile(crop, mean_profile_folder)
+    mean_ndvi_csv_file_exists = mean_ndvi_profile is not None
+
+    render_hash = render_cache_utils.get_render_hash(
+        ndvi_profile, RENDERER_VERSION, "with_std", parcel_id, crop, plot_title, add_error_bars,
+        mean_color, current_color, mean_ndvi_profile)
+    ndvi_profile = prepare_ndvi_profile(ndvi_profile)
 
     # check if there are real NDVI values and stdev values in the dataframe
     # (for very small parcels the values in the csv can be None which evaluates as object in
@@ -336,6 +450,11 @@ def display_ndvi_profiles_with_mean_profile_of_the_crop_with_std(parcel_id, crop
     if not ndvi_profile['S2 NDVI'].dtypes == "float64" or \
             not ndvi_profile['ndvi_std'].dtypes == "float64":
         return
+    if incremental and isinstance(output_file, str) and render_cache_utils.is_render_current(output_file, render_hash):
+        # Not drawn again, the prepared profile is still returned
+        render_cache_utils.count_render(reused=True)
+        return ndvi_profile
+    _make_output_folder(output_file)
 
     # plot the time series
     ax0 = pyplot.gca()
@@ -354,10 +473,8 @@ def display_ndvi_profiles_with_mean_profile_of_the_crop_with_std(parcel_id, crop
                                    color=mean_color, ax=ax0, label="crop's mean NDVI")
 
             pyplot.fill_between(mean_ndvi_profile['date'],
-                                mean_ndvi_profile['S2 NDVI mean'] -
-                                mean_ndvi_profile['ndvi_stdev'],
-                                mean_ndvi_profile['S2 NDVI mean'] +
-                                mean_ndvi_profile['ndvi_stdev'],
+                                mean_ndvi_profile['band_low'],
+                                mean_ndvi_profile['band_high'],
                                 alpha=0.2, color=mean_color)
 
     # format the graph a little bit
@@ -408,10 +525,205 @@ def display_ndvi_profiles_with_mean_profile_of_the_crop_with_std(parcel_id, crop
                  color='blue', fontsize=13)
 
     # save the figure to a jpg file
-    fig.savefig(output_graph_folder + '/parcel_id_' +
-                str(parcel_id) + '_NDVI.jpg')
+    fig.savefig(output_file, format=None if isinstance(output_file, str) else 'png')
     pyplot.close(fig)
-    logging.info((datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S") + "\t" + parcel_id +
+    if isinstance(output_file, str):
+        render_cache_utils.store_render_hash(output_file, render_hash)
+    render_cache_utils.count_render(reused=False)
+    logging.info((datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S") + "\t" + str(parcel_id) +
                  "\tgraph_utils.display_ndvi_profiles_with_mean_profile_of_the_crop:\t" + "{0:.3f}".format(time.time() - start)))
 
     return ndvi_profile
+
+
+def plot_crop_ndvi_profiles(crop, ndvi_profiles, plot_title, output_folder, mean_profile_folder,
+                            add_error_bars=False, mean_color='blue', current_color='red',
+                            output='jpg', sheet_columns=4, sheet_rows=4, sheet_scale=4, incremental=True):
+    """
+    this function plots every parcel of one crop over the crop mean profile and its std band.
+    The figure with the crop mean, the axes and the month labels is drawn once and its canvas is
+    cached; for each parcel only its own series and title are drawn over it (blitting).
+    ndvi_profiles is an iterable of (parcel_id, ndvi_profile) pairs.
+    output can be 'jpg' (one image per parcel, as the with_std plots), 'pdf' (one multi-page pdf
+    per crop) or 'sheet' (contact sheets of sheet_columns x sheet_rows thumbnails per crop)
+    with incremental, jpg images drawn from the same data are kept
+    returns the number of plotted parcels, drawn or with a current image; empty profiles are skipped
+    """
+    start = time.time()
+    if not os.path.exists(output_folder):
+        os.makedirs(output_folder)
+    mean_ndvi_profile = get_crop_profile(crop, mean_profile_folder)
+    # Read the profiles lazily, the first one fixes the x range if there is no crop mean
+    ndvi_profiles = iter(ndvi_profiles)
+    first = next(ndvi_profiles, None)
+    if first is None:
+        return 0
+    first = (first[0], prepare_ndvi_profile(first[1]))
+    if mean_ndvi_profile is not None:
+        dates = mean_ndvi_profile['date']
+    else:
+        dates = first[1]['date']
+
+    fig, ax0 = _crop_background(crop, mean_ndvi_profile, min(dates).date(), max(dates).date(),
+                                mean_color, current_color)
+    blit = output != 'pdf'
+    line, = ax0.plot([], [], marker='+', color=current_color, animated=blit)
+    bars = LineCollection([], colors='grey', animated=blit)
+    ax0.add_collection(bars)
+    ax0.title.set_animated(blit)
+
+    if blit:
+        fig.canvas.draw()
+        background = fig.canvas.copy_from_bbox(fig.bbox)
+    else:
+        pdf = PdfPages(output_folder + '/' + str(crop) + '_NDVI.pdf')
+
+    sheet = []
+    sheet_number = 0
+    n_plotted = 0
+    # The first profile is already prepared
+    is_first = True
+    for parcel_id, ndvi_profile in _chain_first(first, ndvi_profiles):
+        if not is_first:
+            ndvi_profile = prepare_ndvi_profile(ndvi_profile)
+        is_first = False
+        if ndvi_profile.empty or not ndvi_profile['S2 NDVI'].dtypes == "float64" or \
+                not ndvi_profile['ndvi_std'].dtypes == "float64":
+            continue
+        if output == 'jpg':
+            output_file = output_folder + '/parcel_id_' + str(parcel_id) + '_NDVI.jpg'
+            render_hash = render_cache_utils.get_render_hash(
+                None, RENDERER_VERSION, "crop_batch", parcel_id, crop, plot_title, add_error_bars,
+                mean_color, current_color, ndvi_profile[['date', 'S2 NDVI', 'ndvi_std']], mean_ndvi_profile)
+            if incremental and render_cache_utils.is_render_current(output_file, render_hash):
+                render_cache_utils.count_render(reused=True)
+                n_plotted += 1
+                continue
+        x = mdates.date2num(ndvi_profile['date'])
+        y = ndvi_profile['S2 NDVI'].values
+        line.set_data(x, y)
+        if add_error_bars:
+            err = ndvi_profile['ndvi_std'].values
+            bars.set_segments(np.stack([np.column_stack([x, y - err]), np.column_stack([x, y + err])], axis=1))
+        ax0.set_title(plot_title + ", Id: " + str(parcel_id) + ", " + crop)
+
+        if blit:
+            fig.canvas.restore_region(background)
+            if add_error_bars:
+                ax0.draw_artist(bars)
+            ax0.draw_artist(line)
+            ax0.draw_artist(ax0.title)
+            image = np.asarray(fig.canvas.buffer_rgba())[..., :3]
+            if output == 'sheet':
+                sheet.append(_downscale(image, sheet_scale))
+                if len(sheet) == sheet_columns * sheet_rows:
+                    _save_sheet(sheet, sheet_columns, output_folder + '/' + str(crop) +
+                                '_sheet_' + str(sheet_number) + '.jpg')
+                    sheet, sheet_number = [], sheet_number + 1
+            else:
+                mimage.imsave(output_file, image)
+                render_cache_utils.store_render_hash(output_file, render_hash)
+                render_cache_utils.count_render(reused=False)
+        else:
+            pdf.savefig(fig)
+        n_plotted += 1
+
+    if sheet:
+        _save_sheet(sheet, sheet_columns, output_folder + '/' + str(crop) + '_sheet_' + str(sheet_number) + '.jpg')
+    if not blit:
+        pdf.close()
+    pyplot.close(fig)
+    logging.info((datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S") + "\t" + str(crop) +
+                  "\tgraph_utils.plot_crop_ndvi_profiles:\t" + str(n_plotted) + "\t" +
+                  "{0:.3f}".format(time.time() - start)))
+    return n_plotted
+
+
+def plot_ndvi_profiles_by_crop(df, id_column, crop_column, base_dir, plot_title, mean_profile_folder,
+                               add_error_bars=False, output='jpg'):
+    """
+    this function groups the parcels of df by crop and plots each group with plot_crop_ndvi_profiles,
+    reading the ndvi/<id>_ndvi.csv files as it goes
+    """
+    output_folder = base_dir + "/ndvi_graphs_with_mean"
+    for crop, df_crop in df.groupby(crop_column):
+        profiles = ((_id, pd.read_csv(base_dir + "/ndvi/" + str(_id) + "_ndvi.csv"))
+                    for _id in df_crop[id_column]
+                    if os.path.isfile(base_dir + "/ndvi/" + str(_id) + "_ndvi.csv"))
+        plot_crop_ndvi_profiles(str(crop), profiles, plot_title, output_folder, mean_profile_folder,
+                                add_error_bars=add_error_bars, output=output)
+
+
+def _make_output_folder(output_file):
+    # output_file may also be a file-like object, rendered to PNG and without a stored hash
+    if isinstance(output_file, str):
+        output_graph_folder = os.path.dirname(output_file)
+        if output_graph_folder and not os.path.exists(output_graph_folder):
+            # Render processes may create it at the same time
+            os.makedirs(output_graph_folder, exist_ok=True)
+
+
+def _crop_background(crop, mean_ndvi_profile, min_date, max_date, mean_color, current_color):
+    """
+    draws the static part of the crop plots: crop mean, std band, legend, axes and month labels
+    """
+    fig = pyplot.figure(figsize=(13, 7))
+    ax0 = fig.add_subplot(1, 1, 1)
+    handles = [ax0.plot([], [], marker='+', color=current_color, label="NDVI polygon")[0]]
+    if mean_ndvi_profile is not None:
+        handles.append(ax0.plot(mean_ndvi_profile['date'], mean_ndvi_profile['S2 NDVI mean'],
+                                color=mean_color, label="crop's mean NDVI")[0])
+        if 'band_low' in mean_ndvi_profile:
+            ax0.fill_between(mean_ndvi_profile['date'], mean_ndvi_profile['band_low'],
+                             mean_ndvi_profile['band_high'], alpha=0.2, color=mean_color)
+    ax0.legend(handles=handles)
+    ax0.set_ylabel('NDVI')
+    ax0.set_xlabel('date')
+    ax0.set_ylim([0, 1])
+    ax0.xaxis.set_major_locator(mdates.MonthLocator(interval=1))
+    ax0.xaxis.set_major_formatter(mdates.DateFormatter('%Y-%m-%d'))
+    ax0.xaxis.grid()  # horizontal lines
+    ax0.yaxis.grid()  # vertical lines
+    fig.autofmt_xdate()  # Rotation
+
+    number_of_months = diff_month(max_date, min_date) + 1
+    ax0.set_xlim([datetime.date(min_date.year, min_date.month, 1),
+                  datetime.date(max_date.year, max_date.month,
+                                calendar.monthrange(max_date.year, max_date.month)[1])])
+    min_year_month = str(min_date.year) + ('0' + str(min_date.month))[-2:]
+    step_x = 1/number_of_months
+    start_x = step_x/2
+    current_year_month_text = get_current_list_of_months(min_year_month, number_of_months)
+    for current_year_month_index in range(0, number_of_months):
+        loc_x = start_x + current_year_month_index * step_x
+        ax0.text(loc_x, 0.915, current_year_month_text[current_year_month_index], verticalalignment='bottom',
+                 horizontalalignment='center', transform=ax0.transAxes, color='blue', fontsize=13)
+    return fig, ax0
+
+
+def _chain_first(first, rest):
+    yield first
+    for item in rest:
+        yield item
+
+
+def _downscale(image, scale):
+    """
+    shrinks an image by an integer factor averaging scale x scale pixel blocks
+    """
+    height, width = image.shape[0] // scale * scale, image.shape[1] // scale * scale
+    blocks = image[:height, :width].reshape(height // scale, scale, width // scale, scale, -1)
+    return blocks.mean(axis=(1, 3)).astype(np.uint8)
+
+
+def _save_sheet(images, columns, output_file):
+    """
+    tiles equally sized thumbnails into one contact sheet image
+    """
+    height, width = images[0].shape[:2]
+    rows = (len(images) + columns - 1) // columns
+    sheet = np.full((rows * height, columns * width, 3), 255, dtype=np.uint8)
+    for i, image in enumerate(images):
+        r, c = divmod(i, columns)
+        sheet[r * height:(r + 1) * height, c * width:(c + 1) * width] = image
+    mimage.imsave(output_file, sheet)
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Hedged requests: when a request is slower than a percentile of the recent latencies, a duplicate is sent
+# and the first good answer wins. Duplicates are capped to a share of the requests sent.
+
+import time
+import bisect
+import threading
+import collections
+import concurrent.futures
+import metrics_utils
+
+# Latency percentile after which a duplicate is sent
+PERCENTILE = 95
+# Duplicates allowed per request sent, the extra load
+MAX_EXTRA_RATIO = 0.05
+# Recent latencies kept, and latencies needed before hedging
+WINDOW = 500
+MIN_SAMPLES = 20
+# Shortest deadline (seconds), so fast answers do not trigger duplicates
+MIN_DEADLINE = 0.05
+# Requests in flight at once, duplicates included
+MAX_WORKERS = 128
+
+
+class LatencyWindow:
+    """ Latencies of the last `size` answers, sorted for the percentiles
+    """
+
+    def __init__(self, size=WINDOW):
+        self.size = size
+        self._recent = collections.deque()
+        self._sorted = []
+        self._lock = threading.Lock()
+
+    def add(self, seconds):
+        with self._lock:
+            self._recent.append(seconds)
+            bisect.insort(self._sorted, seconds)
+            if len(self._recent) > self.size:
+                del self._sorted[bisect.bisect_left(self._sorted, self._recent.popleft())]
+
+    def __len__(self):
+        return len(self._recent)
+
+    def percentile(self, q):
+        """ Latency below which q % of the recent answers came, None without answers
+        """
+        with self._lock:
+            if not self._sorted:
+                return None
+            return self._sorted[min(len(self._sorted) - 1, int(len(self._sorted) * q / 100))]
+
+
+class Hedger:
+    """ Runs requests with a duplicate sent when the first one is late.
+
+    The deadline is the `percentile` of the recent latencies; duplicates stay below `max_extra_ratio`
+    of the requests sent. The loser's answer is dropped, requests cannot be cancelled once sent.
+    """
+
+    def __init__(self, percentile=PERCENTILE, max_extra_ratio=MAX_EXTRA_RATIO, window=WINDOW,
+                 min_samples=MIN_SAMPLES, min_deadline=MIN_DEADLINE, max_workers=MAX_WORKERS):
+        self.percentile = percentile
+        self.max_extra_ratio = max_extra_ratio
+        self.min_samples = min_samples
+        self.min_deadline = min_deadline
+        self.latencies = LatencyWindow(window)
+        self.requests = 0
+        self.hedges = 0
+        self._lock = threading.Lock()
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers, thread_name_prefix="hedge")
+
+    def deadline(self):
+        """ Seconds after which a request is duplicated, None while there are too few latencies
+        """
+        if len(self.latencies) < self.min_samples:
+            return None
+        return max(self.min_deadline, self.latencies.percentile(self.percentile))
+
+    def _may_hedge(self):
+        with self._lock:
+            if self.hedges + 1 > self.max_extra_ratio * self.requests:
+                return False
+            self.hedges += 1
+            return True
+
+    def _timed(self, function, is_ok):
+        start = time.perf_counter()
+        result = function()
+        if is_ok(result):
+            self.latencies.add(time.perf_counter() - start)
+        return result
+
+    def call(self, function, is_ok=lambda result: True):
+        """ Run function(), and a second function() if the first is later than the deadline
+        Args:
+            function: request without arguments, run in the threads of the hedger
+            is_ok: function telling if a result is a good answer; bad answers let the other request win
+
+        Returns:
+            result: first good result, else the result (or exception) of the first request
+        """
+        with self._lock:
+            self.requests += 1
+        deadline = self.deadline()
+        primary = self._executor.submit(self._timed, function, is_ok)
+        if deadline is None:
+            return primary.result()
+        try:
+            # Answer or error of the first request within the deadline
+            return primary.result(timeout=deadline)
+        except concurrent.futures.TimeoutError:
+            pass
+        if not self._may_hedge():
+            metrics_utils.inc("hedged_requests_total", result="capped")
+            return primary.result()
+        hedge = self._executor.submit(self._timed, function, is_ok)
+        pending = {primary, hedge}
+        while pending:
+            done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None and is_ok(future.result()):
+                    metrics_utils.inc("hedged_requests_total", result="hedge" if future is hedge else "primary")
+                    return future.result()
+        # Neither was good: the answer of the first request, for its retries and errors
+        metrics_utils.inc("hedged_requests_total", result="failed")
+        return primary.result()
@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Logging through a queue: every process puts its records on a queue and one listener process writes them.
+
+import os
+import time
+import json
+import queue
+import atexit
+import logging
+import threading
+import multiprocessing
+import multiprocessing.util
+
+LOG_FORMAT = "%(asctime)s\t%(processName)s\t%(levelname)s\t%(message)s"
+# Records written at once, and longest wait before writing a partial batch (seconds)
+BATCH_SIZE = 500
+FLUSH_INTERVAL = 1.0
+# Records sent at once by each process, and longest wait before sending a partial batch (seconds)
+SEND_SIZE = 200
+SEND_INTERVAL = 0.5
+# Record attributes copied into the json lines when present
+EXTRA_FIELDS = ("parcel_id", "crop", "stage", "request", "error")
+
+_listener = None
+
+
+class BatchQueueHandler(logging.Handler):
+    """ Sends the records to the listener in batches of plain dicts, which is much cheaper than
+    one pickled LogRecord per put. Errors and the end of the process send the pending batch at once,
+    a daemon thread sends a partial batch after send_interval when no new record comes.
+    """
+
+    def __init__(self, log_queue, send_size=SEND_SIZE, send_interval=SEND_INTERVAL):
+        super().__init__()
+        self.log_queue = log_queue
+        self.send_size = send_size
+        self.send_interval = send_interval
+        self._batch = []
+        self._sent = time.monotonic()
+        self._flusher = None
+        self._flusher_pid = None
+        self._stopped = threading.Event()
+
+    def _start_flusher(self):
+        # One thread per process: a handler copied by fork has no thread
+        if self._flusher_pid != os.getpid():
+            self._flusher_pid = os.getpid()
+            self._flusher = threading.Thread(target=self._flush_loop, name="log_flusher", daemon=True)
+            self._flusher.start()
+
+    def _flush_loop(self):
+        while not self._stopped.wait(self.send_interval):
+            if self._batch and time.monotonic() - self._sent >= self.send_interval:
+                self.flush()
+
+    def emit(self, record):
+        try:
+            entry = {"created": record.created, "msecs": record.msecs, "levelname": record.levelname,
+                     "levelno": record.levelno, "name": record.name, "processName": record.processName,
+                     "process": record.process, "msg": record.getMessage()}
+            for field in EXTRA_FIELDS:
+                if hasattr(record, field):
+                    entry[field] = getattr(record, field)
+            if record.exc_info:
+                entry["exc_text"] = logging.Formatter().formatException(record.exc_info)
+            self.acquire()
+            try:
+                self._start_flusher()
+                self._batch.append(entry)
+                if len(self._batch) >= self.send_size or record.levelno >= logging.ERROR \
+                        or time.monotonic() - self._sent > self.send_interval:
+                    self._send()
+            finally:
+                self.release()
+        except Exception:
+            self.handleError(record)
+
+    def flush(self):
+        self.acquire()
+        try:
+            self._send()
+        finally:
+            self.release()
+
+    def close(self):
+        self._stopped.set()
+        self.flush()
+        super().close()
+
+    def _send(self):
+        if self._batch and self.log_queue is not None:
+            self.log_queue.put(self._batch)
+            self._batch = []
+        self._sent = time.monotonic()
+
+
+class JsonFormatter(logging.Formatter):
+    """ One json object per record: time, level, process, message and the EXTRA_FIELDS it has
+    """
+
+    def format(self, record):
+        entry = {"time": self.formatTime(record), "level": record.levelname,
+                 "process": record.processName, "pid": record.process, "message": record.getMessage()}
+        for field in EXTRA_FIELDS:
+            if hasattr(record, field):
+                entry[field] = getattr(record, field)
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+def _listen(log_queue, log_file, json_format, batch_size, flush_interval):
+    formatter = JsonFormatter() if json_format else logging.Formatter(LOG_FORMAT)
+    with open(log_file, "a") as f:
+        running = True
+        while running:
+            lines = []
+            try:
+                entries = log_queue.get(timeout=flush_interval)
+                while True:
+                    if entries is None:
+                        running = False
+                        break
+                    lines.extend(formatter.format(logging.makeLogRecord(entry)) for entry in entries)
+                    if len(lines) >= batch_size:
+                        break
+                    entries = log_queue.get_nowait()
+            except queue.Empty:
+                pass
+            if lines:
+                f.write("\n".join(lines) + "\n")
+                f.flush()
+
+
+def start_logging(log_file="ndvi_processes.log", level=logging.INFO, json_format=False,
+                  batch_size=BATCH_SIZE, flush_interval=FLUSH_INTERVAL):
+    """ Start the listener process writing log_file and send the records of this process to it
+    Args:
+        log_file: (str) log file, appended to
+        level: (int) logging level
+        json_format: (bool) write json lines instead of tab separated text
+        batch_size: (int) records written at once
+        flush_interval: (float) seconds before a partial batch is written
+
+    Returns:
+        log_queue: queue to give to configure_worker in the worker processes
+    """
+    global _listener
+    log_queue = multiprocessing.Queue(-1)
+    process = multiprocessing.Process(target=_listen, name="log_listener", daemon=True,
+                                      args=(log_queue, log_file, json_format, batch_size, flush_interval))
+    process.start()
+    _listener = (log_queue, process)
+    configure_worker(log_queue, level)
+    return log_queue
+
+
+def get_queue():
+    """ Queue of the running listener, None when start_logging was not called
+    """
+    return _listener[0] if _listener is not None else None
+
+
+def configure_worker(log_queue, level=logging.INFO):
+    """ Send the records of this process to the listener; logging a record does not wait for the file
+    """
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    handler = BatchQueueHandler(log_queue)
+    root.addHandler(handler)
+    root.setLevel(level)
+    # Send the last batch at exit: atexit in the main process, Finalize in multiprocessing workers
+    atexit.register(handler.flush)
+    multiprocessing.util.Finalize(handler, handler.flush, exitpriority=10)
+
+
+def stop_logging(timeout=30):
+    """ Write the pending records and stop the listener process
+    """
+    global _listener
+    if _listener is None:
+        return
+    log_queue, process = _listener
+    _listener = None
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        if isinstance(handler, BatchQueueHandler):
+            handler.close()
+            handler.log_queue = None
+            root.removeHandler(handler)
+    log_queue.put(None)
+    process.join(timeout)
+    log_queue.close()
+
+
+def log_parcel_error(parcel_id, error, stage=None, crop=None):
+    """ Error record of one parcel, with its id, stage and error as separate fields in json logs
+    """
+    logging.error('Polygon number {} failed: {}'.format(parcel_id, error),
+                  extra={"parcel_id": str(parcel_id), "stage": stage, "crop": crop, "error": repr(error)})
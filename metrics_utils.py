@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Per-stage counters and latency histograms, merged across worker processes and exported for Prometheus and as JSON.
+
+import os
+import json
+import time
+import glob
+import threading
+import contextlib
+
+# Upper bounds in seconds of the latency histogram buckets
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, float("inf"))
+PREFIX = "ndvi_"
+SNAPSHOT_PREFIX = "metrics-"
+
+_worker = "main"
+# {(name, labels): value} and {(name, labels): {"buckets": [...], "sum", "count", "max"}}
+_counters = {}
+_histograms = {}
+# Fetch threads record into the same metrics
+_lock = threading.Lock()
+# Context manager factories entered around every stage (profile_utils), empty by default
+_stage_hooks = []
+
+
+def set_worker(worker):
+    """ Name of this process in the worker label, "main" by default
+    """
+    global _worker
+    _worker = str(worker)
+
+
+def reset():
+    """ Forget the metrics recorded so far in this process (new worker)
+    """
+    _counters.clear()
+    _histograms.clear()
+
+
+def _key(name, labels):
+    labels = dict(labels)
+    labels.setdefault("worker", _worker)
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def inc(name, value=1, **labels):
+    """ Add value to a counter
+    """
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def observe(name, value, **labels):
+    """ Record one value, in seconds, into a histogram
+    """
+    key = _key(name, labels)
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = {"buckets": [0] * len(BUCKETS), "sum": 0.0, "count": 0, "max": 0.0}
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                histogram["buckets"][i] += 1
+                break
+        histogram["sum"] += value
+        histogram["count"] += 1
+        histogram["max"] = max(histogram["max"], value)
+
+
+@contextlib.contextmanager
+def stage(name, items=1):
+    """ Time a pipeline stage: stage_seconds histogram, stage_items_total and stage_errors_total counters
+    Args:
+        name: (str) stage name: request_build, download, parse, write, render...
+        items: (int) number of parcels handled by this call
+    """
+    with _hooks(name) if _stage_hooks else contextlib.nullcontext():
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            inc("stage_errors_total", stage=name)
+            raise
+        finally:
+            add_stage(name, time.perf_counter() - start, items)
+
+
+def add_stage(name, seconds, items=1):
+    """ Record a stage timed by the caller, when it is not one block of code (waits between yields)
+    """
+    observe("stage_seconds", seconds, stage=name)
+    inc("stage_items_total", items, stage=name)
+
+
+@contextlib.contextmanager
+def _hooks(name):
+    with contextlib.ExitStack() as stack:
+        for hook in list(_stage_hooks):
+            stack.enter_context(hook(name))
+        yield
+
+
+def snapshot():
+    """ Metrics of this process as a json serializable dict
+    """
+    return {"counters": [[name, list(labels), value] for (name, labels), value in _counters.items()],
+            "histograms": [[name, list(labels), histogram] for (name, labels), histogram in _histograms.items()]}
+
+
+def dump(metrics_dir):
+    """ Write the metrics of this process into metrics_dir, one file per process
+    """
+    if not os.path.exists(metrics_dir):
+        os.makedirs(metrics_dir, exist_ok=True)
+    filename = os.path.join(metrics_dir, "{}{}.json".format(SNAPSHOT_PREFIX, os.getpid()))
+    with open(filename + ".tmp", "w") as f:
+        json.dump(snapshot(), f)
+    os.replace(filename + ".tmp", filename)
+
+
+def clear(metrics_dir):
+    """ Remove the snapshots of a previous run from metrics_dir
+    """
+    for filename in glob.glob(os.path.join(metrics_dir, SNAPSHOT_PREFIX + "*.json")):
+        os.remove(filename)
+
+
+def merge(snapshots):
+    """ Sum several snapshots: counters are added and histograms bucket by bucket
+    Args:
+        snapshots: (iterable) snapshot dicts
+
+    Returns:
+        merged: snapshot dict
+    """
+    counters, histograms = {}, {}
+    for current in snapshots:
+        for name, labels, value in current["counters"]:
+            key = (name, tuple(tuple(label) for label in labels))
+            counters[key] = counters.get(key, 0) + value
+        for name, labels, histogram in current["histograms"]:
+            key = (name, tuple(tuple(label) for label in labels))
+            total = histograms.setdefault(key, {"buckets": [0] * len(BUCKETS), "sum": 0.0, "count": 0, "max": 0.0})
+            total["buckets"] = [a + b for a, b in zip(total["buckets"], histogram["buckets"])]
+            total["sum"] += histogram["sum"]
+            total["count"] += histogram["count"]
+            total["max"] = max(total["max"], histogram["max"])
+    return {"counters": [[name, list(labels), value] for (name, labels), value in counters.items()],
+            "histograms": [[name, list(labels), histogram] for (name, labels), histogram in histograms.items()]}
+
+
+def collect(metrics_dir, include_current=True):
+    """ Merge the snapshots dumped into metrics_dir, and those of this process
+    """
+    snapshots = []
+    for filename in sorted(glob.glob(os.path.join(metrics_dir, SNAPSHOT_PREFIX + "*.json"))):
+        if include_current and filename.endswith("{}{}.json".format(SNAPSHOT_PREFIX, os.getpid())):
+            continue
+        with open(filename) as f:
+            snapshots.append(json.load(f))
+    if include_current:
+        snapshots.append(snapshot())
+    return merge(snapshots)
+
+
+def _labels_text(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in pairs) + "}"
+
+
+def to_prometheus(metrics):
+    """ Prometheus text exposition format of a snapshot
+    """
+    lines = []
+    for name in sorted({name for name, _, _ in metrics["counters"]}):
+        lines.append("# TYPE {}{} counter".format(PREFIX, name))
+        for _name, labels, value in metrics["counters"]:
+            if _name == name:
+                lines.append("{}{}{} {}".format(PREFIX, name, _labels_text(labels), value))
+    for name in sorted({name for name, _, _ in metrics["histograms"]}):
+        lines.append("# TYPE {}{} histogram".format(PREFIX, name))
+        for _name, labels, histogram in metrics["histograms"]:
+            if _name != name:
+                continue
+            cumulative = 0
+            for bound, count in zip(BUCKETS, histogram["buckets"]):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append("{}{}_bucket{} {}".format(PREFIX, name, _labels_text(labels, [("le", le)]), cumulative))
+            lines.append("{}{}_sum{} {}".format(PREFIX, name, _labels_text(labels), histogram["sum"]))
+            lines.append("{}{}_count{} {}".format(PREFIX, name, _labels_text(labels), histogram["count"]))
+    return "\n".join(lines) + "\n"
+
+
+def _quantile(histogram, q):
+    # Upper bound of the bucket holding the quantile
+    target = q * histogram["count"]
+    cumulative = 0
+    for bound, count in zip(BUCKETS, histogram["buckets"]):
+        cumulative += count
+        if cumulative >= target and count:
+            return min(bound, histogram["max"])
+    return histogram["max"]
+
+
+def summary(metrics):
+    """ Readable summary of a snapshot: per stage (all workers and per worker) and cache hit rates
+    """
+    stages = {}
+    for name, labels, histogram in metrics["histograms"]:
+        if name != "stage_seconds":
+            continue
+        labels = dict(labels)
+        for scope in ("all", labels.get("worker")):
+            entry = stages.setdefault(labels["stage"], {}).setdefault(
+                scope, {"buckets": [0] * len(BUCKETS), "sum": 0.0, "count": 0, "max": 0.0})
+            entry["buckets"] = [a + b for a, b in zip(entry["buckets"], histogram["buckets"])]
+            entry["sum"] += histogram["sum"]
+            entry["count"] += histogram["count"]
+            entry["max"] = max(entry["max"], histogram["max"])
+    stages = {stage: {scope: {"calls": h["count"], "seconds": h["sum"],
+                              "mean": h["sum"] / h["count"] if h["count"] else 0.0,
+                              "p50": _quantile(h, 0.5), "p99": _quantile(h, 0.99), "max": h["max"]}
+                      for scope, h in scopes.items()}
+              for stage, scopes in stages.items()}
+    counters = {}
+    for name, labels, value in metrics["counters"]:
+        key = name + _labels_text([label for label in labels if label[0] != "worker"])
+        counters[key] = counters.get(key, 0) + value
+    caches = {}
+    for name, labels, value in metrics["counters"]:
+        if name == "cache_requests_total":
+            labels = dict(labels)
+            caches.setdefault(labels["cache"], {"hit": 0, "miss": 0})[labels["result"]] += value
+    for cache in caches.values():
+        total = cache["hit"] + cache["miss"]
+        cache["hit_rate"] = cache["hit"] / total if total else 0.0
+    return {"stages": stages, "counters": counters, "caches": caches}
+
+
+def export(metrics_dir, prometheus_file=None, json_file=None):
+    """ Merge the snapshots of every process and write the Prometheus textfile and the JSON summary
+    Args:
+        metrics_dir: (str) directory of the process snapshots
+        prometheus_file: (str) .prom file, metrics_dir/ndvi.prom by default
+        json_file: (str) summary file, metrics_dir/summary.json by default
+
+    Returns:
+        summary: (dict) summary of the merged metrics
+    """
+    metrics = collect(metrics_dir)
+    if not os.path.exists(metrics_dir):
+        os.makedirs(metrics_dir, exist_ok=True)
+    prometheus_file = prometheus_file or os.path.join(metrics_dir, "ndvi.prom")
+    json_file = json_file or os.path.join(metrics_dir, "summary.json")
+    # Written aside and renamed, so the node exporter never reads a partial file
+    with open(prometheus_file + ".tmp", "w") as f:
+        f.write(to_prometheus(metrics))
+    os.replace(prometheus_file + ".tmp", prometheus_file)
+    metrics_summary = summary(metrics)
+    with open(json_file, "w") as f:
+        json.dump(metrics_summary, f, indent=2)
+    return metrics_summary
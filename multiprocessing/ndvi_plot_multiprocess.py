@@ -2,37 +2,40 @@
 Created on Oct 08 18:42:49 2021
 
 Script to plot ndvi time series for a set of poligons within a geodataframe.
-Uses multiprocessing and the Sentinel Hub Statistical API
+Uses concurrent requests and render processes (the "hybrid" executor of executor_utils)
+and the Sentinel Hub Statistical API
 
 @autor: Xavi Pascuet
 """
 
 import os
+import sys
 import logging
-import geopandas as gpd
-from sentinelhub import SHConfig
-import matplotlib
-matplotlib.interactive(False)
-
-geodf = gpd.read_file("dun2021.geojson")
+# The pipeline is shared with the serial version at the repository root
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import log_utils
+import pipeline_utils
 
+layer_file = "dun2021.geojson"
 id_column = "id"
 crop_column = "PRODUCTE"
 request_size = 200  # Number of polygons of each request
-n_processes = 3  # Number of processes to split the tasks into
+executor = "hybrid"  # threads for the requests and warm processes for the plots
+fetch_workers = None  # Concurrent requests, None to size them from the last run's metrics
+render_workers = None  # Render processes, None for one per CPU but one
 plot_title = "NDVI 2021"
-
-
-config = SHConfig()
-
-logging.basicConfig(filename="ndvi_processes.log", level=logging.INFO)  # DEBUG
-
-cdir = os.getcwd()
-
-dest_dir = os.path.join(cdir, r'ndvi')
-if not os.path.exists(dest_dir):
-    os.mkdir(dest_dir)
-
-
-sentinel_api_utils.plot_ndvi_multiprocess(
-    geodf, id_column, crop_column, dest_dir, cdir, plot_title, n_processes, request_size)
+# python ndvi_plot_multiprocess.py --profile: cProfile, tracemalloc and stack samples per stage and worker
+profile = "--profile" in sys.argv
+
+
+if __name__ == "__main__":
+    # Workers send their records through a queue to one writer process; --json-logs for json lines
+    log_utils.start_logging("ndvi_processes.log", logging.INFO, json_format="--json-logs" in sys.argv)  # DEBUG
+    # geopandas is only needed here, to read the parcel layer
+    import geopandas as gpd
+    geodf = gpd.read_file(layer_file)
+    cdir = os.getcwd()
+    pipeline_utils.run_pipeline(cdir, geodf[id_column], geodf[crop_column], geodf, year=2021,
+                                batch_size=request_size, plot_title=plot_title, profile=profile,
+                                executor=executor, fetch_workers=fetch_workers, render_workers=render_workers)
+    log_utils.stop_logging()
@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Command line entry point: fetch, replay, aggregate and plot subcommands.
+#
+# Only the standard library is imported here; geopandas, sentinelhub, matplotlib and pandas are imported
+# by the subcommands that use them, so `--help` and small re-plots start at once.
+#
+# Usage: python ndvi_cli.py fetch --layer dun2021.geojson
+#        python ndvi_cli.py estimate --max-pu-day 5000 --crop-priority "BLAT TOU" ORDI
+#        python ndvi_cli.py --base-dir /shared/run node --shards 64    (on every node)
+#        python ndvi_cli.py replay
+#        python ndvi_cli.py aggregate
+#        python ndvi_cli.py plot --crop "BLAT TOU" --output sheet
+
+import os
+import logging
+import argparse
+
+RENDERERS = ("matplotlib", "thumbnail", "none")
+EXECUTORS = ("serial", "thread", "process", "hybrid")
+PLOT_OUTPUTS = ("jpg", "pdf", "sheet", "thumbnail")
+SMOOTHING_METHODS = ("polynomial", "savgol", "whittaker", "harmonic")
+
+
+def _read_layer(args):
+    # geopandas only for the subcommands reading the parcel layer
+    import geopandas as gpd
+    geodf = gpd.read_file(args.layer)
+    return geodf, [str(_id) for _id in geodf[args.id_column]], [str(crop) for crop in geodf[args.crop_column]]
+
+
+def _get_parcels(args):
+    """ Parcel ids and crops from the cube of a previous run, or from the layer
+    """
+    import cube_utils
+    cube_dir = os.path.join(args.base_dir, r'ndvi_cube')
+    if os.path.isfile(os.path.join(cube_dir, cube_utils.META_FILE)):
+        cube = cube_utils.open_cube(cube_dir)
+        return list(cube.parcel_id), list(cube.crop)
+    if args.layer is None:
+        raise SystemExit("No ndvi_cube in {}, give the parcel layer with --layer".format(args.base_dir))
+    _, parcel_ids, crops = _read_layer(args)
+    return parcel_ids, crops
+
+
+def _get_priorities(args, geodf):
+    import quota_utils
+    if args.priority_column is None and not args.crop_priority:
+        return None
+    return quota_utils.get_priorities(geodf, args.priority_column, args.crop_column, args.crop_priority)
+
+
+def fetch(args):
+    import pipeline_utils
+    geodf, parcel_ids, crops = _read_layer(args)
+    return pipeline_utils.run_pipeline(args.base_dir, parcel_ids, crops, geodf, year=args.year,
+                                       batch_size=args.batch_size, plot_title=args.title,
+                                       renderer=args.renderer, source="api", profile=args.profile,
+                                       executor=args.executor, fetch_workers=args.fetch_workers,
+                                       render_workers=args.render_workers, hedge=args.hedge,
+                                       request_timeout=args.request_timeout, max_pu_per_hour=args.max_pu_hour,
+                                       max_pu_per_day=args.max_pu_day, priorities=_get_priorities(args, geodf),
+                                       pu_calibration=args.pu_calibration)
+
+
+def estimate(args):
+    import pipeline_utils
+    geodf, parcel_ids, crops = _read_layer(args)
+    # Dry run: estimate and plan, nothing is requested
+    selected, costs = pipeline_utils.plan_requests(args.base_dir, parcel_ids, crops, geodf, args.batch_size,
+                                                   args.max_pu_hour, args.max_pu_day, _get_priorities(args, geodf),
+                                                   args.pu_calibration, write=False)
+    import numpy as np
+    import pandas as pd
+    import quota_utils
+    df = pd.DataFrame({"id": parcel_ids, "crop": crops, "pu": costs,
+                       "selected": np.isin(np.arange(len(parcel_ids)), selected)})
+    if args.output:
+        df.to_csv(args.output, index=False)
+    # The log goes to the log file, the estimate is for the console too
+    print("{:.1f} PU for {} parcels ({:.2f} per parcel, up to {:.1f} per batch of {})".format(
+        costs.sum(), len(costs), costs.mean() if len(costs) else 0.0,
+        quota_utils.get_batch_costs(costs, args.batch_size).max(initial=0), args.batch_size))
+    print(df.groupby("crop")["pu"].agg(["count", "sum"]).sort_values("sum", ascending=False).to_string())
+    print("Requested now: {} parcels, {:.1f} PU".format(len(selected), costs[selected].sum()))
+    return costs[selected].sum()
+
+
+def node(args):
+    import shard_utils
+    geodf, parcel_ids, crops = _read_layer(args)
+    return shard_utils.run_node(args.base_dir, parcel_ids, crops, geodf, args.shards, node=args.node,
+                                tile_size=args.tile_size, lease_seconds=args.lease, poll_seconds=args.poll,
+                                merge=not args.no_merge, year=args.year, batch_size=args.batch_size,
+                                plot_title=args.title, renderer=args.renderer, source="api", profile=args.profile,
+                                executor=args.executor, fetch_workers=args.fetch_workers,
+                                render_workers=args.render_workers)
+
+
+def merge(args):
+    import shard_utils
+    _, parcel_ids, crops = _read_layer(args)
+    return shard_utils.merge_shards(args.base_dir, parcel_ids, crops, args.year)
+
+
+def replay(args):
+    import pipeline_utils
+    parcel_ids, crops = _get_parcels(args)
+    return pipeline_utils.run_pipeline(args.base_dir, parcel_ids, crops, year=args.year, plot_title=args.title,
+                                       renderer=args.renderer, source="archive", profile=args.profile,
+                                       executor=args.executor, render_workers=args.render_workers)
+
+
+def aggregate(args):
+    import pandas as pd
+    import ndvi_utils
+    parcel_ids, crops = _get_parcels(args)
+    df = pd.DataFrame({"id": parcel_ids, "crop": crops})
+    # Parcels whose request failed have no csv file
+    df = df[[os.path.isfile(os.path.join(args.base_dir, r'ndvi', _id + "_ndvi.csv")) for _id in df["id"]]]
+    crop_profiles = ndvi_utils.get_crop_mean_ndvi(df, "id", "crop", args.base_dir, smoothing=args.smoothing)
+    logging.info("Crop mean profiles of {} parcels: {}".format(len(df), ", ".join(sorted(crop_profiles))))
+    return crop_profiles
+
+
+def plot(args):
+    import cube_utils
+    cube = cube_utils.open_cube(os.path.join(args.base_dir, r'ndvi_cube'))
+    crop_by_id = dict(zip(cube.parcel_id, cube.crop))
+    if args.ids:
+        parcel_ids = [str(_id) for _id in args.ids]
+        unknown = [_id for _id in parcel_ids if _id not in crop_by_id]
+        if unknown:
+            logging.warning("Parcels not in the cube, not plotted: {}".format(", ".join(unknown)))
+        parcel_ids = [_id for _id in parcel_ids if _id in crop_by_id]
+    else:
+        parcel_ids = [_id for _id, crop in crop_by_id.items() if args.crop is None or crop in args.crop]
+    if args.output == "thumbnail":
+        # Pillow only, matplotlib is not imported
+        import thumbnail_utils
+        for parcel_id in parcel_ids:
+            thumbnail_utils.render_ndvi_thumbnail(
+                cube.profile(parcel_id), args.base_dir + "/ndvi_thumbnails/" + parcel_id + "_NDVI.png")
+        return len(parcel_ids)
+    import matplotlib
+    matplotlib.use("Agg")
+    import graph_utils
+    n_plotted = 0
+    for crop in sorted({crop_by_id[_id] for _id in parcel_ids}):
+        profiles = ((_id, cube.profile(_id)) for _id in parcel_ids if crop_by_id[_id] == crop)
+        n_plotted += graph_utils.plot_crop_ndvi_profiles(
+            crop, profiles, args.title, args.base_dir + "/ndvi_graphs_with_mean",
+            args.base_dir + "/crop_mean_ndvi", add_error_bars=True, output=args.output)
+    return n_plotted
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description="NDVI time series of parcels from the Sentinel Hub Statistical API")
+    parser.add_argument("--base-dir", default=os.getcwd(), help="folder of the results (default: current folder)")
+    parser.add_argument("--log-file", default="ndvi_processes.log")
+    parser.add_argument("--json-logs", action="store_true", help="write the log as JSON lines")
+    parser.add_argument("--debug", action="store_true")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    layer = argparse.ArgumentParser(add_help=False)
+    layer.add_argument("--layer", help="parcel layer (GeoJSON, shapefile...)")
+    layer.add_argument("--id-column", default="id")
+    layer.add_argument("--crop-column", default="PRODUCTE")
+    run = argparse.ArgumentParser(add_help=False)
+    run.add_argument("--year", type=int, default=2021)
+    run.add_argument("--title", default="NDVI 2021", help="plot title")
+    run.add_argument("--renderer", choices=RENDERERS, default="matplotlib")
+    run.add_argument("--profile", action="store_true", help="cProfile, tracemalloc and stack samples per stage")
+    run.add_argument("--executor", choices=EXECUTORS, default="hybrid",
+                     help="threads for the requests, processes for the plots, both (hybrid) or none (serial)")
+    run.add_argument("--fetch-workers", type=int, help="concurrent requests (default: from the last run's metrics)")
+    run.add_argument("--render-workers", type=int, help="render processes (default: one per CPU but one)")
+
+    quota = argparse.ArgumentParser(add_help=False)
+    quota.add_argument("--batch-size", type=int, default=100, help="polygons per request")
+    quota.add_argument("--max-pu-hour", type=float, help="processing units allowed per hour, the rest is deferred")
+    quota.add_argument("--max-pu-day", type=float, help="processing units allowed per 24 hours")
+    quota.add_argument("--priority-column", help="numeric layer column, higher parcels first within the caps")
+    quota.add_argument("--crop-priority", nargs="+", help="crops first within the caps, in this order")
+    quota.add_argument("--pu-calibration", type=float, default=1.0,
+                       help="billed / estimated processing units, from the dashboard")
+
+    command = subparsers.add_parser("fetch", parents=[layer, run, quota], help="request, store and plot the parcels")
+    command.add_argument("--hedge", type=float, metavar="PERCENTILE",
+                         help="send a request again when slower than this percentile of the recent ones (e.g. 95)")
+    command.add_argument("--request-timeout", type=float, help="seconds before a request is abandoned")
+    command.set_defaults(function=fetch, layer="dun2021.geojson")
+    command = subparsers.add_parser("estimate", parents=[layer, quota],
+                                    help="dry run: processing units per parcel, batch and crop, and the parcels within the caps")
+    command.add_argument("--output", help="csv of the estimate per parcel")
+    command.set_defaults(function=estimate, layer="dun2021.geojson")
+    command = subparsers.add_parser("node", parents=[layer, run],
+                                    help="run shards claimed from the coordinator in base-dir, with other nodes")
+    command.add_argument("--shards", type=int, default=16, help="number of shards, the same on every node")
+    command.add_argument("--node", help="node name (default: host and process id)")
+    command.add_argument("--tile-size", type=float, help="spatial shards of tiles of this size in degrees "
+                                                         "(default: shards by hash of the parcel id)")
+    command.add_argument("--lease", type=float, default=300, help="seconds before the shard of a silent node is retaken")
+    command.add_argument("--poll", type=float, default=10, help="seconds between claims while other nodes finish")
+    command.add_argument("--no-merge", action="store_true", help="do not merge the shards at the end")
+    command.add_argument("--batch-size", type=int, default=100, help="polygons per request")
+    command.set_defaults(function=node, layer="dun2021.geojson")
+    command = subparsers.add_parser("merge", parents=[layer], help="merge the shards of a multi-node run")
+    command.add_argument("--year", type=int, default=2021)
+    command.set_defaults(function=merge, layer="dun2021.geojson")
+    command = subparsers.add_parser("replay", parents=[layer, run],
+                                    help="rerun the pipeline from the archived responses, without the network")
+    command.set_defaults(function=replay)
+    command = subparsers.add_parser("aggregate", parents=[layer], help="crop mean profiles from the csv files")
+    command.add_argument("--smoothing", choices=SMOOTHING_METHODS, default="polynomial")
+    command.set_defaults(function=aggregate)
+    command = subparsers.add_parser("plot", help="plot parcels from the NDVI cube")
+    command.add_argument("--ids", nargs="+", help="parcel ids (default: every parcel)")
+    command.add_argument("--crop", nargs="+", help="plot only these crops")
+    command.add_argument("--output", choices=PLOT_OUTPUTS, default="jpg",
+                         help="jpg per parcel, pdf or contact sheet per crop, or review thumbnails")
+    command.add_argument("--title", default="NDVI 2021", help="plot title")
+    command.set_defaults(function=plot)
+    return parser
+
+
+def main(argv=None):
+    args = get_parser().parse_args(argv)
+    import log_utils
+    # Records of every process go through a queue to one writer
+    log_utils.start_logging(args.log_file, logging.DEBUG if args.debug else logging.INFO, json_format=args.json_logs)
+    try:
+        return args.function(args)
+    finally:
+        log_utils.stop_logging()
+
+
+if __name__ == "__main__":
+    main()
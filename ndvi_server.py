@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Local HTTP service rendering NDVI plots on demand from the stored series.
+#
+#   /parcel/<id>/ndvi.json   parcel profile
+#   /parcel/<id>/plot.png    parcel plot, rendered on first request
+#   /crop/<crop>/mean.json   crop mean profile
+#
+# Usage: python ndvi_server.py [base_dir] [port]
+
+import os
+import io
+import sys
+import json
+import logging
+import threading
+from collections import OrderedDict
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import unquote
+import pandas as pd
+import matplotlib
+matplotlib.use("Agg")
+import graph_utils
+import cube_utils
+import render_cache_utils
+
+# Rendered images kept in memory
+CACHE_MAX_BYTES = 256 * 1024 * 1024
+CACHE_MAX_ITEMS = 10000
+
+
+class RenderCache:
+    """ LRU cache of rendered images bounded by total size and item count
+    """
+
+    def __init__(self, max_bytes=CACHE_MAX_BYTES, max_items=CACHE_MAX_ITEMS):
+        self.max_bytes = max_bytes
+        self.max_items = max_items
+        self.n_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return item
+
+    def put(self, key, etag, content):
+        with self._lock:
+            if key in self._items:
+                self.n_bytes -= len(self._items.pop(key)[1])
+            self._items[key] = (etag, content)
+            self.n_bytes += len(content)
+            while self._items and (self.n_bytes > self.max_bytes or len(self._items) > self.max_items):
+                _, (_, evicted) = self._items.popitem(last=False)
+                self.n_bytes -= len(evicted)
+
+
+class NdviStore:
+    """ Access to the stored series: the NDVI cube if there is one, else the ndvi/<id>_ndvi.csv files
+    """
+
+    def __init__(self, base_dir):
+        self.base_dir = base_dir
+        self.mean_profile_folder = base_dir + "/crop_mean_ndvi"
+        cube_dir = base_dir + "/ndvi_cube"
+        self.cube = cube_utils.open_cube(cube_dir) if os.path.isfile(cube_dir + "/" + cube_utils.META_FILE) else None
+
+    def get_profile(self, parcel_id):
+        """ Parcel profile (acq_date, ndvi_mean, ndvi_std) or None if it is unknown
+        """
+        if self.cube is not None:
+            try:
+                return self.cube.profile(parcel_id)
+            except KeyError:
+                pass
+        filename = self.base_dir + "/ndvi/" + str(parcel_id) + "_ndvi.csv"
+        if os.path.isfile(filename):
+            return pd.read_csv(filename)
+        return None
+
+    def get_crop(self, parcel_id):
+        if self.cube is not None:
+            try:
+                return str(self.cube.crop[self.cube.row(parcel_id)])
+            except KeyError:
+                pass
+        return ""
+
+
+def profile_to_json(ndvi_profile):
+    """ Profile as a dict of lists, dates in ISO format
+    """
+    columns = [c for c in ("ndvi_mean", "ndvi_std", "ndvi_stdev") if c in ndvi_profile]
+    return {
+        "acq_date": [d.strftime("%Y-%m-%d") for d in pd.to_datetime(ndvi_profile["acq_date"])],
+        **{c: [None if pd.isna(v) else float(v) for v in ndvi_profile[c]] for c in columns},
+    }
+
+
+def render_plot_png(ndvi_profile, parcel_id, crop, plot_title, mean_profile_folder):
+    """ Render a parcel plot into PNG bytes, with the crop mean if there is one; empty bytes when the
+    profile has nothing to plot
+    """
+    buffer = io.BytesIO()
+    if crop and graph_utils.get_crop_profile(crop, mean_profile_folder) is not None:
+        graph_utils.plot_ndvi_profile_with_mean_profile_of_the_crop_with_std(
+            ndvi_profile, parcel_id, crop, plot_title, buffer, mean_profile_folder, add_error_bars=True)
+    else:
+        graph_utils.plot_ndvi_profile(ndvi_profile, parcel_id, crop, plot_title, buffer, add_error_bars=True)
+    return buffer.getvalue()
+
+
+def is_safe_name(name):
+    """ True if a parcel id or crop taken from the url can be used in a file name, without leaving its folder
+    """
+    return bool(name) and "/" not in name and "\\" not in name and ".." not in name and "\0" not in name
+
+
+def make_handler(store, cache, plot_title, render_lock):
+
+    class NdviHandler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            parts = [unquote(p) for p in self.path.split("?")[0].strip("/").split("/")]
+            try:
+                if len(parts) == 3 and not is_safe_name(parts[1]):
+                    # An id or crop like ..%2F..%2Fx would read files outside base_dir
+                    self.send_error(400)
+                elif len(parts) == 3 and parts[0] == "parcel" and parts[2] == "ndvi.json":
+                    self._parcel_json(parts[1])
+                elif len(parts) == 3 and parts[0] == "parcel" and parts[2] == "plot.png":
+                    self._parcel_plot(parts[1])
+                elif len(parts) == 3 and parts[0] == "crop" and parts[2] == "mean.json":
+                    self._crop_json(parts[1])
+                else:
+                    self.send_error(404)
+            except Exception as e:
+                logging.error('Request {} failed: {}'.format(self.path, e))
+                self.send_error(500)
+
+        def _parcel_json(self, parcel_id):
+            ndvi_profile = store.get_profile(parcel_id)
+            if ndvi_profile is None:
+                return self.send_error(404)
+            etag = render_cache_utils.get_render_hash(ndvi_profile, "json")
+            self._send(json.dumps(profile_to_json(ndvi_profile)).encode(), "application/json", etag)
+
+        def _crop_json(self, crop):
+            mean_ndvi_profile = graph_utils.get_crop_profile(crop, store.mean_profile_folder)
+            if mean_ndvi_profile is None:
+                return self.send_error(404)
+            mean_ndvi_profile = mean_ndvi_profile.rename(columns={'date': 'acq_date', 'S2 NDVI mean': 'ndvi_mean'})
+            etag = render_cache_utils.get_render_hash(mean_ndvi_profile, "json")
+            self._send(json.dumps(profile_to_json(mean_ndvi_profile)).encode(), "application/json", etag)
+
+        def _parcel_plot(self, parcel_id):
+            ndvi_profile = store.get_profile(parcel_id)
+            if ndvi_profile is None:
+                return self.send_error(404)
+            crop = store.get_crop(parcel_id)
+            if not is_safe_name(crop):
+                # No crop mean for a crop name that is not a plain file name
+                crop = ""
+            mean_ndvi_profile = graph_utils.get_crop_profile(crop, store.mean_profile_folder) if crop else None
+            etag = render_cache_utils.get_render_hash(
+                ndvi_profile, graph_utils.RENDERER_VERSION, "png", parcel_id, crop, plot_title, mean_ndvi_profile)
+            if self.headers.get("If-None-Match") == '"' + etag + '"':
+                return self._not_modified(etag)
+            cached = cache.get(etag)
+            if cached is None:
+                # pyplot is not thread safe
+                with render_lock:
+                    content = render_plot_png(ndvi_profile, parcel_id, crop, plot_title, store.mean_profile_folder)
+                if not content:
+                    # Nothing was drawn: not an image, and not cached
+                    return self.send_error(422, "No NDVI values to plot")
+                cache.put(etag, etag, content)
+            else:
+                content = cached[1]
+            self._send(content, "image/png", etag)
+
+        def _send(self, content, content_type, etag):
+            if self.headers.get("If-None-Match") == '"' + etag + '"':
+                return self._not_modified(etag)
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(content)))
+            self.send_header("ETag", '"' + etag + '"')
+            self.end_headers()
+            self.wfile.write(content)
+
+        def _not_modified(self, etag):
+            self.send_response(304)
+            self.send_header("ETag", '"' + etag + '"')
+            self.end_headers()
+
+        def log_message(self, format, *args):
+            logging.info("ndvi_server\t" + format % args)
+
+    return NdviHandler
+
+
+def serve(base_dir, port=8000, plot_title="NDVI 2021", max_bytes=CACHE_MAX_BYTES):
+    """ Start the service over the results stored in base_dir
+    Args:
+        base_dir: (str) base directory of a run (ndvi, ndvi_cube and crop_mean_ndvi folders)
+        port: (int) listening port
+        plot_title: (str) Plot title
+        max_bytes: (int) size limit of the rendered images cache
+
+    Returns:
+        None
+    """
+    store = NdviStore(base_dir)
+    cache = RenderCache(max_bytes=max_bytes)
+    server = ThreadingHTTPServer(("127.0.0.1", port), make_handler(store, cache, plot_title, threading.Lock()))
+    logging.info("ndvi_server listening on port {}".format(port))
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(filename="ndvi_processes.log", level=logging.INFO)
+    serve(sys.argv[1] if len(sys.argv) > 1 else os.getcwd(),
+          int(sys.argv[2]) if len(sys.argv) > 2 else 8000)
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Parsing of the Statistical API responses and crop mean profiles. Nothing here imports sentinelhub,
+# so archive replays, aggregation and parsing workers start without it.
+
+import os
+import datetime
+import pandas as pd
+import smoothing_utils
+
+
+def _parse_date(value):
+    # Interval bounds are ISO 8601 timestamps ("2021-01-01T00:00:00Z"), only the date is kept
+    return datetime.date.fromisoformat(value[:10])
+
+
+def stats_to_df(stats_data):
+    """ Transform Statistical API response into a pandas.DataFrame
+    """
+    df_data = []
+
+    for single_data in stats_data['data']:
+        df_entry = {}
+        is_valid_entry = True
+
+        df_entry['interval_from'] = _parse_date(single_data['interval']['from'])
+        df_entry['interval_to'] = _parse_date(single_data['interval']['to'])
+
+        for output_name, output_data in single_data['outputs'].items():
+            for band_name, band_values in output_data['bands'].items():
+
+                band_stats = band_values['stats']
+                if band_stats['sampleCount'] == band_stats['noDataCount']:
+                    is_valid_entry = False
+                    break
+
+                for stat_name, value in band_stats.items():
+                    col_name = f'{output_name}_{band_name}_{stat_name}'
+                    if stat_name == 'percentiles':
+                        for perc, perc_val in value.items():
+                            perc_col_name = f'{col_name}_{perc}'
+                            df_entry[perc_col_name] = perc_val
+                    else:
+                        df_entry[col_name] = value
+
+        if is_valid_entry:
+            df_data.append(df_entry)
+
+    return pd.DataFrame(df_data)
+
+
+def response_to_ndvi_df(stats_data):
+    """ Parse a Statistical API response into an ndvi profile (acq_date, ndvi_mean, ndvi_std)
+    """
+    ndvi_df = stats_to_df(stats_data)
+    # Rename columns acording to Cbm script
+    ndvi_df.rename(columns={'interval_from': 'acq_date', 'ndvi_B0_mean': 'ndvi_mean',
+                            'ndvi_B0_stDev': 'ndvi_std'}, inplace=True)
+    return ndvi_df
+
+
+def get_crop_mean_ndvi(df, id_column, crop_column, base_dir, smoothing="polynomial"):
+    """ Get mean ndvi for crop and export into csv files
+    Args:
+        df: Pandas Dataframe
+        id_column: (int) Polygon identifier
+        crop_column: (str) Polygon crop name
+        base_dir: (str) base directory
+        smoothing: (str) smoothing_utils method applied to the mean and std series
+
+    Returns:
+        crop_profiles: (dict) crop mean Dataframe by crop, ready for graph_utils.set_crop_profiles
+    """
+    dest_dir = base_dir + "/crop_mean_ndvi"
+    if not os.path.exists(dest_dir):
+        os.mkdir(dest_dir)
+
+    crop_profiles = {}
+    for product in df[crop_column].unique():
+        # Get dataframe for product
+        df_product = df[df[crop_column] == product]
+        # List of dataframes
+        df_list = []
+        # Iterate all id in product and read csv files
+        for _id in df_product[id_column]:
+            filename = base_dir + "/ndvi/" + str(_id) + "_ndvi.csv"
+            ndvi_profile = pd.read_csv(filename)
+            df_list.append(ndvi_profile)
+        # Get total's dataframe
+        df_total = pd.concat(df_list)
+        # Group by day and calculate means
+        df_total = df_total.groupby(["acq_date"], as_index=False)[
+            ["ndvi_mean", "ndvi_std"]].mean()
+        # Transfor string tate to datetime
+        df_total['acq_date'] = pd.to_datetime(df_total.acq_date)
+        # Smooth mean values (polynomial regression by default)
+        df_total["ndvi_mean"] = smoothing_utils.smooth_series(
+            df_total['acq_date'], df_total['ndvi_mean'], method=smoothing)
+        # Smooth standard deviation
+        df_total["ndvi_std"] = smoothing_utils.smooth_series(
+            df_total['acq_date'], df_total['ndvi_std'], method=smoothing)
+        # Rename columns
+        df_total.rename(columns={'ndvi_std': 'ndvi_stdev'}, inplace=True)
+        # Export
+        df_total.to_csv((dest_dir + "/" + product + ".csv"), index=False)
+        crop_profiles[product] = df_total
+
+    return crop_profiles
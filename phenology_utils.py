@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Season metrics (start, peak, end, integrated NDVI) for many NDVI series at once.
+
+import numpy as np
+import pandas as pd
+import cube_utils
+import smoothing_utils
+
+# Share of the amplitude marking the start and end of the season
+SEASON_THRESHOLD = 0.5
+
+
+def profiles_to_matrix(profiles, year, column="pol_regr", date_column="date", step=cube_utils.GRID_STEP):
+    """ Put profiles already computed by the plotting or crop mean functions onto the regular grid.
+
+    Use column="pol_regr" for the Dataframes returned by display_ndvi_profiles and
+    column="ndvi_mean", date_column="acq_date" for the get_crop_mean_ndvi csv files.
+
+    Args:
+        profiles: (iterable) Pandas Dataframes
+        year: (int) profiles year
+        column: (str) values column
+        date_column: (str) dates column
+        step: (int) grid spacing in days
+
+    Returns:
+        grid: (numpy.ndarray) grid day indexes
+        values: (numpy.ndarray) values on the grid, one row per profile
+    """
+    profiles = list(profiles)
+    daily = np.full((len(profiles), cube_utils.CUBE_DAYS), np.nan)
+    for i, profile in enumerate(profiles):
+        if profile is None or profile.empty:
+            continue
+        dates = pd.to_datetime(profile[date_column]).values.astype("datetime64[D]")
+        days = (dates - np.datetime64("{}-01-01".format(year))).astype(np.int64)
+        in_year = (days >= 0) & (days < cube_utils.CUBE_DAYS)
+        daily[i, days[in_year]] = profile[column].values[in_year]
+    grid = cube_utils.regular_grid(step=step)
+    return grid, cube_utils.interpolate_rows(daily, ~np.isnan(daily), grid)
+
+
+def get_season_metrics(values, days, parcel_ids=None, threshold=SEASON_THRESHOLD):
+    """ Start, peak and end of season of every row of a smoothed NDVI matrix.
+
+    Start (end) of season is the day the curve crosses 'threshold' of the amplitude between the
+    minimum before (after) the peak and the peak, linearly interpolated between grid days.
+
+    Args:
+        values: (numpy.ndarray) smoothed NDVI, one series per row
+        days: (numpy.ndarray) day index (day of year - 1) of every column
+        parcel_ids: (iterable) row identifiers
+        threshold: (float) share of the amplitude defining start and end of season
+
+    Returns:
+        metrics: Pandas Dataframe with sos_doy, peak_doy, peak_value, eos_doy, amplitude,
+            season_length and integrated_ndvi (NDVI x days between sos and eos)
+    """
+    values = np.asarray(values, dtype=np.float64)
+    days = np.asarray(days, dtype=np.float64)
+    n_rows, n_cols = values.shape
+    idx = np.arange(n_cols)
+    r = np.arange(n_rows)
+    has_data = ~np.isnan(values).all(axis=1)
+    v = np.where(np.isnan(values), -np.inf, values)
+
+    peak = np.argmax(v, axis=1)
+    peak_value = v[r, peak]
+    before = idx[None, :] <= peak[:, None]
+    after = idx[None, :] >= peak[:, None]
+    finite = np.isfinite(v)
+    left_min = np.where(before & finite, v, np.inf).min(axis=1)
+    right_min = np.where(after & finite, v, np.inf).min(axis=1)
+    sos_level = left_min + threshold * (peak_value - left_min)
+    eos_level = right_min + threshold * (peak_value - right_min)
+
+    # Without a crossing the season starts (ends) with the series
+    first_day = days[np.argmax(finite, axis=1)]
+    last_day = days[n_cols - 1 - np.argmax(finite[:, ::-1], axis=1)]
+    # Last day below the level before the peak, first one after it
+    last_below = np.where(before & finite & (v < sos_level[:, None]), idx, -1).max(axis=1)
+    first_below = np.where(after & finite & (v < eos_level[:, None]), idx, n_cols).min(axis=1)
+    sos = _crossing(values, days, last_below, last_below + 1, sos_level, default=first_day)
+    eos = _crossing(values, days, first_below - 1, first_below, eos_level, default=last_day)
+
+    # Integrated NDVI inside the season
+    dt = np.gradient(days)
+    in_season = (days[None, :] >= sos[:, None]) & (days[None, :] <= eos[:, None])
+    integrated = np.where(in_season & finite, v, 0.0) @ dt
+
+    metrics = pd.DataFrame({
+        "sos_doy": sos + 1,
+        "peak_doy": days[peak] + 1,
+        "peak_value": peak_value,
+        "eos_doy": eos + 1,
+        "amplitude": peak_value - np.minimum(left_min, right_min),
+        "season_length": eos - sos,
+        "integrated_ndvi": integrated,
+    })
+    metrics[~has_data] = np.nan
+    if parcel_ids is not None:
+        metrics.insert(0, "parcel_id", np.asarray(parcel_ids))
+    return metrics
+
+
+def _crossing(values, days, lo, hi, level, default):
+    """ Fractional day at which each row crosses 'level' between columns lo and hi
+    """
+    n_cols = values.shape[1]
+    found = (lo >= 0) & (hi < n_cols)
+    lo_c = np.clip(lo, 0, n_cols - 1)
+    hi_c = np.clip(hi, 0, n_cols - 1)
+    r = np.arange(len(values))
+    v_lo = values[r, lo_c]
+    v_hi = values[r, hi_c]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        frac = np.clip((level - v_lo) / (v_hi - v_lo), 0.0, 1.0)
+    frac = np.where(np.isfinite(frac), frac, 0.0)
+    crossing = days[lo_c] + frac * (days[hi_c] - days[lo_c])
+    return np.where(found, crossing, default)
+
+
+def get_cube_season_metrics(cube, chunk_size=10000, method="polynomial", step=cube_utils.GRID_STEP,
+                            threshold=SEASON_THRESHOLD, **params):
+    """ Season metrics of every parcel of an NdviCube. The default smoothing is the degree-5
+    polynomial trend drawn by the plots
+    Args:
+        cube: NdviCube
+        chunk_size: (int) number of parcels processed at once
+        method: (str) smoothing_utils method
+        step: (int) grid spacing in days
+        threshold: (float) share of the amplitude defining start and end of season
+        params: smoothing method parameters
+
+    Returns:
+        metrics: Pandas Dataframe, one row per parcel
+    """
+    grid = cube_utils.regular_grid(cube.n_days, step)
+    tables = []
+    for rows, mean, _, valid in cube.iter_chunks(chunk_size):
+        if method == "whittaker":
+            # Gap-filled onto the shared grid every row has W = I, so I + lam D'D is factored once
+            filled = cube_utils.interpolate_rows(mean, valid, grid)
+            trend = smoothing_utils.smooth(filled, method=method, **params)
+        else:
+            trend = smoothing_utils.smooth(mean, valid, method=method, x_out=grid, **params)
+        # Only trust the trend inside the observed period
+        observed = valid.any(axis=1)
+        first = np.argmax(valid, axis=1)
+        last = cube.n_days - 1 - np.argmax(valid[:, ::-1], axis=1)
+        inside = (grid[None, :] >= first[:, None]) & (grid[None, :] <= last[:, None]) & observed[:, None]
+        trend[~inside] = np.nan
+        metrics = get_season_metrics(trend, grid, cube.parcel_id[rows], threshold)
+        metrics.insert(1, "crop", cube.crop[rows])
+        tables.append(metrics)
+    return pd.concat(tables, ignore_index=True)
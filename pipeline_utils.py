@@ -0,0 +1,365 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# The fetch/replay -> parse -> csv, cube and index -> plot pipeline shared by ndvi_plot.py and ndvi_cli.py.
+#
+# Heavy modules (sentinelhub, matplotlib, Pillow) are imported by the stage that needs them, so that
+# processes that only parse, store or draw thumbnails do not load the others.
+
+import os
+import json
+import logging
+import concurrent.futures
+import numpy as np
+import pandas as pd
+import ndvi_utils
+import cube_utils
+import similarity_utils
+import render_cache_utils
+import executor_utils
+import quota_utils
+import metrics_utils
+import profile_utils
+import log_utils
+
+RENDERERS = ("matplotlib", "thumbnail", "none")
+SOURCES = ("api", "archive")
+# Batches waiting to be rendered, per render process, before the pipeline waits for them
+RENDER_BACKLOG = 2
+
+# Renderer of a render process, set by _init_render_worker
+_worker_render = None
+
+
+def get_renderer(renderer, base_dir, plot_title):
+    """ Function drawing one parcel: render(parcel_id, crop, ndvi_df)
+    Args:
+        renderer: (str) "matplotlib" plots, "thumbnail" images or "none"
+        base_dir: (str) base directory, plots go to ndvi_graphs or ndvi_thumbnails
+        plot_title: (str) Plot title
+
+    Returns:
+        render: function, None for "none"
+    """
+    if renderer not in RENDERERS:
+        raise ValueError("Unknown renderer {}, use one of {}".format(renderer, RENDERERS))
+    if renderer == "thumbnail":
+        import thumbnail_utils
+
+        def render(parcel_id, crop, ndvi_df):
+            thumbnail_utils.render_ndvi_thumbnail(
+                ndvi_df, base_dir + "/ndvi_thumbnails/" + str(parcel_id) + "_NDVI.png")
+        return render
+    if renderer == "matplotlib":
+        executor_utils.warm_matplotlib()
+        import graph_utils
+
+        def render(parcel_id, crop, ndvi_df):
+            graph_utils.plot_ndvi_profile(ndvi_df, parcel_id, crop, plot_title,
+                                          base_dir + "/ndvi_graphs/" + str(parcel_id) + "_NDVI.jpg",
+                                          add_error_bars=True)
+        return render
+    return None
+
+
+def _init_render_worker(renderer, base_dir, plot_title):
+    global _worker_render
+    _worker_render = get_renderer(renderer, base_dir, plot_title)
+
+
+def fetch_batch(geodf, parcel_ids, crops, archive=None, n_request=0, ledger=None, costs=None):
+    """ Request the API for one batch of polygons and parse the responses
+    Args:
+        geodf: GeopandasDataframe of the batch
+        parcel_ids: (list) Polygon identifiers, aligned with geodf rows
+        crops: (dict) crop by parcel id (str)
+        archive: archive_utils.ResponseArchive keeping the raw responses, None to skip it
+        n_request: (int) request number, for the log
+        ledger: quota_utils.QuotaLedger recording the estimated units of the requests sent, None to skip it
+        costs: (dict) estimated processing units by parcel id (str), for the ledger
+
+    Returns:
+        parcel_ids: (list) identifiers of the parsed polygons
+        ndvi_dfs: (list) parsed profiles, aligned with parcel_ids
+    """
+    import sentinel_api_utils
+    logging.info("\tStarting API request number:{}".format(n_request))
+    batch_ids, batch_dfs = [], []
+    sent = {}
+    try:
+        # Every response is parsed as it arrives and its json dropped: memory does not grow with the batch size
+        for parcel_id, rec_stats in sentinel_api_utils.iter_sentinelapi_responses(geodf, archive, parcel_ids, sent):
+            try:
+                # Parse API response into a Dataframe
+                with metrics_utils.stage("parse"):
+                    batch_dfs.append(ndvi_utils.response_to_ndvi_df(rec_stats))
+                batch_ids.append(parcel_id)
+            except Exception as e:
+                log_utils.log_parcel_error(parcel_id, e, stage="parse", crop=crops.get(str(parcel_id)))
+                continue
+    except Exception as e:
+        # The parcels parsed before the failure are kept
+        logging.error('Request number {} failed: {}'.format(n_request, e), extra={"request": n_request, "error": repr(e)})
+    if ledger is not None and sent:
+        # Every request sent may be billed: retries, hedged duplicates and failed requests included. An interval
+        # retry costs one interval of the request
+        n_intervals = quota_utils.count_intervals(sentinel_api_utils.time_interval,
+                                                  sentinel_api_utils.aggregation_interval)
+        ledger.record(sum(costs[str(_id)] * (n_requests + n_interval_requests / n_intervals)
+                          for _id, (n_requests, n_interval_requests) in sent.items()), len(sent))
+    return batch_ids, batch_dfs
+
+
+def fetch_batches(geodf, parcel_ids, crops, batch_size, archive=None, executor=None, max_pending=1, ledger=None,
+                  costs=None):
+    """ Request the API by batches of polygons, max_pending batches at a time
+    Args:
+        geodf: GeopandasDataframe
+        parcel_ids: (list) Polygon identifiers, aligned with geodf rows
+        crops: (dict) crop by parcel id (str)
+        batch_size: (int) number of polygons per request
+        archive: archive_utils.ResponseArchive keeping the raw responses, None to skip it
+        executor: executor_utils fetch executor, serial by default
+        max_pending: (int) requests submitted and not yet returned
+        ledger: quota_utils.QuotaLedger of the processing units spent, None to skip it
+        costs: (dict) estimated processing units by parcel id (str)
+
+    Returns:
+        Generator of (parcel_ids, ndvi_dfs) batches, in completion order
+    """
+    executor = executor or executor_utils.SerialExecutor()
+    pending = set()
+    # Iterate throw n subdataframes with len= batch_size
+    for i in range(int(len(geodf)/batch_size) + (len(geodf) % batch_size > 0)):
+        pending.add(executor.submit(fetch_batch, geodf.iloc[i*batch_size:(i+1)*batch_size],
+                                    parcel_ids[i*batch_size:(i+1)*batch_size], crops, archive, i, ledger, costs))
+        if len(pending) >= max_pending:
+            done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+    for future in concurrent.futures.as_completed(pending):
+        yield future.result()
+
+
+def process_batch(parcel_ids, ndvi_dfs, crops, dest_dir, cube, similarity_index, year):
+    """ Persist the parsed profiles of a batch: csv files, cube and similarity index
+    Args:
+        parcel_ids: (list) Polygon identifiers
+        ndvi_dfs: (list) parsed profiles, aligned with parcel_ids
+        crops: (dict) crop by parcel id (str)
+        dest_dir: (str) destination directory of the csv files
+        cube: cube_utils.NdviCube
+        similarity_index: similarity_utils.SimilarityIndex
+        year: (int) year of the profiles
+
+    Returns:
+        parcel_ids: (list) identifiers of the stored polygons
+        ndvi_dfs: (list) stored profiles, aligned with parcel_ids
+    """
+    batch_ids, batch_dfs = [], []
+    for parcel_id, ndvi_df in zip(parcel_ids, ndvi_dfs):
+        try:
+            # Export csv
+            with metrics_utils.stage("write"):
+                ndvi_df.to_csv(dest_dir + "/" + str(parcel_id) + "_ndvi.csv")
+            batch_ids.append(parcel_id)
+            batch_dfs.append(ndvi_df)
+        except Exception as e:
+            log_utils.log_parcel_error(parcel_id, e, stage="write", crop=crops.get(str(parcel_id)))
+            continue
+    # Store batch profiles into the cube
+    with metrics_utils.stage("store", len(batch_ids)):
+        cube.add_batch(batch_ids, batch_dfs)
+        similarity_index.add_profiles(batch_ids, batch_dfs, year=year)
+    return batch_ids, batch_dfs
+
+
+def render_batch(parcel_ids, crops, ndvi_dfs, render=None):
+    """ Plot the profiles of a batch
+    Args:
+        parcel_ids: (list) Polygon identifiers
+        crops: (list) Polygon crop names, aligned with parcel_ids
+        ndvi_dfs: (list) parsed profiles, aligned with parcel_ids
+        render: get_renderer function, the one of the render process by default
+
+    Returns:
+        n_rendered: (int) number of plotted parcels
+    """
+    render = render or _worker_render
+    n_rendered = 0
+    for parcel_id, crop, ndvi_df in zip(parcel_ids, crops, ndvi_dfs):
+        try:
+            # Plot ndvi time series from the parsed profile
+            with metrics_utils.stage("render"):
+                render(parcel_id, crop, ndvi_df)
+            n_rendered += 1
+        except Exception as e:
+            log_utils.log_parcel_error(parcel_id, e, stage="render", crop=crop)
+    return n_rendered
+
+
+def load_metrics_summary(metrics_dir):
+    """ metrics_utils summary of the previous run in metrics_dir, None if there is none
+    """
+    summary_file = os.path.join(metrics_dir, "summary.json")
+    if not os.path.isfile(summary_file):
+        return None
+    with open(summary_file) as f:
+        return json.load(f)
+
+
+def plan_requests(base_dir, parcel_ids, crops, geodf, batch_size=100, max_pu_per_hour=None, max_pu_per_day=None,
+                  priorities=None, pu_calibration=1.0, write=True):
+    """ Estimate the processing units of the requests and choose the parcels to request within the caps.
+    With a cap, parcels with a csv file from a previous run are skipped and, with write, the ones left over
+    are written to base_dir/quota/deferred.csv, for a later run.
+    Args:
+        base_dir: (str) base directory
+        parcel_ids: (list) Polygon identifiers, aligned with geodf rows
+        crops: (list) Polygon crop names, aligned with parcel_ids
+        geodf: GeopandasDataframe
+        batch_size: (int) number of polygons per API request
+        max_pu_per_hour: (float) processing units allowed in the last hour, no cap by default
+        max_pu_per_day: (float) processing units allowed in the last 24 hours, no cap by default
+        priorities: (array) priority per parcel, higher first; quota_utils.get_priorities
+        pu_calibration: (float) billed / estimated processing units
+        write: (bool) False for a dry run, which writes nothing
+
+    Returns:
+        selected: (numpy.ndarray) indices of the parcels to request, by priority
+        costs: (numpy.ndarray) estimated processing units per parcel
+    """
+    costs = quota_utils.get_request_costs(geodf, pu_calibration)
+    quota_utils.log_estimate(costs, batch_size, crops)
+    if max_pu_per_hour is None and max_pu_per_day is None:
+        return np.arange(len(parcel_ids)), costs
+    quota_dir = os.path.join(base_dir, r'quota')
+    ledger = quota_utils.QuotaLedger(os.path.join(quota_dir, "ledger.csv"))
+    scheduler = quota_utils.QuotaScheduler(ledger, max_pu_per_hour, max_pu_per_day)
+    # Parcels done by a previous run are not requested again
+    todo = np.flatnonzero([not os.path.isfile(os.path.join(base_dir, r'ndvi', str(_id) + "_ndvi.csv"))
+                           for _id in parcel_ids])
+    selected, deferred = scheduler.plan(costs[todo], None if priorities is None else np.asarray(priorities)[todo])
+    selected, deferred = todo[selected], todo[deferred]
+    if write:
+        os.makedirs(quota_dir, exist_ok=True)
+        pd.DataFrame({"id": [parcel_ids[i] for i in deferred], "crop": [crops[i] for i in deferred],
+                      "pu": costs[deferred]}).to_csv(os.path.join(quota_dir, "deferred.csv"), index=False)
+    logging.info("Quota: {:.1f} PU left, {} parcels requested for {:.1f} PU, {} deferred, {} done before".format(
+        scheduler.budget(), len(selected), costs[selected].sum(), len(deferred), len(parcel_ids) - len(todo)))
+    return selected, costs
+
+
+def run_pipeline(base_dir, parcel_ids, crops, geodf=None, year=2021, batch_size=100, plot_title="NDVI 2021",
+                 renderer="matplotlib", source="api", profile=False, executor="serial", fetch_workers=None,
+                 render_workers=None, hedge=None, request_timeout=None, max_pu_per_hour=None, max_pu_per_day=None,
+                 priorities=None, pu_calibration=1.0):
+    """ Get, store and plot the ndvi time series of a collection of polygons
+    Args:
+        base_dir: (str) base directory
+        parcel_ids: (iterable) Polygon identifiers
+        crops: (iterable) Polygon crop names, aligned with parcel_ids
+        geodf: GeopandasDataframe with the polygons of parcel_ids, needed for source "api"
+        year: (int) year of the time series
+        batch_size: (int) number of polygons per API request
+        plot_title: (str) Plot title
+        renderer: (str) "matplotlib", "thumbnail" or "none"
+        source: (str) "api", or "archive" to replay the archived responses without the network
+        profile: (bool) write cProfile, tracemalloc and stack sample reports per stage into base_dir/profile
+        executor: (str) "serial", "thread" (threaded requests), "process" (render processes) or "hybrid" (both)
+        fetch_workers: (int) concurrent requests, sized from the previous run's metrics by default
+        render_workers: (int) render processes, one per CPU but one by default
+        hedge: (float) latency percentile after which a request is sent again, the first answer wins
+        request_timeout: (float) seconds before a request is abandoned, config.download_timeout_seconds by default
+        max_pu_per_hour: (float) processing units allowed in the last hour; the other parcels are deferred
+        max_pu_per_day: (float) processing units allowed in the last 24 hours
+        priorities: (array) priority per parcel, the first requested within the caps
+        pu_calibration: (float) billed / estimated processing units
+
+    Returns:
+        metrics_summary: (dict) per-stage metrics of the run
+    """
+    import archive_utils
+    if source not in SOURCES:
+        raise ValueError("Unknown source {}, use one of {}".format(source, SOURCES))
+    if source == "api" and geodf is None:
+        raise ValueError("The api source needs the polygons geodf")
+    parcel_ids = list(parcel_ids)
+    crops = list(crops)
+    dest_dir = os.path.join(base_dir, r'ndvi')
+    if not os.path.exists(dest_dir):
+        os.mkdir(dest_dir)
+    # Dense parcel x day cube filled as batches arrive
+    cube = cube_utils.create_cube(os.path.join(base_dir, r'ndvi_cube'), parcel_ids, crops, year=year)
+    # Similarity index over the processed curves, updated batch by batch
+    similarity_index = similarity_utils.SimilarityIndex(os.path.join(base_dir, r'ndvi_index'))
+    # Raw API responses, kept for replays
+    archive_dir = os.path.join(base_dir, r'ndvi_archive')
+    crop_by_id = dict(zip(map(str, parcel_ids), crops))
+    # Per-stage metrics, exported at the end of the run; the previous run's size the fetch threads
+    metrics_dir = os.path.join(base_dir, r'metrics')
+    previous_summary = load_metrics_summary(metrics_dir)
+    metrics_utils.clear(metrics_dir)
+    profile_dir = os.path.join(base_dir, r'profile')
+    if profile:
+        profile_utils.enable(profile_dir, sample_interval=0.01)
+
+    if source == "api" and (hedge is not None or request_timeout is not None):
+        import session_utils
+        # Read by the download clients of this process, fetch threads included
+        if hedge is not None:
+            session_utils.hedge_percentile = hedge
+        if request_timeout is not None:
+            session_utils.request_timeout = request_timeout
+    if renderer == "none":
+        # No render processes to start
+        executor = {"process": "serial", "hybrid": "thread"}.get(executor, executor)
+    if source == "archive":
+        # Replays parse with their own processes
+        executor = {"thread": "serial", "hybrid": "process"}.get(executor, executor)
+    auto_fetch, auto_render = executor_utils.get_worker_counts(executor, previous_summary)
+    fetch_workers = fetch_workers or auto_fetch
+    render_workers = render_workers or auto_render
+    fetch_executor, render_executor = executor_utils.create_executors(
+        executor, fetch_workers, render_workers, metrics_dir=metrics_dir,
+        initializer=_init_render_worker, initargs=(renderer, base_dir, plot_title))
+    logging.info("Executor {}: {} fetch workers, {} render processes".format(executor, fetch_workers, render_workers))
+    # Renderer of this process, when not rendering in worker processes
+    render = get_renderer(renderer, base_dir, plot_title) if render_workers == 0 else None
+
+    with fetch_executor, render_executor:
+        if source == "archive":
+            # Parse the archived responses in parallel, one segment per process
+            batches = archive_utils.replay(archive_dir)
+        else:
+            # Parcels within the processing unit caps, by priority
+            selected, costs = plan_requests(base_dir, parcel_ids, crops, geodf, batch_size, max_pu_per_hour,
+                                            max_pu_per_day, priorities, pu_calibration)
+            # Estimated spend of the requests sent, recorded by the fetch workers
+            ledger = quota_utils.QuotaLedger(os.path.join(base_dir, r'quota', "ledger.csv"))
+            batches = fetch_batches(geodf.iloc[selected], [parcel_ids[i] for i in selected], crop_by_id, batch_size,
+                                    archive_utils.ResponseArchive(archive_dir), fetch_executor,
+                                    max_pending=2 * fetch_workers, ledger=ledger,
+                                    costs=dict(zip(map(str, parcel_ids), costs)))
+        rendering = set()
+        for batch_ids, batch_dfs in batches:
+            batch_ids, batch_dfs = process_batch(batch_ids, batch_dfs, crop_by_id, dest_dir, cube, similarity_index, year)
+            if renderer == "none" or not batch_ids:
+                continue
+            rendering.add(render_executor.submit(render_batch, batch_ids, [crop_by_id.get(str(_id), "") for _id in batch_ids],
+                                                 batch_dfs, render))
+            # Bounded backlog, so parsed batches do not pile up in memory
+            if len(rendering) > RENDER_BACKLOG * max(1, render_workers):
+                _, rendering = concurrent.futures.wait(rendering, return_when=concurrent.futures.FIRST_COMPLETED)
+        concurrent.futures.wait(rendering)
+    # Render processes have exited and dumped their metrics
+
+    similarity_index.save()
+    # metrics/ndvi.prom and metrics/summary.json
+    metrics_summary = metrics_utils.export(metrics_dir)
+    # Report of reused and redrawn images, over every process
+    cache = metrics_summary["caches"].get("render", {"hit": 0, "miss": 0})
+    render_cache_utils.log_render_report({"reused": cache["hit"], "redrawn": cache["miss"]})
+    if profile:
+        profile_utils.stop_worker()
+        logging.info("Profile report: {}".format(profile_utils.merge(profile_dir)))
+    return metrics_summary
@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Profiling mode: cProfile and tracemalloc per pipeline stage and worker, plus an optional stack sampler.
+
+import os
+import sys
+import glob
+import json
+import pstats
+import cProfile
+import threading
+import contextlib
+import tracemalloc
+import metrics_utils
+
+# Number of allocation sites kept per worker
+TOP_ALLOCATIONS = 50
+
+_options = None
+_state = None
+
+
+def enable(profile_dir, sample_interval=None, n_frames=1):
+    """ Turn on profiling in this process; stages recorded through metrics_utils.stage are profiled
+    Args:
+        profile_dir: (str) directory of the profiles
+        sample_interval: (float) seconds between stack samples, None to skip the sampler
+        n_frames: (int) traceback depth of the tracemalloc allocations
+
+    Returns:
+        options: (dict) profiling options, for start_worker in other processes
+    """
+    global _options
+    if not os.path.exists(profile_dir):
+        os.makedirs(profile_dir)
+    for filename in glob.glob(os.path.join(profile_dir, "*")):
+        os.remove(filename)
+    _options = {"profile_dir": profile_dir, "sample_interval": sample_interval, "n_frames": n_frames}
+    start_worker("main", _options)
+    return _options
+
+
+def get_options():
+    """ Profiling options of this process, None when profiling is off
+    """
+    return _options
+
+
+def start_worker(worker, options=None):
+    """ Start profiling a worker process; does nothing if options is None
+    Args:
+        worker: (str) worker name, used in the file names
+        options: (dict) as returned by enable
+    """
+    global _options, _state
+    options = options if options is not None else _options
+    if options is None:
+        return
+    _options = options
+    if _state is not None and _state["pid"] == os.getpid():
+        return
+    # A forked worker starts afresh, without the parent's profilers nor sampler thread. Dashes separate
+    # worker, pid and stage in the file names: the ones of process names (ForkProcess-1) are replaced
+    # profilers by (stage, thread), active stages by thread
+    _state = {"pid": os.getpid(), "worker": str(worker).replace("-", "_"), "profilers": {}, "active": {},
+              "peaks": {}, "samples": {}, "sampler": None, "stop": threading.Event(), "lock": threading.Lock()}
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(options["n_frames"])
+    if options["sample_interval"]:
+        sampler = threading.Thread(target=_sample, args=(options["sample_interval"],), daemon=True)
+        _state["sampler"] = sampler
+        sampler.start()
+    if _profile_stage not in metrics_utils._stage_hooks:
+        metrics_utils._stage_hooks.append(_profile_stage)
+
+
+def stop_worker():
+    """ Stop profiling this process and write its files:
+    <worker>-<pid>-<stage>.prof, <worker>-<pid>-memory.json and <worker>-<pid>.folded
+    """
+    global _state
+    if _state is None or _state["pid"] != os.getpid():
+        return
+    state, _state = _state, None
+    if _profile_stage in metrics_utils._stage_hooks:
+        metrics_utils._stage_hooks.remove(_profile_stage)
+    state["stop"].set()
+    if state["sampler"] is not None:
+        state["sampler"].join()
+    prefix = os.path.join(_options["profile_dir"], "{}-{}".format(state["worker"], state["pid"]))
+    # The threads of a stage (fetch threads) add up into one file per stage
+    by_stage = {}
+    for (stage, _), profiler in state["profilers"].items():
+        by_stage.setdefault(stage, []).append(profiler)
+    for stage, profilers in by_stage.items():
+        stats = None
+        for profiler in profilers:
+            try:
+                stats = pstats.Stats(profiler) if stats is None else stats.add(profiler)
+            except TypeError:
+                # A profiler never enabled has no stats
+                continue
+        if stats is not None:
+            stats.dump_stats("{}-{}.prof".format(prefix, stage))
+    top = tracemalloc.take_snapshot().statistics("lineno")[:TOP_ALLOCATIONS]
+    tracemalloc.stop()
+    with open(prefix + "-memory.json", "w") as f:
+        json.dump({"stage_peaks": state["peaks"],
+                   "top_allocations": [[str(s.traceback[0]), s.size, s.count] for s in top]}, f)
+    if state["samples"]:
+        with open(prefix + ".folded", "w") as f:
+            for stack, count in sorted(state["samples"].items()):
+                f.write("{} {}\n".format(stack, count))
+
+
+@contextlib.contextmanager
+def _profile_stage(name):
+    state = _state
+    thread_id = threading.get_ident()
+    # Stages nested in another one of the same thread are accounted to the outer stage
+    if state is None or state["pid"] != os.getpid() or state["active"].get(thread_id):
+        yield
+        return
+    # cProfile follows only the thread that enables it: one profiler per stage and thread
+    profiler = state["profilers"].get((name, thread_id))
+    if profiler is None:
+        profiler = state["profilers"][(name, thread_id)] = cProfile.Profile()
+    with state["lock"]:
+        # The peak is reset only when no other thread runs a stage, so with concurrent stages
+        # it is an upper bound that includes their allocations
+        if not any(state["active"].values()):
+            tracemalloc.reset_peak()
+        state["active"][thread_id] = [name]
+        current = tracemalloc.get_traced_memory()[0]
+    try:
+        profiler.enable()
+    except ValueError:
+        # Python 3.12+ allows a single active profiler per process: the other threads are only sampled
+        profiler = None
+    try:
+        yield
+    finally:
+        if profiler is not None:
+            profiler.disable()
+        with state["lock"]:
+            peak = tracemalloc.get_traced_memory()[1] - current
+            state["peaks"][name] = max(state["peaks"].get(name, 0), peak)
+            state["active"][thread_id] = []
+
+
+def _sample(interval):
+    state = _state
+    main_id = threading.main_thread().ident
+    while not state["stop"].wait(interval):
+        for thread_id, frame in sys._current_frames().items():
+            active = state["active"].get(thread_id)
+            # The main thread, and the other threads while they run a stage (fetch threads)
+            if thread_id != main_id and not active:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append("{}:{}".format(os.path.basename(frame.f_code.co_filename), frame.f_code.co_name))
+                frame = frame.f_back
+            # Folded stacks, root first, tagged with the stage of the thread
+            key = ";".join([active[-1] if active else "other"] + stack[::-1])
+            state["samples"][key] = state["samples"].get(key, 0) + 1
+
+
+def merge(profile_dir, n_functions=25):
+    """ Merge the files of every worker: merged-<stage>.prof, merged-all.prof, merged.folded and report.txt
+    Args:
+        profile_dir: (str) directory of the profiles
+        n_functions: (int) functions listed per stage in the report
+
+    Returns:
+        report_file: (str) path of report.txt
+    """
+    by_stage = {}
+    for filename in glob.glob(os.path.join(profile_dir, "*.prof")):
+        name = os.path.basename(filename)
+        if name.startswith("merged-"):
+            continue
+        stage = name[:-len(".prof")].split("-", 2)[2]
+        by_stage.setdefault(stage, []).append(filename)
+    report_file = os.path.join(profile_dir, "report.txt")
+    with open(report_file, "w") as report:
+        all_files = [f for files in by_stage.values() for f in files]
+        if all_files:
+            pstats.Stats(*all_files).dump_stats(os.path.join(profile_dir, "merged-all.prof"))
+        for stage, files in sorted(by_stage.items()):
+            stats = pstats.Stats(*files, stream=report)
+            stats.dump_stats(os.path.join(profile_dir, "merged-{}.prof".format(stage)))
+            report.write("=== Stage {} ({} workers) ===\n".format(stage, len(files)))
+            stats.sort_stats("cumulative").print_stats(n_functions)
+
+        peaks, allocations = {}, {}
+        for filename in glob.glob(os.path.join(profile_dir, "*-memory.json")):
+            with open(filename) as f:
+                memory = json.load(f)
+            for stage, peak in memory["stage_peaks"].items():
+                peaks[stage] = max(peaks.get(stage, 0), peak)
+            for site, size, count in memory["top_allocations"]:
+                total = allocations.setdefault(site, [0, 0])
+                total[0] += size
+                total[1] += count
+        report.write("=== Peak memory per stage call (largest over workers) ===\n")
+        for stage, peak in sorted(peaks.items(), key=lambda item: -item[1]):
+            report.write("{:<20} {:>12.1f} KiB\n".format(stage, peak / 1024.0))
+        report.write("=== Top allocations at exit (summed over workers) ===\n")
+        for site, (size, count) in sorted(allocations.items(), key=lambda item: -item[1][0])[:n_functions]:
+            report.write("{:>12.1f} KiB {:>9} blocks  {}\n".format(size / 1024.0, count, site))
+
+    samples = {}
+    for filename in glob.glob(os.path.join(profile_dir, "*.folded")):
+        if os.path.basename(filename) == "merged.folded":
+            continue
+        with open(filename) as f:
+            for line in f:
+                stack, count = line.rsplit(" ", 1)
+                samples[stack] = samples.get(stack, 0) + int(count)
+    if samples:
+        with open(os.path.join(profile_dir, "merged.folded"), "w") as f:
+            for stack, count in sorted(samples.items()):
+                f.write("{} {}\n".format(stack, count))
+    return report_file
@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Indexed queries over the NDVI cube: by parcel, crop and date range, with filters and column projection.
+
+import os
+import warnings
+import numpy as np
+import pandas as pd
+import cube_utils
+
+# Columns stored in the cube
+COLUMNS = ("ndvi_mean", "ndvi_std")
+# Filter operators
+OPERATORS = {
+    "<": np.less,
+    "<=": np.less_equal,
+    ">": np.greater,
+    ">=": np.greater_equal,
+    "==": np.equal,
+    "!=": np.not_equal,
+}
+# Per-parcel statistics of summarize
+STATISTICS = {
+    "mean": np.nanmean,
+    "min": np.nanmin,
+    "max": np.nanmax,
+    "median": np.nanmedian,
+}
+
+
+def open_query(base_dir):
+    """ Query layer over the cube of a run
+    Args:
+        base_dir: (str) base directory holding the ndvi_cube folder
+
+    Returns:
+        query: NdviQuery
+    """
+    return NdviQuery(cube_utils.open_cube(os.path.join(base_dir, "ndvi_cube")))
+
+
+class NdviQuery:
+    """ Queries over an NdviCube.
+
+    The parcel id -> row index is the cube's own; crops are indexed by sorting the rows by crop once,
+    and dates map to a column slice. Only the selected rows, the date slice and the columns that are
+    returned or filtered on are read from the memory-mapped files.
+    """
+
+    def __init__(self, cube):
+        self.cube = cube
+        self._crop_order = None
+        self._crop_names = None
+        self._crop_starts = None
+
+    def crop_rows(self, crop):
+        """ Sorted row indexes of the parcels of a crop
+        """
+        if self._crop_order is None:
+            self._crop_order = np.argsort(self.cube.crop, kind="stable")
+            self._crop_names, self._crop_starts = np.unique(self.cube.crop[self._crop_order], return_index=True)
+            self._crop_starts = np.append(self._crop_starts, self.cube.n_parcels)
+        i = np.searchsorted(self._crop_names, str(crop))
+        if i == len(self._crop_names) or self._crop_names[i] != str(crop):
+            return np.empty(0, dtype=np.int64)
+        return self._crop_order[self._crop_starts[i]:self._crop_starts[i + 1]]
+
+    def select_rows(self, parcel_ids=None, crops=None):
+        """ Sorted row indexes of the given parcels and/or crops, all rows if both are None
+        """
+        rows = None
+        if crops is not None:
+            crops = [crops] if isinstance(crops, str) else crops
+            rows = np.unique(np.concatenate([self.crop_rows(crop) for crop in crops] + [np.empty(0, np.int64)]))
+        if parcel_ids is not None:
+            id_rows = np.unique(np.asarray([r for r in map(self._row, parcel_ids) if r is not None], dtype=np.int64))
+            rows = id_rows if rows is None else np.intersect1d(rows, id_rows, assume_unique=True)
+        if rows is None:
+            rows = np.arange(self.cube.n_parcels)
+        return rows.astype(np.int64)
+
+    def day_slice(self, start=None, end=None):
+        """ Column slice of the dates from start to end, both included
+        """
+        first = 0 if start is None else int(np.clip(self.cube.day_index([start])[0], 0, self.cube.n_days))
+        last = self.cube.n_days if end is None else int(np.clip(self.cube.day_index([end])[0] + 1, 0, self.cube.n_days))
+        return slice(first, max(first, last))
+
+    def select(self, parcel_ids=None, crops=None, start=None, end=None, columns=COLUMNS, where=(),
+               output="pandas", chunk_size=10000):
+        """ Observations of the selected parcels and dates that pass every filter
+        Args:
+            parcel_ids: (iterable) Polygon identifiers, None for all
+            crops: (str or iterable) crop names, None for all
+            start: first date, None from the start of the year
+            end: last date (included), None to the end of the year
+            columns: (iterable) data columns to return, out of COLUMNS
+            where: (iterable) filters (column, operator, value), e.g. [("ndvi_mean", "<", 0.3)]
+            output: (str) "pandas" for a Dataframe, "numpy" for a dict of arrays
+            chunk_size: (int) number of rows read at once
+
+        Returns:
+            One observation per row: parcel_id, crop, acq_date and the requested columns
+        """
+        columns = _check_columns(columns, where)
+        rows = self.select_rows(parcel_ids, crops)
+        days = self.day_slice(start, end)
+        parts = {name: [] for name in ("parcel_id", "crop", "acq_date") + tuple(columns)}
+        for block in _blocks(rows, chunk_size):
+            mask = self.cube.valid(block)[:, days]
+            data = self._read(block, days, set(columns) | {c for c, _, _ in where})
+            for column, operator, value in where:
+                mask &= OPERATORS[operator](data[column], value)
+            r, d = np.nonzero(mask)
+            parts["parcel_id"].append(self.cube.parcel_id[block[r]])
+            parts["crop"].append(self.cube.crop[block[r]])
+            parts["acq_date"].append(self.cube.dates[days][d])
+            for column in columns:
+                parts[column].append(data[column][r, d].astype(np.float64))
+        result = {name: _concatenate(values, name) for name, values in parts.items()}
+        return _output(result, output)
+
+    def summarize(self, parcel_ids=None, crops=None, start=None, end=None, columns=COLUMNS, where=(),
+                  statistic="mean", output="pandas", chunk_size=10000):
+        """ One statistic per parcel over its observations between start and end, keeping the parcels
+        whose statistics pass every filter, e.g. the parcels with a June-July mean NDVI below 0.3
+        Args:
+            statistic: (str) "mean", "min", "max" or "median"
+            other arguments as in select, with the filters applied to the statistics
+
+        Returns:
+            One parcel per row: parcel_id, crop, n_obs and the statistic of each requested column
+        """
+        if statistic not in STATISTICS:
+            raise ValueError("Unknown statistic {}, use one of {}".format(statistic, sorted(STATISTICS)))
+        columns = _check_columns(columns, where)
+        rows = self.select_rows(parcel_ids, crops)
+        days = self.day_slice(start, end)
+        parts = {name: [] for name in ("parcel_id", "crop", "n_obs") + tuple(columns)}
+        for block in _blocks(rows, chunk_size):
+            valid = self.cube.valid(block)[:, days]
+            data = self._read(block, days, set(columns) | {c for c, _, _ in where})
+            with warnings.catch_warnings():
+                # Parcels without observations in the range give NaN
+                warnings.simplefilter("ignore", category=RuntimeWarning)
+                stats = {c: STATISTICS[statistic](np.where(valid, data[c], np.nan), axis=1) for c in data}
+            keep = np.ones(len(block), dtype=bool)
+            for column, operator, value in where:
+                keep &= OPERATORS[operator](stats[column], value)
+            parts["parcel_id"].append(self.cube.parcel_id[block[keep]])
+            parts["crop"].append(self.cube.crop[block[keep]])
+            parts["n_obs"].append(valid[keep].sum(axis=1))
+            for column in columns:
+                parts[column].append(stats[column][keep].astype(np.float64))
+        result = {name: _concatenate(values, name) for name, values in parts.items()}
+        return _output(result, output)
+
+    def _read(self, rows, days, columns):
+        arrays = {"ndvi_mean": self.cube.mean, "ndvi_std": self.cube.std}
+        return {c: np.asarray(arrays[c][rows, days]) for c in columns}
+
+    def _row(self, parcel_id):
+        # Unknown parcels are left out of the selection
+        try:
+            return self.cube.row(parcel_id)
+        except KeyError:
+            return None
+
+
+def _check_columns(columns, where):
+    columns = tuple(columns)
+    for column in columns + tuple(c for c, _, _ in where):
+        if column not in COLUMNS:
+            raise ValueError("Unknown column {}, use one of {}".format(column, COLUMNS))
+    for _, operator, _ in where:
+        if operator not in OPERATORS:
+            raise ValueError("Unknown operator {}, use one of {}".format(operator, sorted(OPERATORS)))
+    return columns
+
+
+def _blocks(rows, chunk_size):
+    for start in range(0, len(rows), chunk_size):
+        yield rows[start:start + chunk_size]
+
+
+def _concatenate(values, name):
+    if values:
+        return np.concatenate(values)
+    return np.empty(0, dtype="datetime64[D]" if name == "acq_date" else None)
+
+
+def _output(result, output):
+    if output == "numpy":
+        return result
+    if output == "pandas":
+        df = pd.DataFrame(result)
+        if "acq_date" in df:
+            df["acq_date"] = pd.to_datetime(df["acq_date"])
+        return df
+    raise ValueError("Unknown output {}, use 'pandas' or 'numpy'".format(output))
@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Processing unit (PU) estimates of the Statistical API requests and a scheduler keeping the spend under
+# hourly and daily caps. Spent units are appended to a ledger, so caps hold across runs.
+#
+# PU rules of Sentinel Hub: 1 PU is 512 x 512 pixels of 3 input bands for one interval; the size factor is
+# at least 0.01 and dataMask is free. Estimates are multiplied by `calibration`, the ratio of the units
+# billed in the dashboard to the estimated ones.
+
+import os
+import re
+import csv
+import math
+import time
+import logging
+import datetime
+import threading
+import numpy as np
+import pandas as pd
+
+PU_PIXELS = 512 * 512
+PU_BANDS = 3
+MIN_SIZE_FACTOR = 0.01
+# Bands not billed
+FREE_BANDS = ("dataMask",)
+# Rolling windows of the caps, in seconds
+HOUR = 3600
+DAY = 24 * 3600
+LEDGER_FIELDS = ("time", "parcels", "pu")
+
+
+def count_intervals(time_interval, aggregation_interval):
+    """ Number of aggregation intervals of a time interval
+    Args:
+        time_interval: (tuple) first and last day, ISO dates ("2021-01-01", "2021-11-30"), both included
+        aggregation_interval: (str) ISO 8601 duration in days, weeks, months or years ("P1D", "P10D", "P1M")
+
+    Returns:
+        n_intervals: (int) number of intervals, the last one may be partial
+    """
+    start, end = (datetime.date.fromisoformat(str(day)[:10]) for day in time_interval)
+    match = re.fullmatch(r"P(\d+)([DWMY])", aggregation_interval)
+    if match is None:
+        raise ValueError("Unsupported aggregation interval {}".format(aggregation_interval))
+    step, unit = int(match.group(1)), match.group(2)
+    if unit in ("D", "W"):
+        return math.ceil(((end - start).days + 1) / (step * (7 if unit == "W" else 1)))
+    months = (end.year - start.year) * 12 + end.month - start.month + 1
+    return math.ceil(months / (step * (12 if unit == "Y" else 1)))
+
+
+def estimate_pu(width_px, height_px, n_bands, n_intervals, calibration=1.0):
+    """ Processing units of one request
+    Args:
+        width_px: (array) width of the requested bounding box in pixels
+        height_px: (array) height in pixels
+        n_bands: (int) billed input bands
+        n_intervals: (int) aggregation intervals
+        calibration: (float) billed / estimated units
+
+    Returns:
+        pu: (array) processing units
+    """
+    size_factor = np.maximum(MIN_SIZE_FACTOR, np.ceil(width_px) * np.ceil(height_px) / PU_PIXELS)
+    return size_factor * n_bands / PU_BANDS * n_intervals * calibration
+
+
+def estimate_costs(geodf, resolution, input_bands, time_interval, aggregation_interval, calibration=1.0):
+    """ Estimated processing units of the request of every polygon
+    Args:
+        geodf: GeopandasDataframe
+        resolution: (tuple) pixel size in meters (x, y)
+        input_bands: (list) evalscript input bands
+        time_interval: (tuple) first and last day of the request
+        aggregation_interval: (str) ISO 8601 duration of the intervals
+        calibration: (float) billed / estimated units
+
+    Returns:
+        costs: (numpy.ndarray) processing units, aligned with geodf rows
+    """
+    # Bounding boxes in meters, in the UTM zone of the layer
+    bounds = geodf.geometry.to_crs(geodf.estimate_utm_crs()).bounds
+    n_bands = len([band for band in input_bands if band not in FREE_BANDS])
+    n_intervals = count_intervals(time_interval, aggregation_interval)
+    return estimate_pu((bounds["maxx"] - bounds["minx"]).values / resolution[0],
+                       (bounds["maxy"] - bounds["miny"]).values / resolution[1],
+                       n_bands, n_intervals, calibration)
+
+
+def get_request_costs(geodf, calibration=1.0):
+    """ estimate_costs with the request settings of sentinel_api_utils
+    """
+    import sentinel_api_utils
+    return estimate_costs(geodf, sentinel_api_utils.resolution, sentinel_api_utils.input_bands,
+                          sentinel_api_utils.time_interval, sentinel_api_utils.aggregation_interval, calibration)
+
+
+def get_priorities(geodf, priority_column=None, crop_column=None, crop_priority=None):
+    """ Priority of every polygon, higher first
+    Args:
+        geodf: GeopandasDataframe
+        priority_column: (str) numeric column of priorities
+        crop_column: (str) crop column, for crop_priority
+        crop_priority: (list) crops first, in this order; the others come after them
+
+    Returns:
+        priorities: (numpy.ndarray) priorities, aligned with geodf rows
+    """
+    crop_rank = np.zeros(len(geodf))
+    if crop_priority:
+        # The first crop listed ranks highest, unlisted crops 0
+        rank = {crop: len(crop_priority) - i for i, crop in enumerate(crop_priority)}
+        crop_rank = np.array([rank.get(str(crop), 0) for crop in geodf[crop_column]], dtype=float)
+    column = np.zeros(len(geodf))
+    if priority_column is not None:
+        column = pd.to_numeric(geodf[priority_column], errors="coerce").fillna(0).values.astype(float)
+        column -= column.min() if len(column) else 0
+    # The crop rank first, the column orders the parcels of a same rank
+    return crop_rank * (column.max(initial=0) + 1) + column
+
+
+class QuotaLedger:
+    """ Processing units spent, one csv line per batch, appended by every run and by the fetch threads
+    """
+
+    def __init__(self, ledger_file):
+        self.ledger_file = ledger_file
+        self._lock = threading.Lock()
+
+    def record(self, pu, parcels):
+        with self._lock:
+            new_file = not os.path.isfile(self.ledger_file)
+            if new_file:
+                os.makedirs(os.path.dirname(self.ledger_file) or ".", exist_ok=True)
+            with open(self.ledger_file, "a", newline="") as f:
+                writer = csv.writer(f)
+                if new_file:
+                    writer.writerow(LEDGER_FIELDS)
+                writer.writerow((round(time.time(), 3), parcels, round(float(pu), 4)))
+
+    def spent(self, seconds, now=None):
+        """ Processing units spent in the last `seconds`
+        """
+        if not os.path.isfile(self.ledger_file):
+            return 0.0
+        since = (now or time.time()) - seconds
+        with open(self.ledger_file, newline="") as f:
+            return sum(float(row["pu"]) for row in csv.DictReader(f) if float(row["time"]) >= since)
+
+
+class QuotaScheduler:
+    """ Chooses the parcels of a run: by priority, while the estimated spend stays under the hourly and
+    daily caps. The parcels left are deferred to a later run.
+    """
+
+    def __init__(self, ledger, max_pu_per_hour=None, max_pu_per_day=None):
+        self.ledger = ledger
+        self.max_pu_per_hour = max_pu_per_hour
+        self.max_pu_per_day = max_pu_per_day
+
+    def budget(self, now=None):
+        """ Processing units that can still be spent now, inf without caps
+        """
+        budget = math.inf
+        for cap, window in ((self.max_pu_per_hour, HOUR), (self.max_pu_per_day, DAY)):
+            if cap is not None:
+                budget = min(budget, cap - self.ledger.spent(window, now))
+        return max(0.0, budget)
+
+    def plan(self, costs, priorities=None, now=None):
+        """ Parcels to request now
+        Args:
+            costs: (array) estimated processing units per parcel
+            priorities: (array) priority per parcel, higher first; all equal by default
+            now: (float) time of the plan, time.time() by default
+
+        Returns:
+            selected: (numpy.ndarray) indices of the parcels to request, by priority
+            deferred: (numpy.ndarray) indices of the parcels left for a later run
+        """
+        costs = np.asarray(costs, dtype=float)
+        priorities = np.zeros(len(costs)) if priorities is None else np.asarray(priorities, dtype=float)
+        # Higher priority first and, at equal priority, the cheaper parcels: more parcels per unit
+        order = np.lexsort((costs, -priorities))
+        budget = self.budget(now)
+        if budget == math.inf:
+            return order, np.array([], dtype=int)
+        # Parcels too expensive for what is left are skipped, cheaper ones after them may still fit
+        cumulative = 0.0
+        taken = np.zeros(len(order), dtype=bool)
+        for i, index in enumerate(order):
+            if cumulative + costs[index] <= budget:
+                cumulative += costs[index]
+                taken[i] = True
+        return order[taken], order[~taken]
+
+
+def get_batch_costs(costs, batch_size):
+    """ Estimated processing units of every request batch, in the order of the parcels
+    """
+    costs = np.asarray(costs, dtype=float)
+    return np.array([costs[i:i + batch_size].sum() for i in range(0, len(costs), batch_size)])
+
+
+def log_estimate(costs, batch_size, crops=None):
+    """ Log the total, per parcel, per batch and per crop estimated units of a run
+    """
+    costs = np.asarray(costs, dtype=float)
+    batches = get_batch_costs(costs, batch_size)
+    logging.info("Estimated processing units: {:.1f} for {} parcels, {:.2f} per parcel (max {:.2f}), "
+                 "{:.1f} per batch of {} (max {:.1f})".format(costs.sum(), len(costs), costs.mean() if len(costs) else 0,
+                                                              costs.max(initial=0), batches.mean() if len(batches) else 0,
+                                                              batch_size, batches.max(initial=0)))
+    if crops is not None:
+        by_crop = pd.Series(costs).groupby(np.asarray(crops)).sum().sort_values(ascending=False)
+        for crop, pu in by_crop.items():
+            logging.info("\t{}: {:.1f} PU".format(crop, pu))
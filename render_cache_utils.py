@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Content hashes stored next to rendered images, so unchanged plots are not drawn again.
+
+import os
+import hashlib
+import logging
+import numpy as np
+import pandas as pd
+import metrics_utils
+
+# Suffix of the file holding the hash of an image
+HASH_SUFFIX = ".sha1"
+
+# Images reused and redrawn in this process
+_render_report = {"reused": 0, "redrawn": 0}
+
+
+def get_render_hash(ndvi_profile, renderer_version, *params):
+    """ Hash of a profile (acq_date, ndvi_mean, ndvi_std) and of everything else that changes its image
+    Args:
+        ndvi_profile: Pandas Dataframe, dict of arrays or None
+        renderer_version: (str) version of the renderer drawing the image
+        params: title, crop, error bar flag, crop mean profile...
+
+    Returns:
+        render_hash: (str) hex digest
+    """
+    sha = hashlib.sha1(str(renderer_version).encode())
+    if ndvi_profile is not None:
+        ndvi_profile = pd.DataFrame(ndvi_profile)
+        if 'acq_date' in ndvi_profile:
+            # Dates may come as date objects, strings or datetime64
+            sha.update(pd.to_datetime(ndvi_profile['acq_date']).values.astype("datetime64[D]").tobytes())
+        for column in ('ndvi_mean', 'ndvi_std', 'ndvi_stdev'):
+            if column in ndvi_profile:
+                sha.update(pd.to_numeric(ndvi_profile[column], errors="coerce").values.astype(np.float64).tobytes())
+    for param in params:
+        if isinstance(param, pd.DataFrame):
+            sha.update(pd.util.hash_pandas_object(param, index=False).values.tobytes())
+        else:
+            sha.update(repr(param).encode())
+    return sha.hexdigest()
+
+
+def is_render_current(output_file, render_hash):
+    """ True if output_file exists and was drawn from data with the same hash
+    """
+    hash_file = output_file + HASH_SUFFIX
+    if not (os.path.isfile(output_file) and os.path.isfile(hash_file)):
+        return False
+    with open(hash_file) as f:
+        return f.read().strip() == render_hash
+
+
+def store_render_hash(output_file, render_hash):
+    """ Store the hash of a freshly drawn image next to it
+    """
+    with open(output_file + HASH_SUFFIX, "w") as f:
+        f.write(render_hash)
+
+
+def count_render(reused):
+    """ Count one image as reused or redrawn
+    """
+    _render_report["reused" if reused else "redrawn"] += 1
+    metrics_utils.inc("cache_requests_total", cache="render", result="hit" if reused else "miss")
+
+
+def get_render_report():
+    """ Number of images reused and redrawn in this process
+    """
+    return dict(_render_report)
+
+
+def log_render_report(report=None):
+    """ Log the reused/redrawn image counts, of this process or the given report (e.g. summed over workers)
+    """
+    report = report if report is not None else get_render_report()
+    total = report["reused"] + report["redrawn"]
+    logging.info("Rendered images: {} reused, {} redrawn ({:.1f}% reused)".format(
+        report["reused"], report["redrawn"], 100.0 * report["reused"] / total if total else 0.0))
+    return report
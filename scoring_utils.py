@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Batch scoring of parcels whose NDVI curve does not match their declared crop.
+
+import numpy as np
+import pandas as pd
+import cube_utils
+
+
+def get_crop_profiles(cube, chunk_size=10000, step=cube_utils.GRID_STEP):
+    """ Crop mean NDVI profiles on the regular grid, computed in one pass over the cube.
+
+    As in get_crop_mean_ndvi, the band half-width is the mean of the parcels' ndvi_std.
+
+    Args:
+        cube: NdviCube
+        chunk_size: (int) number of parcels read at once
+        step: (int) grid spacing in days
+
+    Returns:
+        crops: (numpy.ndarray) crop names
+        crop_mean: (numpy.ndarray) mean profile per crop, shape (crops, grid)
+        crop_std: (numpy.ndarray) std band half-width per crop, shape (crops, grid)
+    """
+    crops, labels = np.unique(cube.crop, return_inverse=True)
+    n_grid = len(cube_utils.regular_grid(cube.n_days, step))
+    sum_mean = np.zeros((len(crops), n_grid))
+    sum_std = np.zeros((len(crops), n_grid))
+    counts = np.zeros(len(crops))
+
+    for rows, mean, std, _ in cube.iter_chunks(chunk_size, gap_filled=True, step=step):
+        # Skip parcels without data
+        has_data = ~np.isnan(mean).any(axis=1)
+        chunk_labels = labels[rows][has_data]
+        np.add.at(sum_mean, chunk_labels, mean[has_data])
+        np.add.at(sum_std, chunk_labels, std[has_data])
+        counts += np.bincount(chunk_labels, minlength=len(crops))
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        crop_mean = sum_mean / counts[:, None]
+        crop_std = sum_std / counts[:, None]
+    return crops, crop_mean, crop_std
+
+
+def score_parcels(cube, chunk_size=10000, step=cube_utils.GRID_STEP):
+    """ Score every parcel of the cube against its declared crop profile and against all crop profiles
+    Args:
+        cube: NdviCube
+        chunk_size: (int) number of parcels scored at once
+        step: (int) grid spacing in days
+
+    Returns:
+        scores: Pandas Dataframe, one row per parcel with data, most suspicious first.
+            band_distance: mean distance outside the crop's mean +- std band
+            outside_ratio: share of grid days outside the band
+            own_rmse: RMSE to the declared crop mean profile
+            best_crop, best_rmse: closest crop mean profile and its RMSE
+            score: band_distance + (own_rmse - best_rmse)
+    """
+    crops, crop_mean, crop_std = get_crop_profiles(cube, chunk_size, step)
+    crop_index = {crop: i for i, crop in enumerate(crops)}
+    # Crops without any parcel with data can not be matched
+    usable = ~np.isnan(crop_mean).any(axis=1)
+    profiles = np.where(usable[:, None], crop_mean, 0.0)
+    profiles_sq = (profiles ** 2).sum(axis=1)
+    n_grid = crop_mean.shape[1]
+
+    tables = []
+    for rows, mean, _, _ in cube.iter_chunks(chunk_size, gap_filled=True, step=step):
+        has_data = ~np.isnan(mean).any(axis=1)
+        x = mean[has_data].astype(np.float64)
+        labels = np.asarray([crop_index[crop] for crop in cube.crop[rows][has_data]], dtype=np.int64)
+
+        # Distance to the declared crop band
+        deviation = np.abs(x - crop_mean[labels])
+        outside = np.maximum(deviation - crop_std[labels], 0.0)
+        band_distance = outside.mean(axis=1)
+        outside_ratio = (outside > 0).mean(axis=1)
+
+        # Squared distances to every crop profile: |x|^2 - 2 x.m + |m|^2
+        dist = (x ** 2).sum(axis=1)[:, None] - 2.0 * x @ profiles.T + profiles_sq[None, :]
+        rmse = np.sqrt(np.maximum(dist, 0.0) / n_grid)
+        rmse[:, ~usable] = np.inf
+        own_rmse = rmse[np.arange(len(x)), labels]
+        best = np.argmin(rmse, axis=1)
+        best_rmse = rmse[np.arange(len(x)), best]
+
+        tables.append(pd.DataFrame({
+            "parcel_id": cube.parcel_id[rows][has_data],
+            "crop": cube.crop[rows][has_data],
+            "band_distance": band_distance,
+            "outside_ratio": outside_ratio,
+            "own_rmse": own_rmse,
+            "best_crop": crops[best],
+            "best_rmse": best_rmse,
+            "score": band_distance + (own_rmse - best_rmse),
+        }))
+
+    if not tables:
+        return pd.DataFrame(columns=["parcel_id", "crop", "band_distance", "outside_ratio",
+                                     "own_rmse", "best_crop", "best_rmse", "score"])
+    scores = pd.concat(tables, ignore_index=True)
+    return scores.sort_values(by="score", ascending=False, ignore_index=True)
+
+
+def get_top_suspects(scores, n=100, crop=None):
+    """ The n highest scored parcels, optionally for a single declared crop
+    """
+    if crop is not None:
+        scores = scores[scores["crop"] == crop]
+    return scores.head(n)
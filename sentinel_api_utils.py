@@ -3,50 +3,24 @@
 
 # Author: Xavi Pascuet
 
-import os
-import pandas as pd
-import numpy as np
+import time
+import archive_utils
+import metrics_utils
+import session_utils
+# Parsing and crop means, kept importable without sentinelhub
+from ndvi_utils import stats_to_df, response_to_ndvi_df, get_crop_mean_ndvi
 from sentinelhub import SentinelHubStatistical, DataCollection, CRS,  \
-    Geometry, SHConfig, parse_time, SentinelHubStatisticalDownloadClient
+    Geometry, SHConfig
 
 config = SHConfig()
-
-
-def stats_to_df(stats_data):
-    """ Transform Statistical API response into a pandas.DataFrame
-    """
-    df_data = []
-
-    for single_data in stats_data['data']:
-        df_entry = {}
-        is_valid_entry = True
-
-        df_entry['interval_from'] = parse_time(
-            single_data['interval']['from']).date()
-        df_entry['interval_to'] = parse_time(
-            single_data['interval']['to']).date()
-
-        for output_name, output_data in single_data['outputs'].items():
-            for band_name, band_values in output_data['bands'].items():
-
-                band_stats = band_values['stats']
-                if band_stats['sampleCount'] == band_stats['noDataCount']:
-                    is_valid_entry = False
-                    break
-
-                for stat_name, value in band_stats.items():
-                    col_name = f'{output_name}_{band_name}_{stat_name}'
-                    if stat_name == 'percentiles':
-                        for perc, perc_val in value.items():
-                            perc_col_name = f'{col_name}_{perc}'
-                            df_entry[perc_col_name] = perc_val
-                    else:
-                        df_entry[col_name] = value
-
-        if is_valid_entry:
-            df_data.append(df_entry)
-
-    return pd.DataFrame(df_data)
+# Collection requested; define_from(..., service_url=...) points it at another deployment
+data_collection = DataCollection.SENTINEL2_L2A
+# Request settings, also used by quota_utils to estimate the processing units
+time_interval = ('2021-01-01', '2021-11-30')
+aggregation_interval = 'P1D'
+resolution = (10, 10)
+# Input bands of ndvi_evalscript
+input_bands = ["B04", "B08", "CLM", "CLP", "dataMask"]
 
 
 ndvi_evalscript = """
@@ -94,82 +68,93 @@ function evaluatePixel(samples) {
 """
 
 
-def sentinelapi_request(geodf):
-    """ Request ndvi yearly time series for a colletion of polygons(geodataframe)
+def build_download_requests(geodf):
+    """ Build the Statistical API download requests for a collection of polygons(geodataframe)
     Args:
         geodf: GeopandasDataframe
 
     Returns:
-        ndvi_stats: Sentinel Satistical API's response on json format
+        download_requests: (list) sentinelhub DownloadRequest, one per polygon
     """
-
     ndvi_requests = []  # List of requests
 	# Iterate throw polygons creating a request for each
     for geo_shape in geodf.geometry.values:
         ndvi_request = SentinelHubStatistical(
             aggregation=SentinelHubStatistical.aggregation(
                 evalscript=ndvi_evalscript,
-                time_interval=('2021-01-01', '2021-11-30'),
-                aggregation_interval='P1D',
-                resolution=(10, 10)),
+                time_interval=time_interval,
+                aggregation_interval=aggregation_interval,
+                resolution=resolution),
             input_data=[SentinelHubStatistical.input_data(
-                DataCollection.SENTINEL2_L2A, maxcc=0.8)],
+                data_collection, maxcc=0.8)],
             geometry=Geometry(geo_shape, CRS(geodf.crs)),
             config=config)
 
         ndvi_requests.append(ndvi_request)
 
-    download_requests = [ndvi_request.download_list[0]
-                         for ndvi_request in ndvi_requests]
-    # Set client
-    client = SentinelHubStatisticalDownloadClient(config=config)
+    return [ndvi_request.download_list[0] for ndvi_request in ndvi_requests]
+
+
+def sentinelapi_request(geodf, archive=None, parcel_ids=None):
+    """ Request ndvi yearly time series for a colletion of polygons(geodataframe)
+    Args:
+        geodf: GeopandasDataframe
+        archive: archive_utils.ResponseArchive storing the raw responses, None to skip it
+        parcel_ids: (iterable) Polygon identifiers of the geodf rows, for the archive
+
+    Returns:
+        ndvi_stats: Sentinel Satistical API's response on json format
+    """
+    with metrics_utils.stage("request_build", len(geodf)):
+        download_requests = build_download_requests(geodf)
+    # Client of this thread: pooled keep-alive connections and the token shared by every process
+    client = session_utils.get_client(config)
     # Download from API
-    ndvi_stats = client.download(download_requests)
+    with metrics_utils.stage("download", len(download_requests)):
+        ndvi_stats = client.download(download_requests)
+    if archive is not None:
+        archive.append(parcel_ids, ndvi_stats,
+                       [archive_utils.get_request_hash(request) for request in download_requests])
 
     return ndvi_stats
 
 
-def get_crop_mean_ndvi(df, id_column, crop_column, base_dir):
-    """ Get mean ndvi for crop and export into csv files
+def iter_sentinelapi_responses(geodf, archive=None, parcel_ids=None, sent=None):
+    """ Request ndvi yearly time series for a collection of polygons, yielding every answer as it arrives,
+    so that a batch never holds all the responses at once
     Args:
-        df: Pandas Dataframe
-        id_column: (int) Polygon identifier
-        crop_column: (str) Polygon crop name
-        base_dir: (str) base directory
+        geodf: GeopandasDataframe
+        archive: archive_utils.ResponseArchive storing the raw responses, None to skip it
+        parcel_ids: (iterable) Polygon identifiers of the geodf rows, row numbers by default
+        sent: (dict) filled with the requests sent by parcel id, also when the download fails: (requests of the
+            whole time range, retries and hedged duplicates included; single interval retry requests)
 
     Returns:
-        None
+        Generator of (parcel_id, ndvi_stats) in arrival order, ndvi_stats the json response of one polygon
     """
-    dest_dir = base_dir + "/crop_mean_ndvi"
-    if not os.path.exists(dest_dir):
-        os.mkdir(dest_dir)
-
-    for product in df[crop_column].unique():
-        # Get dataframe for product
-        df_product = df[df[crop_column] == product]
-        # List of dataframes
-        df_list = []
-        # Iterate all id in product and read csv files
-        for _id in df_product[id_column]:
-            filename = base_dir + "/ndvi/" + str(_id) + "_ndvi.csv"
-            ndvi_profile = pd.read_csv(filename)
-            df_list.append(ndvi_profile)
-        # Get total's dataframe
-        df_total = pd.concat(df_list)
-        # Group by day and calculate means
-        df_total = df_total.groupby(["acq_date"], as_index=False)[
-            ["ndvi_mean", "ndvi_std"]].mean()
-        # Transfor string tate to datetime
-        df_total['acq_date'] = pd.to_datetime(df_total.acq_date)
-        # transform datetime to numeric (days since epoch)
-        date_num = df_total['acq_date'].apply(lambda x: x.value)
-        # Get polynomic regression for mean values
-        poly = np.polyfit(date_num, df_total['ndvi_mean'], 5)
-        df_total["ndvi_mean"] = np.poly1d(poly)(date_num)
-        # Get polynomic regression for standard deviation
-        poly = np.polyfit(date_num, df_total['ndvi_std'], 5)
-        df_total["ndvi_std"] = np.poly1d(poly)(date_num)
-        # Rename columns
-        df_total.rename(columns={'ndvi_std': 'ndvi_stdev'}, inplace=True)
-        # Export
-        df_total.to_csv((dest_dir + "/" + product + ".csv"), index=False)
+    with metrics_utils.stage("request_build", len(geodf)):
+        download_requests = build_download_requests(geodf)
+    parcel_ids = list(range(len(geodf))) if parcel_ids is None else list(parcel_ids)
+    client = session_utils.get_client(config)
+    counts = [[0, 0] for _ in download_requests]
+    responses = client.iter_download(download_requests, sent=counts)
+    waited = 0.0
+    try:
+        while True:
+            start = time.perf_counter()
+            try:
+                i, ndvi_stats = next(responses)
+            except StopIteration:
+                break
+            finally:
+                waited += time.perf_counter() - start
+            if archive is not None:
+                archive.append([parcel_ids[i]], [ndvi_stats], [archive_utils.get_request_hash(download_requests[i])])
+            yield parcel_ids[i], ndvi_stats
+    finally:
+        responses.close()
+        # Complete once closed: the requests in flight have returned
+        if sent is not None:
+            sent.update((parcel_ids[i], tuple(n)) for i, n in enumerate(counts) if any(n))
+        # Only the waits for the answers: what the caller does between them is timed by its own stages
+        metrics_utils.add_stage("download", waited, len(download_requests))
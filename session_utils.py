@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Sentinel Hub sessions: pooled keep-alive HTTP connections per worker process and one OAuth token
+# shared by every process of the machine through a locked file.
+
+import os
+import copy
+import json
+import time
+import inspect
+import hashlib
+import itertools
+import tempfile
+import threading
+import concurrent.futures
+import requests
+from requests.adapters import HTTPAdapter
+from sentinelhub import SentinelHubSession, SentinelHubStatisticalDownloadClient
+import metrics_utils
+import hedge_utils
+
+try:
+    import fcntl
+except ImportError:
+    # Without file locks (Windows) processes may fetch a token each, the file is still shared
+    fcntl = None
+
+# Seconds before expiry at which the shared token is replaced
+REFRESH_BEFORE_EXPIRY = 120
+# Keep-alive connections kept per host; the download client runs several threads per request batch
+POOL_SIZE = 64
+
+# Seconds before a request is abandoned (a number or a (connect, read) tuple), config.download_timeout_seconds if None
+request_timeout = None
+# Latency percentile after which a late request is sent again (hedge_utils), None to send every request once
+hedge_percentile = None
+# Duplicates allowed per request sent
+max_hedge_ratio = hedge_utils.MAX_EXTRA_RATIO
+
+_lock = threading.Lock()
+_sent_lock = threading.Lock()
+# Per process: {"pid", "http", "sessions", "hedger"}; per thread: the download clients and the sent counts slot
+_process = None
+_threads = threading.local()
+
+
+def get_token_file(config):
+    """ Token file of a client id and token url, in the temporary folder
+    """
+    key = "{}|{}".format(config.sh_client_id, getattr(config, "sh_token_url", config.sh_base_url))
+    return os.path.join(tempfile.gettempdir(), "ndvi_sh_token_{}.json".format(hashlib.sha1(key.encode()).hexdigest()[:16]))
+
+
+class SharedTokenSession(SentinelHubSession):
+    """ SentinelHubSession reading its token from a file shared by every process, under a file lock.
+    A new token is fetched, and written for the others, only when the shared one is about to expire.
+
+    Only _fetch_token is overridden, which sentinelhub 3.3.1 (the pinned version) and later versions
+    both call whenever the session needs a token.
+    """
+
+    def __init__(self, config=None, token_file=None, refresh_before_expiry=REFRESH_BEFORE_EXPIRY):
+        self.token_file = token_file or get_token_file(config)
+        # Set before super().__init__, which fetches the first token
+        self.refresh_before_expiry = refresh_before_expiry
+        # sentinelhub < 3.6 refreshes SECONDS_BEFORE_EXPIRY before expiry and takes only config
+        self.SECONDS_BEFORE_EXPIRY = refresh_before_expiry
+        if "refresh_before_expiry" in inspect.signature(SentinelHubSession.__init__).parameters:
+            super().__init__(config=config, refresh_before_expiry=refresh_before_expiry)
+        else:
+            super().__init__(config=config)
+
+    def _fetch_token(self, request):
+        with open(self.token_file + ".lock", "a") as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                token = _read_token(self.token_file)
+                if token is not None and token["expires_at"] - time.time() > self.refresh_before_expiry:
+                    metrics_utils.inc("cache_requests_total", cache="oauth_token", result="hit")
+                    return token
+                token = super()._fetch_token(request)
+                metrics_utils.inc("cache_requests_total", cache="oauth_token", result="miss")
+                _write_token(self.token_file, token)
+                return token
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def _read_token(token_file):
+    try:
+        with open(token_file) as f:
+            token = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return token if "access_token" in token and "expires_at" in token else None
+
+
+def _write_token(token_file, token):
+    # Readable by this user only, written aside and renamed so readers never see a partial file
+    fd = os.open(token_file + ".tmp", os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w") as f:
+        json.dump(token, f)
+    os.replace(token_file + ".tmp", token_file)
+
+
+class PooledStatisticalClient(SentinelHubStatisticalDownloadClient):
+    """ Statistical API client sending its requests through the pooled keep-alive session of the process,
+    instead of a new connection (and TLS handshake) per request. Late requests are hedged when
+    hedge_percentile is set.
+    """
+
+    def _do_download(self, request):
+        if request.url is None:
+            raise ValueError(f"Faulty request {request}, no URL specified.")
+        headers = self._prepare_headers(request)
+        timeout = request_timeout or self.config.download_timeout_seconds
+        # Count of iter_download to increment, taken here as hedged duplicates run in other threads
+        sent = getattr(_threads, "sent", None)
+
+        def send():
+            if sent is not None:
+                counts, index, column = sent
+                with _sent_lock:
+                    counts[index][column] += 1
+            start = time.perf_counter()
+            response = get_http_session().request(request.request_type.value, url=request.url,
+                                                  json=request.post_values, headers=headers, timeout=timeout)
+            metrics_utils.observe("request_seconds", time.perf_counter() - start)
+            # Bytes received as sent (compressed if they were), duplicates of hedged requests included
+            size = response.headers.get("Content-Length", len(response.content))
+            metrics_utils.inc("download_bytes_total", int(size))
+            return response
+        hedger = get_hedger()
+        if hedger is None:
+            return send()
+        # 429 and errors are not answers: the other request may still win, else the client retries
+        return hedger.call(send, is_ok=lambda response: response.ok)
+
+    def iter_download(self, download_requests, max_threads=None, sent=None):
+        """ Download like download(), but yield every decoded answer as soon as it arrives
+        Args:
+            download_requests: (list) sentinelhub DownloadRequest
+            max_threads: (int) concurrent requests, as in download()
+            sent: (list) [0, 0] pairs aligned with download_requests, incremented for every request sent: the
+                requests of the whole time range (retries, hedged duplicates and failed requests included), and
+                the single interval requests retrying the intervals that failed
+
+        Returns:
+            Generator of (index, data): position of the request in download_requests and its decoded answer
+        """
+        # ThreadPoolExecutor's default, as download()
+        max_threads = max_threads or min(32, (os.cpu_count() or 1) + 4)
+        # As in download(): the threads share the rate limit state under this lock
+        self.lock = threading.Lock()
+        executor = concurrent.futures.ThreadPoolExecutor(max_threads)
+        requests_left = iter(enumerate(download_requests))
+        try:
+            # max_threads requests at a time: answers are not downloaded faster than they are consumed
+            pending = {executor.submit(self._download_decoded, request, i, sent): i
+                       for i, request in itertools.islice(requests_left, max_threads)}
+            while pending:
+                done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                while done:
+                    # No reference to the future, and to its answer, is kept once it is consumed
+                    future = done.pop()
+                    index = pending.pop(future)
+                    for i, request in itertools.islice(requests_left, 1):
+                        pending[executor.submit(self._download_decoded, request, i, sent)] = i
+                    yield index, future.result()
+        finally:
+            # Stopped early (error or close): the requests not started are dropped
+            executor.shutdown(wait=True, cancel_futures=True)
+            self.lock = None
+
+    def _download_per_interval(self, request, time_intervals):
+        """ Retry the failed intervals one request each, as SentinelHubStatisticalDownloadClient does, counting
+        them into the sent pair of the request: they run in threads of their own
+        """
+        sent = getattr(_threads, "sent", None)
+        interval_requests = []
+        for time_interval in time_intervals.values():
+            interval_request = copy.deepcopy(request)
+            if interval_request.post_values is None or "aggregation" not in interval_request.post_values:
+                raise ValueError("Unable to configure request for retrying by interval.")
+            interval_request.post_values["aggregation"]["timeRange"] = time_interval
+            interval_requests.append(interval_request)
+
+        def execute(interval_request):
+            _threads.sent = None if sent is None else (sent[0], sent[1], 1)
+            try:
+                return self._execute_single_stat_download(interval_request)
+            finally:
+                _threads.sent = None
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_retry_threads) as executor:
+            stat_info_responses = list(executor.map(execute, interval_requests))
+        return dict(zip(time_intervals, stat_info_responses))
+
+    def _download_decoded(self, request, index=None, sent=None):
+        # (counts, index, column): column 0 counts the requests of the whole time range, 1 the interval retries
+        _threads.sent = None if sent is None else (sent, index, 0)
+        try:
+            if hasattr(self, "_single_download_decoded"):
+                return self._single_download_decoded(request)
+            # sentinelhub < 3.9
+            return self._single_download(request, True)
+        finally:
+            _threads.sent = None
+
+
+def _get_process():
+    global _process
+    # A forked worker must not reuse its parent's sockets
+    if _process is None or _process["pid"] != os.getpid():
+        with _lock:
+            if _process is None or _process["pid"] != os.getpid():
+                _process = {"pid": os.getpid(), "http": None, "sessions": {}, "hedger": None}
+    return _process
+
+
+def get_http_session():
+    """ requests.Session of this process, with POOL_SIZE keep-alive connections per host
+    """
+    process = _get_process()
+    if process["http"] is None:
+        with _lock:
+            if process["http"] is None:
+                http = requests.Session()
+                adapter = HTTPAdapter(pool_connections=4, pool_maxsize=POOL_SIZE)
+                http.mount("https://", adapter)
+                http.mount("http://", adapter)
+                process["http"] = http
+    return process["http"]
+
+
+def get_hedger():
+    """ hedge_utils.Hedger of this process, None when hedging is off
+    """
+    if hedge_percentile is None:
+        return None
+    process = _get_process()
+    if process["hedger"] is None:
+        with _lock:
+            if process["hedger"] is None:
+                process["hedger"] = hedge_utils.Hedger(hedge_percentile, max_hedge_ratio)
+    return process["hedger"]
+
+
+def get_session(config):
+    """ SharedTokenSession of a configuration, one per process
+    """
+    process = _get_process()
+    key = (config.sh_client_id, config.sh_base_url, getattr(config, "sh_token_url", None))
+    with _lock:
+        session = process["sessions"].get(key)
+        if session is None:
+            session = process["sessions"][key] = SharedTokenSession(config)
+    return session
+
+
+def get_client(config):
+    """ Download client of this thread, sharing the pooled connections and the token of the process
+    Args:
+        config: SHConfig
+
+    Returns:
+        client: PooledStatisticalClient
+    """
+    # download() keeps per-call state on the client, so each thread has its own
+    clients = getattr(_threads, "clients", None)
+    if clients is None or _threads.pid != os.getpid():
+        clients = _threads.clients = {}
+        _threads.pid = os.getpid()
+    client = clients.get(id(config))
+    if client is None:
+        client = clients[id(config)] = PooledStatisticalClient(config=config, session=get_session(config))
+    return client
@@ -0,0 +1,311 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Multi-node runs: the parcels are split into deterministic shards and every node claims shards from a
+# SQLite coordinator on a shared filesystem. Claims are leases renewed while the shard runs, so the shards
+# of a dead node are claimed again once their lease expires. Each claim of a shard is a run of the pipeline
+# into its own base_dir/shards/shard-NNNN/attempt-K; the completed attempts are merged into base_dir when
+# every shard is done, so a node that lost its lease never mixes its output with the one of the new claim.
+#
+# The SQLite file relies on the file locks of the shared filesystem (NFS with lockd, SMB, CephFS...), and
+# leases on the clocks of the nodes being in sync.
+
+import os
+import glob
+import time
+import zlib
+import shutil
+import socket
+import logging
+import sqlite3
+import threading
+import numpy as np
+import cube_utils
+import archive_utils
+import metrics_utils
+import similarity_utils
+
+SHARDS_DIR = "shards"
+COORDINATOR_FILE = "coordinator.sqlite"
+# Seconds a claim lasts without renewal; it is renewed every third of it
+LEASE_SECONDS = 300
+# Seconds between claims while the other nodes finish their shards
+POLL_SECONDS = 10
+# Folders of the shard runs copied into base_dir
+OUTPUT_FOLDERS = ("ndvi", "ndvi_graphs", "ndvi_thumbnails")
+
+
+def get_shards(parcel_ids, n_shards, geodf=None, tile_size=None):
+    """ Shard of every parcel: crc32 of the id, or of its tile for spatial shards
+    Args:
+        parcel_ids: (iterable) Polygon identifiers
+        n_shards: (int) number of shards
+        geodf: GeopandasDataframe aligned with parcel_ids, for spatial shards
+        tile_size: (float) tile side in degrees; shards by id when None
+
+    Returns:
+        shards: (numpy.ndarray) shard number of every parcel
+    """
+    if tile_size is None:
+        keys = [str(_id) for _id in parcel_ids]
+    else:
+        # Neighbour parcels share a shard; the point is inside its polygon
+        points = geodf.geometry.to_crs(4326).representative_point()
+        keys = ["{}_{}".format(int(np.floor(x / tile_size)), int(np.floor(y / tile_size)))
+                for x, y in zip(points.x, points.y)]
+    return np.array([zlib.crc32(key.encode()) % n_shards for key in keys], dtype=np.int64)
+
+
+def get_shard_dir(base_dir, shard, attempt):
+    """ Base directory of the run of one claim of a shard
+    """
+    return os.path.join(base_dir, SHARDS_DIR, "shard-{:04d}".format(shard), "attempt-{}".format(attempt))
+
+
+class ShardCoordinator:
+    """ Shard states in a SQLite file shared by the nodes: pending, running (claimed by a node until
+    lease_until) or done. Every change is one transaction, so two nodes never hold the same live claim.
+    attempts numbers the claims of a shard; once done it is the attempt that completed it.
+    """
+
+    def __init__(self, db_file, lease_seconds=LEASE_SECONDS):
+        self.db_file = db_file
+        self.lease_seconds = lease_seconds
+
+    def _connect(self):
+        # Autocommit: transactions are opened explicitly, BEGIN IMMEDIATE takes the write lock at once
+        return sqlite3.connect(self.db_file, timeout=60, isolation_level=None)
+
+    def _write(self, statements):
+        connection = self._connect()
+        try:
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                result = statements(connection)
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+            connection.execute("COMMIT")
+            return result
+        finally:
+            connection.close()
+
+    def create(self, n_shards):
+        """ Create the shard table, or check that the existing one has n_shards
+        """
+        os.makedirs(os.path.dirname(self.db_file) or ".", exist_ok=True)
+
+        def create(connection):
+            connection.execute("CREATE TABLE IF NOT EXISTS shards (shard INTEGER PRIMARY KEY, state TEXT, node TEXT, "
+                               "lease_until REAL, attempts INTEGER, finished REAL)")
+            connection.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+            connection.execute("INSERT OR IGNORE INTO meta VALUES ('n_shards', ?), ('merged_by', '')", (str(n_shards),))
+            existing = int(connection.execute("SELECT value FROM meta WHERE key = 'n_shards'").fetchone()[0])
+            if existing != n_shards:
+                raise ValueError("{} has {} shards, not {}".format(self.db_file, existing, n_shards))
+            connection.executemany("INSERT OR IGNORE INTO shards VALUES (?, 'pending', NULL, 0, 0, NULL)",
+                                   [(shard,) for shard in range(n_shards)])
+        self._write(create)
+
+    def claim(self, node):
+        """ Claim a pending shard, or one whose lease expired
+        Returns:
+            shard: (int) claimed shard, None if there is none to claim now
+            attempt: (int) number of the claim, from 1
+        """
+        def claim(connection):
+            now = time.time()
+            row = connection.execute("SELECT shard, attempts FROM shards WHERE state = 'pending' OR "
+                                     "(state = 'running' AND lease_until < ?) ORDER BY attempts, shard LIMIT 1",
+                                     (now,)).fetchone()
+            if row is None:
+                return None, None
+            connection.execute("UPDATE shards SET state = 'running', node = ?, lease_until = ?, attempts = attempts + 1 "
+                               "WHERE shard = ?", (node, now + self.lease_seconds, row[0]))
+            return row[0], row[1] + 1
+        return self._write(claim)
+
+    def renew(self, shard, node, attempt):
+        """ Extend the lease of a running shard; False if the node lost it
+        """
+        return self._write(lambda connection: connection.execute(
+            "UPDATE shards SET lease_until = ? WHERE shard = ? AND node = ? AND attempts = ? AND state = 'running'",
+            (time.time() + self.lease_seconds, shard, node, attempt)).rowcount == 1)
+
+    def complete(self, shard, node, attempt):
+        """ Mark a shard done by this attempt; False if the node lost it
+        """
+        return self._write(lambda connection: connection.execute(
+            "UPDATE shards SET state = 'done', finished = ? WHERE shard = ? AND node = ? AND attempts = ? "
+            "AND state = 'running'", (time.time(), shard, node, attempt)).rowcount == 1)
+
+    def release(self, shard, node, attempt):
+        """ Give a claimed shard back, after a failure
+        """
+        self._write(lambda connection: connection.execute(
+            "UPDATE shards SET state = 'pending', node = NULL WHERE shard = ? AND node = ? AND attempts = ? "
+            "AND state = 'running'", (shard, node, attempt)))
+
+    def done_attempts(self):
+        """ Attempt that completed every done shard, {shard: attempt}
+        """
+        connection = self._connect()
+        try:
+            return dict(connection.execute("SELECT shard, attempts FROM shards WHERE state = 'done' "
+                                           "ORDER BY shard").fetchall())
+        finally:
+            connection.close()
+
+    def claim_merge(self, node):
+        """ True for the one node that merges the shards, once all are done
+        """
+        def claim(connection):
+            if connection.execute("SELECT COUNT(*) FROM shards WHERE state != 'done'").fetchone()[0]:
+                return False
+            return connection.execute("UPDATE meta SET value = ? WHERE key = 'merged_by' AND value = ''",
+                                      (node,)).rowcount == 1
+        return self._write(claim)
+
+    def counts(self):
+        """ Number of shards by state
+        """
+        connection = self._connect()
+        try:
+            return dict(connection.execute("SELECT state, COUNT(*) FROM shards GROUP BY state").fetchall())
+        finally:
+            connection.close()
+
+
+class _Lease:
+    """ Renews the claim of a shard in a thread while the shard runs; lost is set if another node took it
+    """
+
+    def __init__(self, coordinator, shard, node, attempt):
+        self.coordinator = coordinator
+        self.shard = shard
+        self.node = node
+        self.attempt = attempt
+        self.lost = False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._renew, name="lease", daemon=True)
+
+    def _renew(self):
+        while not self._stop.wait(self.coordinator.lease_seconds / 3):
+            try:
+                if not self.coordinator.renew(self.shard, self.node, self.attempt):
+                    self.lost = True
+                    return
+            except sqlite3.Error as e:
+                # The shared filesystem may be briefly unavailable; the lease covers a few misses
+                logging.warning("Lease renewal of shard {} failed: {}".format(self.shard, e))
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+
+
+def run_node(base_dir, parcel_ids, crops, geodf, n_shards, node=None, tile_size=None, lease_seconds=LEASE_SECONDS,
+             poll_seconds=POLL_SECONDS, merge=True, year=2021, **pipeline_options):
+    """ Claim and run shards until every shard is done, then merge them if this node is the first to see it
+    Args:
+        base_dir: (str) base directory on the shared filesystem
+        parcel_ids: (list) Polygon identifiers, the same list on every node
+        crops: (list) Polygon crop names, aligned with parcel_ids
+        geodf: GeopandasDataframe aligned with parcel_ids
+        n_shards: (int) number of shards, the same on every node
+        node: (str) node name, host and process id by default
+        tile_size: (float) spatial shards of tile_size degrees; shards by id hash when None
+        lease_seconds: (float) seconds a claim lasts without renewal
+        poll_seconds: (float) seconds between claims while other nodes run the last shards
+        merge: (bool) merge the shards into base_dir when they are all done
+        year: (int) year of the time series
+        pipeline_options: other pipeline_utils.run_pipeline arguments
+
+    Returns:
+        shards_run: (list) shards run by this node
+    """
+    import pipeline_utils
+    node = node or "{}-{}".format(socket.gethostname(), os.getpid())
+    parcel_ids = [str(_id) for _id in parcel_ids]
+    crops = list(crops)
+    coordinator = ShardCoordinator(os.path.join(base_dir, SHARDS_DIR, COORDINATOR_FILE), lease_seconds)
+    coordinator.create(n_shards)
+    shards = get_shards(parcel_ids, n_shards, geodf, tile_size)
+    shards_run = []
+    while True:
+        shard, attempt = coordinator.claim(node)
+        if shard is None:
+            counts = coordinator.counts()
+            if counts.get("done", 0) == n_shards:
+                break
+            # Shards still running elsewhere: wait, in case their node dies
+            time.sleep(poll_seconds)
+            continue
+        rows = np.flatnonzero(shards == shard)
+        logging.info("Node {} runs shard {}, attempt {} ({} parcels)".format(node, shard, attempt, len(rows)))
+        with _Lease(coordinator, shard, node, attempt) as lease:
+            try:
+                if len(rows):
+                    # A folder per claim: a node that lost its lease and still runs writes only into its own
+                    shard_dir = get_shard_dir(base_dir, shard, attempt)
+                    os.makedirs(shard_dir, exist_ok=True)
+                    pipeline_utils.run_pipeline(shard_dir, [parcel_ids[i] for i in rows], [crops[i] for i in rows],
+                                                geodf.iloc[rows], year=year, **pipeline_options)
+                    # Metrics of this process for this shard only, merged with the render processes' ones
+                    metrics_utils.dump(os.path.join(shard_dir, r'metrics'))
+                    metrics_utils.reset()
+            except BaseException:
+                coordinator.release(shard, node, attempt)
+                raise
+        if lease.lost or not coordinator.complete(shard, node, attempt):
+            logging.warning("Node {} lost the lease of shard {}, another node runs it; attempt {} is not merged".format(
+                node, shard, attempt))
+            continue
+        shards_run.append(shard)
+    if merge and coordinator.claim_merge(node):
+        merge_shards(base_dir, parcel_ids, crops, year)
+    return shards_run
+
+
+def merge_shards(base_dir, parcel_ids, crops, year=2021):
+    """ Merge the shard runs into base_dir: csv files and plots, NDVI cube, similarity index, response
+    archive and metrics. Only the attempt that completed each shard is read
+    Args:
+        base_dir: (str) base directory of the multi-node run
+        parcel_ids: (list) Polygon identifiers of every shard
+        crops: (list) Polygon crop names, aligned with parcel_ids
+        year: (int) year of the time series
+
+    Returns:
+        metrics_summary: (dict) per-stage metrics of every shard
+    """
+    cube = cube_utils.create_cube(os.path.join(base_dir, r'ndvi_cube'), parcel_ids, crops, year=year)
+    similarity_index = similarity_utils.SimilarityIndex(os.path.join(base_dir, r'ndvi_index'))
+    archive = archive_utils.ResponseArchive(os.path.join(base_dir, r'ndvi_archive'))
+    metrics_dir = os.path.join(base_dir, r'metrics')
+    metrics_utils.clear(metrics_dir)
+    os.makedirs(metrics_dir, exist_ok=True)
+    coordinator = ShardCoordinator(os.path.join(base_dir, SHARDS_DIR, COORDINATOR_FILE))
+    done_attempts = coordinator.done_attempts()
+    for shard, attempt in done_attempts.items():
+        shard_dir = get_shard_dir(base_dir, shard, attempt)
+        for folder in OUTPUT_FOLDERS:
+            if os.path.isdir(os.path.join(shard_dir, folder)):
+                shutil.copytree(os.path.join(shard_dir, folder), os.path.join(base_dir, folder), dirs_exist_ok=True)
+        if os.path.isfile(os.path.join(shard_dir, r'ndvi_cube', cube_utils.META_FILE)):
+            cube.add_cube(cube_utils.open_cube(os.path.join(shard_dir, r'ndvi_cube')))
+        shard_index = similarity_utils.SimilarityIndex(os.path.join(shard_dir, r'ndvi_index'))
+        if len(shard_index):
+            similarity_index.add(shard_index.parcel_id, shard_index.vectors)
+        if os.path.isdir(os.path.join(shard_dir, r'ndvi_archive')):
+            archive.add_archive(os.path.join(shard_dir, r'ndvi_archive'))
+        # Snapshots of the shard's processes, renamed so that shards do not overwrite each other
+        for snapshot in glob.glob(os.path.join(shard_dir, r'metrics', metrics_utils.SNAPSHOT_PREFIX + "*.json")):
+            shutil.copyfile(snapshot, os.path.join(metrics_dir, "{}shard-{:04d}-{}".format(
+                metrics_utils.SNAPSHOT_PREFIX, shard, os.path.basename(snapshot))))
+    similarity_index.save()
+    logging.info("Merged {} shards into {}".format(len(done_attempts), base_dir))
+    return metrics_utils.export(metrics_dir)
@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Nearest-neighbour search over parcel NDVI curves resampled onto a common grid.
+
+import os
+import numpy as np
+import pandas as pd
+import cube_utils
+
+VECTORS_FILE = "vectors.npy"
+IDS_FILE = "parcel_id.npy"
+CENTROIDS_FILE = "centroids.npy"
+
+
+def resample_profile(ndvi_df, year, step=cube_utils.GRID_STEP):
+    """ Resample a parcel profile (acq_date, ndvi_mean) onto the regular day-of-year grid
+    Args:
+        ndvi_df: Pandas Dataframe
+        year: (int) profile year
+        step: (int) grid spacing in days
+
+    Returns:
+        vector: (numpy.ndarray) float32 NDVI values on the grid, NaN if the profile is empty
+    """
+    values = np.full((1, cube_utils.CUBE_DAYS), np.nan)
+    if not ndvi_df.empty:
+        dates = pd.to_datetime(ndvi_df["acq_date"]).values.astype("datetime64[D]")
+        days = (dates - np.datetime64("{}-01-01".format(year))).astype(np.int64)
+        in_year = (days >= 0) & (days < cube_utils.CUBE_DAYS)
+        values[0, days[in_year]] = pd.to_numeric(ndvi_df["ndvi_mean"], errors="coerce").values[in_year]
+    valid = ~np.isnan(values)
+    return cube_utils.interpolate_rows(values, valid, cube_utils.regular_grid(step=step))[0]
+
+
+class SimilarityIndex:
+    """ Nearest-neighbour index of NDVI curves.
+
+    Search is exact (vectorized euclidean distances over all curves) until train() is called;
+    afterwards queries only scan the n_probe closest k-means cells (approximate mode).
+    With an index_dir the curves are kept on disk and reloaded on the next run.
+    """
+
+    def __init__(self, index_dir=None):
+        self.index_dir = index_dir
+        self.parcel_id = np.empty(0, dtype=str)
+        self.vectors = None
+        self.centroids = None
+        self.assignment = None
+        self._rows = {}
+        self._size = 0
+        if index_dir and os.path.isfile(os.path.join(index_dir, VECTORS_FILE)):
+            self.vectors = np.load(os.path.join(index_dir, VECTORS_FILE))
+            self.parcel_id = np.load(os.path.join(index_dir, IDS_FILE))
+            self._size = len(self.parcel_id)
+            self._rows = {_id: i for i, _id in enumerate(self.parcel_id)}
+            if os.path.isfile(os.path.join(index_dir, CENTROIDS_FILE)):
+                self.centroids = np.load(os.path.join(index_dir, CENTROIDS_FILE))
+                self.assignment = self._assign(self.vectors)
+
+    def __len__(self):
+        return self._size
+
+    def add(self, parcel_ids, vectors):
+        """ Add curves to the index; a parcel already indexed gets its curve replaced
+        Args:
+            parcel_ids: (iterable) Polygon identifiers
+            vectors: (numpy.ndarray) curves on the common grid, one per row
+
+        Returns:
+            None
+        """
+        parcel_ids = np.asarray([str(_id) for _id in parcel_ids])
+        vectors = np.asarray(vectors, dtype=np.float32)
+        # Curves without data can not be compared
+        keep = ~np.isnan(vectors).any(axis=1)
+        parcel_ids, vectors = parcel_ids[keep], vectors[keep]
+        if self.vectors is None:
+            self.vectors = np.empty((0, vectors.shape[1]), dtype=np.float32)
+            self.assignment = None if self.centroids is None else np.empty(0, dtype=np.int64)
+
+        new_rows = []
+        for i, _id in enumerate(parcel_ids):
+            row = self._rows.get(_id)
+            if row is None:
+                new_rows.append(i)
+            else:
+                self.vectors[row] = vectors[i]
+                if self.centroids is not None:
+                    self.assignment[row] = self._assign(vectors[i:i + 1])[0]
+        if not new_rows:
+            return
+
+        # Grow the buffers by doubling to keep incremental updates cheap
+        needed = self._size + len(new_rows)
+        if needed > len(self.vectors):
+            capacity = max(needed, 2 * len(self.vectors), 1024)
+            vectors_buf = np.empty((capacity, self.vectors.shape[1]), dtype=np.float32)
+            vectors_buf[:self._size] = self.vectors[:self._size]
+            ids_buf = np.empty(capacity, dtype=object)
+            ids_buf[:self._size] = self.parcel_id[:self._size]
+            self.vectors, self.parcel_id = vectors_buf, ids_buf
+            if self.centroids is not None:
+                assignment_buf = np.empty(capacity, dtype=np.int64)
+                assignment_buf[:self._size] = self.assignment[:self._size]
+                self.assignment = assignment_buf
+        elif self.parcel_id.dtype != object:
+            self.parcel_id = self.parcel_id.astype(object)
+
+        new_rows = np.asarray(new_rows)
+        rows = np.arange(self._size, needed)
+        self.vectors[rows] = vectors[new_rows]
+        self.parcel_id[rows] = parcel_ids[new_rows]
+        if self.centroids is not None:
+            self.assignment[rows] = self._assign(vectors[new_rows])
+        for row, _id in zip(rows, parcel_ids[new_rows]):
+            self._rows[_id] = row
+        self._size = needed
+
+    def add_profiles(self, parcel_ids, ndvi_dfs, year, step=cube_utils.GRID_STEP):
+        """ Add the profiles of a processed batch (Dataframes with acq_date, ndvi_mean)
+        """
+        vectors = [resample_profile(ndvi_df, year, step) for ndvi_df in ndvi_dfs]
+        if vectors:
+            self.add(parcel_ids, np.vstack(vectors))
+
+    def add_cube(self, cube, chunk_size=10000, step=cube_utils.GRID_STEP):
+        """ Add every parcel of an NdviCube, reading it by chunks
+        """
+        for rows, mean, _, _ in cube.iter_chunks(chunk_size, gap_filled=True, step=step):
+            self.add(cube.parcel_id[rows], mean)
+
+    def train(self, n_lists=None, n_iter=10, seed=0):
+        """ Cluster the indexed curves with k-means and switch to approximate search
+        Args:
+            n_lists: (int) number of cells, by default sqrt of the number of curves; at most one
+                per curve
+            n_iter: (int) k-means iterations
+            seed: (int) random seed
+
+        Returns:
+            None
+        """
+        if self._size == 0:
+            # Nothing to cluster, search stays exact
+            return
+        vectors = self.vectors[:self._size]
+        if n_lists is None:
+            n_lists = max(1, int(np.sqrt(self._size)))
+        n_lists = max(1, min(n_lists, self._size))
+        rng = np.random.default_rng(seed)
+        # Train on a sample, large layers do not need every curve
+        sample = vectors[rng.choice(self._size, size=min(self._size, 256 * n_lists), replace=False)]
+        centroids = sample[rng.choice(len(sample), size=n_lists, replace=False)].copy()
+        for _ in range(n_iter):
+            labels = _nearest(sample, centroids)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, labels, sample)
+            counts = np.bincount(labels, minlength=n_lists)
+            filled = counts > 0
+            centroids[filled] = sums[filled] / counts[filled, None]
+        self.centroids = centroids
+        self.assignment = np.empty(len(self.vectors), dtype=np.int64)
+        self.assignment[:self._size] = self._assign(vectors)
+
+    def query(self, vector, k=10, n_probe=4, exclude=None):
+        """ The k curves closest to 'vector'
+        Args:
+            vector: (numpy.ndarray) curve on the common grid
+            k: (int) number of neighbours
+            n_probe: (int) cells scanned in approximate mode
+            exclude: parcel id left out of the results (the query parcel itself)
+
+        Returns:
+            neighbours: Pandas Dataframe with parcel_id and rmse columns, closest first
+        """
+        vector = np.asarray(vector, dtype=np.float32)
+        if self.centroids is None:
+            candidates = np.arange(self._size)
+        else:
+            probes = np.argsort(((self.centroids - vector) ** 2).sum(axis=1))[:n_probe]
+            candidates = np.flatnonzero(np.isin(self.assignment[:self._size], probes))
+        if exclude is not None and str(exclude) in self._rows:
+            candidates = candidates[candidates != self._rows[str(exclude)]]
+
+        dist = ((self.vectors[candidates] - vector) ** 2).mean(axis=1)
+        k = min(k, len(candidates))
+        if k == 0:
+            return pd.DataFrame(columns=["parcel_id", "rmse"])
+        best = np.argpartition(dist, k - 1)[:k]
+        best = best[np.argsort(dist[best])]
+        return pd.DataFrame({"parcel_id": self.parcel_id[candidates[best]],
+                             "rmse": np.sqrt(dist[best])})
+
+    def query_parcel(self, parcel_id, k=10, n_probe=4):
+        """ The k parcels whose season looks most like the one of parcel_id
+        """
+        vector = self.vectors[self._rows[str(parcel_id)]]
+        return self.query(vector, k=k, n_probe=n_probe, exclude=parcel_id)
+
+    def save(self):
+        """ Write the index to index_dir
+        """
+        if self.vectors is None or self._size == 0:
+            # Nothing was added, or only curves without data
+            return
+        if not os.path.exists(self.index_dir):
+            os.makedirs(self.index_dir)
+        np.save(os.path.join(self.index_dir, VECTORS_FILE), self.vectors[:self._size])
+        np.save(os.path.join(self.index_dir, IDS_FILE), self.parcel_id[:self._size].astype(str))
+        if self.centroids is not None:
+            np.save(os.path.join(self.index_dir, CENTROIDS_FILE), self.centroids)
+
+    def _assign(self, vectors):
+        return _nearest(vectors, self.centroids)
+
+
+def _nearest(vectors, centroids, chunk_size=10000):
+    """ Index of the closest centroid of every vector
+    """
+    labels = np.empty(len(vectors), dtype=np.int64)
+    centroids_sq = (centroids ** 2).sum(axis=1)
+    for start in range(0, len(vectors), chunk_size):
+        block = vectors[start:start + chunk_size]
+        dist = centroids_sq[None, :] - 2.0 * block @ centroids.T
+        labels[start:start + chunk_size] = np.argmin(dist, axis=1)
+    return labels
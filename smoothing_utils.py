@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Smoothing of many NDVI series at once: polynomial, Savitzky-Golay, Whittaker and harmonic.
+
+from collections import OrderedDict
+from math import comb
+import numpy as np
+import pandas as pd
+from scipy.linalg import cholesky_banded, cho_solve_banded
+from scipy.signal import savgol_filter
+import cube_utils
+
+# Default parameters of each method
+DEFAULT_PARAMS = {
+    "polynomial": {"degree": 5},
+    "savgol": {"window": 31, "polyorder": 3},
+    "whittaker": {"lam": 1000.0, "d": 2},
+    "harmonic": {"n_harmonics": 3, "period": 365.0},
+}
+# Maximum number of Whittaker factorizations kept for reuse
+MAX_FACTORIZATIONS = 64
+
+_factorizations = OrderedDict()
+
+
+def smooth(values, valid=None, method="polynomial", x_out=None, **params):
+    """ Smooth every row of a matrix of series sampled on a regular grid
+    Args:
+        values: (numpy.ndarray) 2D array, one series per row, columns 0..n-1
+        valid: (numpy.ndarray) boolean mask of the observed cells, by default the non NaN ones
+        method: (str) "polynomial", "savgol", "whittaker" or "harmonic"
+        x_out: (numpy.ndarray) column positions to return, all columns by default
+        params: method parameters, see DEFAULT_PARAMS
+
+    Returns:
+        smoothed: (numpy.ndarray) array of shape (rows, len(x_out)), NaN for rows that can not be fitted
+    """
+    if method not in SMOOTHERS:
+        raise ValueError("Unknown smoothing method {}, use one of {}".format(method, sorted(SMOOTHERS)))
+    values = np.atleast_2d(np.asarray(values, dtype=np.float64))
+    if valid is None:
+        valid = ~np.isnan(values)
+    valid = np.atleast_2d(valid) & ~np.isnan(values)
+    if x_out is None:
+        x_out = np.arange(values.shape[1])
+    method_params = dict(DEFAULT_PARAMS[method], **params)
+    return SMOOTHERS[method](values, valid, np.asarray(x_out), **method_params)
+
+
+def smooth_series(dates, values, method="polynomial", **params):
+    """ Smooth a single series with irregular dates, returning the smoothed value at each date
+    Args:
+        dates: (iterable) observation dates
+        values: (iterable) observed values
+        method: (str) smoothing method
+        params: method parameters
+
+    Returns:
+        smoothed: (numpy.ndarray) smoothed values aligned with dates
+    """
+    dates = pd.to_datetime(pd.Series(dates)).values.astype("datetime64[D]")
+    values = np.asarray(values, dtype=np.float64)
+    if len(dates) == 0:
+        return values
+    # Daily grid covering the series
+    days = (dates - dates.min()).astype(np.int64)
+    daily = np.full((1, days.max() + 1), np.nan)
+    daily[0, days] = values
+    return smooth(daily, method=method, x_out=days, **params)[0]
+
+
+def _least_squares(values, valid, basis, basis_out):
+    """ Weighted least squares fit of every row on a shared basis, by batched normal equations
+    """
+    n_coefs = basis.shape[1]
+    w = valid.astype(np.float64)
+    y = np.where(valid, values, 0.0)
+    lhs = np.einsum("nd,dp,dq->npq", w, basis, basis)
+    rhs = (w * y) @ basis
+    enough = valid.sum(axis=1) >= n_coefs
+    lhs[~enough] = np.eye(n_coefs)
+    coefs = np.linalg.solve(lhs, rhs[..., None])[..., 0]
+    fitted = coefs @ basis_out.T
+    fitted[~enough] = np.nan
+    return fitted
+
+
+def _polynomial(values, valid, x_out, degree):
+    """ Polynomial trend, as the np.polyfit one of display_ndvi_profiles
+    """
+    n_cols = values.shape[1]
+    # Scale x to [-1, 1] to keep the normal equations well conditioned
+    scale = max(n_cols - 1, 1) / 2.0
+    basis = np.vander((np.arange(n_cols) - scale) / scale, degree + 1)
+    basis_out = np.vander((x_out - scale) / scale, degree + 1)
+    return _least_squares(values, valid, basis, basis_out)
+
+
+def _harmonic(values, valid, x_out, n_harmonics, period):
+    """ Harmonic regression: mean plus n_harmonics sine/cosine pairs of the given period
+    """
+    def harmonics(x):
+        columns = [np.ones(len(x))]
+        for k in range(1, n_harmonics + 1):
+            columns.append(np.cos(2 * np.pi * k * x / period))
+            columns.append(np.sin(2 * np.pi * k * x / period))
+        return np.column_stack(columns)
+
+    return _least_squares(values, valid, harmonics(np.arange(values.shape[1])), harmonics(x_out))
+
+
+def _savgol(values, valid, x_out, window, polyorder):
+    """ Savitzky-Golay filter over the gap-filled series
+    """
+    n_cols = values.shape[1]
+    filled = cube_utils.interpolate_rows(values, valid, np.arange(n_cols)).astype(np.float64)
+    # The window has to be odd and fit into the series
+    window = min(window, n_cols if n_cols % 2 else n_cols - 1)
+    if window <= polyorder:
+        return filled[:, x_out]
+    has_data = ~np.isnan(filled).any(axis=1)
+    smoothed = np.full(filled.shape, np.nan)
+    smoothed[has_data] = savgol_filter(filled[has_data], window, polyorder, axis=1, mode="interp")
+    return smoothed[:, x_out]
+
+
+def _whittaker(values, valid, x_out, lam, d):
+    """ Whittaker smoother: solves (W + lam D'D) z = W y with a banded Cholesky factorization.
+
+    Rows sharing the same missing-value pattern share one factorization, which is also kept
+    between calls: gap-filled series (W = I) are all solved with a single factorization.
+    """
+    n_rows, n_cols = values.shape
+    smoothed = np.full((n_rows, n_cols), np.nan)
+    patterns, inverse = np.unique(np.packbits(valid, axis=1), axis=0, return_inverse=True)
+    inverse = np.asarray(inverse).reshape(-1)
+    for p in range(len(patterns)):
+        rows = np.flatnonzero(inverse == p)
+        w = valid[rows[0]].astype(np.float64)
+        # Not enough points to fix the d-order polynomial null space
+        if w.sum() < d:
+            continue
+        key = (patterns[p].tobytes(), n_cols, lam, d)
+        factor = _factorizations.get(key)
+        if factor is None:
+            factor = _whittaker_factor(w, lam, d)
+            _factorizations[key] = factor
+            if len(_factorizations) > MAX_FACTORIZATIONS:
+                _factorizations.popitem(last=False)
+        else:
+            _factorizations.move_to_end(key)
+        rhs = (np.where(valid[rows], values[rows], 0.0) * w).T
+        smoothed[rows] = cho_solve_banded((factor, False), rhs).T
+    return smoothed[:, x_out]
+
+
+def _difference_bands(n, d):
+    """ D'D of the order d difference matrix D (n - d by n), in upper banded storage:
+    bands[d - k, j] holds the element (j - k, j)
+    """
+    # Row r of D holds the coefficients c at columns r..r+d
+    c = np.array([(-1) ** (d - j) * comb(d, j) for j in range(d + 1)], dtype=np.float64)
+    m = n - d
+    bands = np.zeros((d + 1, n))
+    if m <= 0:
+        return bands
+    # Every row adds c[j] * c[l] to the element (r + j, r + l), on band l - j
+    for j in range(d + 1):
+        for l in range(j, d + 1):
+            bands[d - (l - j), l:l + m] += c[j] * c[l]
+    return bands
+
+
+def _whittaker_factor(w, lam, d):
+    """ Upper banded Cholesky factor of W + lam D'D, built band by band in O(n d^2)
+    """
+    bands = lam * _difference_bands(len(w), d)
+    bands[d] += w
+    return cholesky_banded(bands, lower=False)
+
+
+SMOOTHERS = {
+    "polynomial": _polynomial,
+    "savgol": _savgol,
+    "whittaker": _whittaker,
+    "harmonic": _harmonic,
+}
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Small NDVI line-chart thumbnails rasterized with NumPy, without matplotlib.
+
+import os
+import calendar
+import datetime
+import numpy as np
+import pandas as pd
+from PIL import Image
+import smoothing_utils
+import render_cache_utils
+
+# Colors (RGB)
+BACKGROUND = (255, 255, 255)
+GRID_COLOR = (210, 210, 210)
+AXES_COLOR = (0, 0, 0)
+SERIES_COLOR = (0, 0, 255)
+ERROR_COLOR = (150, 150, 150)
+TREND_COLOR = (255, 0, 0)
+# Plot area margins in pixels (left, top, right, bottom)
+MARGINS = (6, 6, 6, 6)
+# Bump when the look of the thumbnails changes
+RENDERER_VERSION = "thumbnail-1"
+
+
+def render_ndvi_thumbnail(ndvi_profile, output_file=None, width=320, height=160,
+                          add_error_bars=True, smoothing="polynomial", incremental=True):
+    """ Rasterize an NDVI profile (acq_date, ndvi_mean, ndvi_std) into a small line chart with the
+    series, error bars, trend and a month grid, as the graph_utils plots
+    Args:
+        ndvi_profile: Pandas Dataframe
+        output_file: (str) PNG or JPEG file to write, nothing is written if None
+        width: (int) image width in pixels
+        height: (int) image height in pixels
+        add_error_bars: (bool) draw ndvi_std error bars
+        smoothing: (str) smoothing_utils method of the trend line, None to skip it
+        incremental: (bool) keep output_file if it was drawn from the same data
+
+    Returns:
+        image: (numpy.ndarray) RGB image of shape (height, width, 3), None if output_file was kept
+    """
+    render_hash = None
+    if output_file is not None:
+        render_hash = render_cache_utils.get_render_hash(
+            ndvi_profile, RENDERER_VERSION, width, height, add_error_bars, smoothing)
+        if incremental and render_cache_utils.is_render_current(output_file, render_hash):
+            render_cache_utils.count_render(reused=True)
+            return
+    image = np.empty((height, width, 3), dtype=np.uint8)
+    image[:] = BACKGROUND
+    ndvi_profile = ndvi_profile.sort_values(by=['acq_date'])
+    dates = pd.to_datetime(ndvi_profile['acq_date']).values.astype("datetime64[D]")
+    values = ndvi_profile['ndvi_mean'].values.astype(np.float64)
+    if len(dates) == 0:
+        _save(image, output_file, render_hash)
+        return image
+
+    # x range from the first day of the first month to the last day of the last month
+    first = pd.Timestamp(dates.min()).date()
+    last = pd.Timestamp(dates.max()).date()
+    x_start = np.datetime64(datetime.date(first.year, first.month, 1))
+    x_end = np.datetime64(datetime.date(last.year, last.month, calendar.monthrange(last.year, last.month)[1]))
+    left, top, right, bottom = MARGINS
+    plot_w = width - left - right - 1
+    plot_h = height - top - bottom - 1
+
+    def to_px(days, ndvi):
+        x = left + (days / max((x_end - x_start).astype(np.int64), 1)) * plot_w
+        y = top + (1.0 - np.clip(ndvi, 0.0, 1.0)) * plot_h
+        return x, y
+
+    # Month grid and horizontal lines every 0.2
+    months = np.arange(x_start.astype("datetime64[M]"), x_end.astype("datetime64[M]") + 1)
+    month_x, _ = to_px((months.astype("datetime64[D]") - x_start).astype(np.float64), 0.0)
+    image[top:top + plot_h + 1, np.round(month_x).astype(int)] = GRID_COLOR
+    _, grid_y = to_px(0.0, np.arange(0.2, 1.0, 0.2))
+    image[np.round(grid_y).astype(int), left:left + plot_w + 1] = GRID_COLOR
+
+    days = (dates - x_start).astype(np.float64)
+    x, y = to_px(days, values)
+    if add_error_bars and 'ndvi_std' in ndvi_profile:
+        std = ndvi_profile['ndvi_std'].values.astype(np.float64)
+        _, y_low = to_px(days, values - std)
+        _, y_high = to_px(days, values + std)
+        draw_segments(image, x, y_low, x, y_high, ERROR_COLOR)
+    valid = ~np.isnan(values)
+    draw_polyline(image, x[valid], y[valid], SERIES_COLOR)
+    if smoothing is not None and valid.sum() > 1:
+        trend = smoothing_utils.smooth_series(dates[valid], values[valid], method=smoothing)
+        trend_x, trend_y = to_px(days[valid], trend)
+        draw_polyline(image, trend_x, trend_y, TREND_COLOR)
+
+    # Plot area frame
+    image[top, left:left + plot_w + 1] = AXES_COLOR
+    image[top + plot_h, left:left + plot_w + 1] = AXES_COLOR
+    image[top:top + plot_h + 1, left] = AXES_COLOR
+    image[top:top + plot_h + 1, left + plot_w] = AXES_COLOR
+    _save(image, output_file, render_hash)
+    return image
+
+
+def render_ndvi_thumbnails(ndvi_profiles, output_folder, extension="png", **kwargs):
+    """ Render (parcel_id, ndvi_profile) pairs into output_folder/<id>_NDVI.<extension>
+    Args:
+        ndvi_profiles: (iterable) (parcel_id, Pandas Dataframe) pairs
+        output_folder: (str) destination directory
+        extension: (str) "png" or "jpg"
+        kwargs: render_ndvi_thumbnail parameters
+
+    Returns:
+        n: (int) number of thumbnails written
+    """
+    if not os.path.exists(output_folder):
+        os.makedirs(output_folder)
+    n = 0
+    for parcel_id, ndvi_profile in ndvi_profiles:
+        render_ndvi_thumbnail(ndvi_profile, output_folder + "/" + str(parcel_id) + "_NDVI." + extension, **kwargs)
+        n += 1
+    return n
+
+
+def draw_segments(image, x0, y0, x1, y1, color, thickness=1):
+    """ Draw many straight segments at once, sampling every segment at one pixel steps
+    Args:
+        image: (numpy.ndarray) RGB image, modified in place
+        x0, y0, x1, y1: (numpy.ndarray) segment end points in pixel coordinates
+        color: (tuple) RGB color
+        thickness: (int) line thickness in pixels
+
+    Returns:
+        None
+    """
+    x0, y0, x1, y1 = (np.atleast_1d(np.asarray(a, dtype=np.float64)) for a in (x0, y0, x1, y1))
+    # Segments with a missing end point (NaN NDVI or std) are not drawn
+    finite = np.isfinite(x0) & np.isfinite(y0) & np.isfinite(x1) & np.isfinite(y1)
+    x0, y0, x1, y1 = x0[finite], y0[finite], x1[finite], y1[finite]
+    if len(x0) == 0:
+        return
+    dx = x1 - x0
+    dy = y1 - y0
+    n = np.ceil(np.maximum(np.abs(dx), np.abs(dy))).astype(np.int64) + 1
+    segment = np.repeat(np.arange(len(n)), n)
+    offsets = np.cumsum(n) - n
+    t = (np.arange(n.sum()) - offsets[segment]) / np.maximum(n - 1, 1)[segment]
+    px = np.round(x0[segment] + t * dx[segment]).astype(np.int64)
+    py = np.round(y0[segment] + t * dy[segment]).astype(np.int64)
+    height, width = image.shape[:2]
+    for offset in range(thickness):
+        inside = (px >= 0) & (px < width) & (py + offset >= 0) & (py + offset < height)
+        image[py[inside] + offset, px[inside]] = color
+
+
+def draw_polyline(image, x, y, color, thickness=2):
+    """ Draw the polyline through the points (x, y)
+    """
+    if len(x) > 1:
+        draw_segments(image, x[:-1], y[:-1], x[1:], y[1:], color, thickness)
+    elif len(x) == 1:
+        draw_segments(image, x, y, x, y, color, thickness)
+
+
+def _save(image, output_file, render_hash):
+    if output_file is None:
+        return
+    output_folder = os.path.dirname(output_file)
+    if output_folder and not os.path.exists(output_folder):
+        os.makedirs(output_folder, exist_ok=True)
+    Image.fromarray(image).save(output_file)
+    render_cache_utils.store_render_hash(output_file, render_hash)
+    render_cache_utils.count_render(reused=False)